@@ -207,6 +207,10 @@ def _init():
 
 DB_NAME = 'db.sqlite'
 DB_SCRIPT = 'db.sql'
+DB_READERS = 4
+'''
+Number of concurrent read-only connections, that serve SELECTs aside of writer
+'''
 
 def _db_connect(file=None):
 	logger = logging.getLogger(__name__)
@@ -231,7 +235,7 @@ def _init_db(file=None):
 		_create_db(file)
 		
 	# Configure database connection pool
-	t = sqlite_server.SQLiteServerThread(_db_connect)
+	t = sqlite_server.SQLiteServerThread(_db_connect, DB_READERS)
 	t.setDaemon(True)
 	t.start()
 	sqlite_server.wait_for_server_thread(t)
@@ -322,6 +326,8 @@ def _init_services():
 		
 	logger.debug('Initialize message handlers')
 	consumer = msg_service.get_consumer()
+	# Drop obsolete QueryEnv responses before handlers get the message
+	consumer.listeners.append(queryenv.on_message)
 	consumer.listeners.append(MessageListener())
 	
 	logger.debug('Schedule SNMP process')
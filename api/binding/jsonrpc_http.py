@@ -38,7 +38,7 @@ class Security(object):
 		self.crypto_key_path = crypto_key_path
 
 	def _read_crypto_key(self):
-		return binascii.a2b_base64(open(self.crypto_key_path).read().strip())
+		return cryptotool.read_key(self.crypto_key_path)
 	
 	def sign(self, data, key, timestamp=None):
 		date = time.strftime(self.DATE_FORMAT, timestamp or time.gmtime())
@@ -3,6 +3,7 @@ Created on Nov 25, 2011
 
 @author: marat
 '''
+from __future__ import with_statement
 
 from scalarizr import exceptions
 from scalarizr.libs import validate
@@ -10,8 +11,11 @@ from scalarizr.services import haproxy
 from scalarizr.util import iptables
 from scalarizr import rpc 
 
+import os
+import sys
 import logging
 LOG = logging.getLogger(__name__)
+STATS_SOCKET = '/var/run/haproxy-stats.sock'
 HEALTHCHECK_DEFAULTS = {
 	'timeout': {'check':'3s'}, 
 	'default-server': {'inter': '30s', 'fall': 2, 'rise': 10}
@@ -22,12 +26,125 @@ _rule_backend = validate.rule(re=r'^role:\d+$')
 _rule_hc_target = validate.rule(re='^[tcp|http]+:\d+$')
 
 
+class _Batch(object):
+	def __init__(self, api):
+		self.api = api
+
+	def __enter__(self):
+		if not self.api._batch_depth:
+			self.api.cfg.reload()
+			self.api._batch_dirty = False
+			self.api._batch_reload = False
+			self.api._batch_removed = []
+			self.api._batch_origin = str(self.api.cfg)
+		self.api._batch_depth += 1
+		return self.api
+
+	def __exit__(self, *args):
+		api = self.api
+		api._batch_depth -= 1
+		if api._batch_depth:
+			return
+		try:
+			if args[0]:
+				# Discard changes made in a failed batch
+				LOG.debug('HAProxyAPI batch failed. Reverting configuration')
+				api.cfg.reload()
+			elif api._batch_dirty:
+				if str(api.cfg) != api._batch_origin:
+					api.cfg.save()
+					api._apply_batch()
+				else:
+					LOG.debug('HAProxy configuration unchanged after batch')
+		finally:
+			api._batch_dirty = False
+			api._batch_removed = []
+
+
 class HAProxyAPI(object):
 
 	def __init__(self, path=None):
 		self.path_cfg = path
 		self.cfg = haproxy.HAProxyCfg(path)
 		self.svs = haproxy.HAProxyInitScript(path)
+		self._batch_depth = 0
+		self._batch_dirty = False
+		self._batch_reload = False
+		self._batch_removed = []
+		self._stats = None
+
+	def batch(self):
+		'''
+		Group several calls into one transaction: configuration is written 
+		and haproxy is gracefully reloaded once, when the outermost batch exits.
+		
+		>> with api.batch():
+		>> 	for ip in ips:
+		>> 		api.add_server(ipaddr=ip, backend='role:1234')
+		'''
+		return _Batch(self)
+
+	def _apply(self, reload=True):
+		'''
+		Save configuration and gracefully reload haproxy (or defer both until batch end).
+		@param reload: False when running haproxy already has the changes applied
+		through the stats socket and only the config file should be updated 
+		'''
+		if self._batch_depth:
+			self._batch_dirty = True
+			self._batch_reload = self._batch_reload or reload
+		else:
+			self.cfg.save()
+			if reload:
+				self._reload_service()
+
+	def _apply_batch(self):
+		# Servers removed in a batch are drained only now, so those added back
+		# by the same batch keep serving traffic
+		reload = self._batch_reload
+		drained = set()
+		for backend, server in self._batch_removed:
+			if (backend, server) in drained or self._has_server(backend, server):
+				continue
+			drained.add((backend, server))
+			reload = not self._drain_server(backend, server) or reload
+		if reload:
+			self._reload_service()
+
+	def _reload_service(self):
+		self.svs.reload()
+		# Stats connection belongs to the old haproxy process
+		if self._stats:
+			self._stats.close()
+			self._stats = None
+
+	def _stat_socket(self):
+		'''
+		@return: persistent StatSocket or None if haproxy has no stats socket
+		'''
+		if not self._stats:
+			try:
+				address = self.cfg.globals['stats']['socket']
+				if isinstance(address, list):
+					# socket <path> level admin
+					address = address[0]
+			except:
+				address = STATS_SOCKET
+			if not isinstance(address, basestring) or not os.path.exists(address):
+				return None
+			try:
+				self._stats = haproxy.StatSocket(address)
+			except:
+				LOG.debug('Cannot connect to haproxy stats socket: %s', sys.exc_info()[1])
+				return None
+		return self._stats
+
+	def _has_server(self, backend, server):
+		try:
+			return server in self.cfg.backend_servers(backend)
+		except:
+			# Backend section was removed
+			return False
 
 	def _server_name(self, ipaddr):
 		'''@rtype: str'''
@@ -99,8 +216,7 @@ class HAProxyAPI(object):
 				except Exception, e:
 					raise exceptions.Duplicate(e)
 
-				self.cfg.save()
-				self.svs.reload()
+				self._apply()
 
 				return listener
 
@@ -141,14 +257,12 @@ class HAProxyAPI(object):
 				'rise': healthy_threshold
 			}
 			self.cfg['backend'][bnd]['default-server'] = default_server
-			for srv in self.cfg['backend'][bnd]['server']:
-				server = self.cfg['backend'][bnd]['server'][srv]
+			for srv, server in self.cfg.backend_servers(bnd).items():
 				server.update({'check' : True})
-				self.cfg['backend'][bnd]['server'][srv] = server
+				self.cfg.set_server(bnd, srv, server)
 		#with self.svs.trans(exit='running'):
 			#	with self.cfg.trans(enter='reload', exit='working'):
-		self.cfg.save()
-		self.svs.reload()
+		self._apply()
 
 
 	@rpc.service_method
@@ -156,7 +270,8 @@ class HAProxyAPI(object):
 	@validate.param('backend', optional=_rule_backend)
 	def add_server(self, ipaddr=None, backend=None):
 		'''Add server with ipaddr in backend section''' 
-		self.cfg.reload()
+		if not self._batch_depth:
+			self.cfg.reload()
 		if backend: backend=backend.strip()
 		if ipaddr: ipaddr=ipaddr.strip()
 		LOG.debug('HAProxyAPI.add_server')
@@ -177,28 +292,33 @@ class HAProxyAPI(object):
 						'port': bnd.split(':')[-1],
 						'check': True
 					}
-					self.cfg.backends[bnd]['server'][ipaddr.replace('.', '-')] = server
+					self.cfg.set_server(bnd, self._server_name(ipaddr), server)
 
-				self.cfg.save()
-				self.svs.reload()
+				self._apply()
 
 
 	@rpc.service_method
 	@validate.param('ipaddr', type='ipv4', optional=True)
 	def get_servers_health(self, ipaddr=None):
 		try:
+			socket = self.cfg.globals['stats']['socket']
 			if self.cfg.defaults['stats'][''] == 'enable' and \
-					self.cfg.globals['stats']['socket'] == '/var/run/haproxy-stats.sock':
+					(socket == STATS_SOCKET or isinstance(socket, list) and socket[0] == STATS_SOCKET):
 				pass
 		except:
-			self.cfg.globals['stats']['socket'] = '/var/run/haproxy-stats.sock'
+			# Admin level allows to change servers state at runtime
+			self.cfg.globals['stats']['socket'] = '%s level admin' % STATS_SOCKET
 			self.cfg.defaults['stats'][''] = 'enable'
+			self._stats = None
+			# Stats socket is needed right now, don't wait for the batch end
 			self.cfg.save()
-			self.svs.reload()
+			self._reload_service()
 
 		#TODO: select parameters what we need with filter by ipaddr
-		stats = haproxy.StatSocket().show_stat()
-		return stats
+		stats = self._stat_socket()
+		if not stats:
+			raise haproxy.HAProxyError('HAProxy stats socket %s is not available' % STATS_SOCKET)
+		return stats.show_stat()
 
 
 	@rpc.service_method
@@ -237,8 +357,7 @@ class HAProxyAPI(object):
 		except Exception, e:
 			raise exceptions.NotFound(e)
 
-		self.cfg.save()
-		self.svs.reload()
+		self._apply()
 
 
 	@rpc.service_method
@@ -257,8 +376,7 @@ class HAProxyAPI(object):
 		#with self.svs.trans(exit='running'):
 			#	with self.cfg.trans(enter='reload', exit='working'):
 			#TODO: with...
-		self.cfg.save()
-		self.svs.reload()
+		self._apply()
 
 
 	@rpc.service_method
@@ -269,11 +387,32 @@ class HAProxyAPI(object):
 		if ipaddr: ipaddr = ipaddr.strip()
 		if backend: backend = backend.strip()
 		srv_name = self._server_name(ipaddr)
+		runtime = True
 		for bd in self.cfg.sections(haproxy.naming('backend', backend=backend)):
-			if ipaddr and srv_name in self.cfg.backends[bd]['server']:
-				del self.cfg.backends[bd]['server'][srv_name]
-		self.cfg.save()
-		self.svs.reload()
+			if ipaddr and self.cfg.remove_server(bd, srv_name):
+				if self._batch_depth:
+					# Drained when batch exits, unless server is added back
+					self._batch_removed.append((bd, srv_name))
+				else:
+					runtime = runtime and self._drain_server(bd, srv_name)
+		# When server was drained in running haproxy, only config file is updated.
+		# It's picked up by the next reload
+		self._apply(reload=not runtime)
+
+
+	def _drain_server(self, backend, server):
+		stats = self._stat_socket()
+		if not stats:
+			return False
+		try:
+			stats.drain_server(backend, server)
+			LOG.debug('Server %s/%s disabled through stats socket', backend, server)
+			return True
+		except:
+			# Not an admin level socket or haproxy has no such server
+			LOG.debug('Cannot disable server %s/%s through stats socket: %s', 
+					backend, server, sys.exc_info()[1])
+			return False
 
 
 	@rpc.service_method
@@ -288,7 +427,8 @@ class HAProxyAPI(object):
 			<backend>, 
 			<servers>: [<ipaddr>, ...]
 		}, ...]'''
-		self.cfg.reload()
+		if not self._batch_depth:
+			self.cfg.reload()
 		res = []
 		for ln in self.cfg.sections(haproxy.naming('listen')):
 			listener = self.cfg.listener[ln]
@@ -318,7 +458,7 @@ class HAProxyAPI(object):
 
 		res = []
 		for bnd in list_section:
-			for srv_name in self.cfg.backends[bnd]['server']:
-				res.append(self.cfg.backends[bnd]['server'][srv_name]['address'])
+			for server in self.cfg.backend_servers(bnd).values():
+				res.append(server['address'])
 		res = list(set(res))
 		return res
\ No newline at end of file
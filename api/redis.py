@@ -9,12 +9,12 @@ from __future__ import with_statement
 import os
 import sys
 import time
+import Queue
 import logging
 import threading
 from scalarizr import config
 from scalarizr.bus import bus
 from scalarizr import handlers, rpc
-from scalarizr.util import system2, PopenError
 from scalarizr.util.iptables import IpTables, RuleSpec, P_TCP
 from scalarizr.services import redis as redis_service
 from scalarizr.handlers import redis as redis_handler
@@ -39,6 +39,7 @@ class RedisAPI(object):
 
 	_cnf = None
 	_queryenv = None
+	max_workers = 4
 	
 	def __init__(self):
 		self._cnf = bus.cnf
@@ -110,138 +111,151 @@ class RedisAPI(object):
 	def _launch(self, ports=[], passwords=[], op=None):
 		LOG.debug('Launching redis processes on ports %s with passwords %s' % (ports, passwords))
 		is_replication_master = self.is_replication_master
+		kind = 'Master' if is_replication_master else 'Slave'
 		
 		primary_ip = self.get_primary_ip()
 		assert primary_ip is not None
 		
-		new_passwords = []
-		new_ports = []
-		
-		
 		iptables = IpTables()
+		iptables_enabled = iptables.enabled()
+		iptables_lock = threading.Lock()
 		
-		
-		for port,password in zip(ports, passwords or [None for port in ports]):
-			if op:
-				op.step('Launch Redis %s on port %s' % ('Master' if is_replication_master else 'Slave', port))
-			try:
-				if op:
-					op.__enter__()
-					
-				if iptables.enabled():
+		def launch(item):
+			port, password = item
+			if iptables_enabled:
+				with iptables_lock:
 					iptables.insert_rule(None, RuleSpec(dport=port, jump='ACCEPT', protocol=P_TCP))
 
-				redis_service.create_redis_conf_copy(port)
-				redis_process = redis_service.Redis(is_replication_master, self.persistence_type, port, password)
-				
-				if not redis_process.service.running:
-					LOG.debug('Launch Redis %s on port %s' % ('Master' if is_replication_master else 'Slave', port))
-					if is_replication_master:
-						current_password = redis_process.init_master(STORAGE_PATH)  
-					else: 
-						current_password = redis_process.init_slave(STORAGE_PATH, primary_ip, port)
-					new_passwords.append(current_password)
-					new_ports.append(port)
-					LOG.debug('Redis process has been launched on port %s with password %s' % (port, current_password))
-					
-				else:
-					raise BaseException('Cannot launch redis on port %s: the process is already running' % port)
-				
-			except:
-				if op:
-					op.__exit__(sys.exc_info())
-				raise
-			finally:
-				if op:
-					op.__exit__(None)
+			redis_service.create_redis_conf_copy(port)
+			redis_process = redis_service.Redis(is_replication_master, self.persistence_type, port, password)
+			
+			if redis_process.service.running:
+				raise BaseException('Cannot launch redis on port %s: the process is already running' % port)
+
+			LOG.debug('Launch Redis %s on port %s' % (kind, port))
+			if is_replication_master:
+				current_password = redis_process.init_master(STORAGE_PATH)  
+			else: 
+				current_password = redis_process.init_slave(STORAGE_PATH, primary_ip, port)
+			LOG.debug('Redis process has been launched on port %s with password %s' % (port, current_password))
+			return current_password
+
+		results = self._run_parallel(launch, zip(ports, passwords or [None for port in ports]), 
+					op, lambda item: 'Launch Redis %s on port %s' % (kind, item[0]))
+		
+		new_ports = []
+		new_passwords = []
+		failed = []
+		for (port, _), current_password, exc_info in results:
+			if exc_info:
+				failed.append('%s (%s)' % (port, exc_info[1]))
+			else:
+				new_ports.append(port)
+				new_passwords.append(current_password)
+		if failed:
+			raise BaseException('Cannot launch Redis on ports: %s. Launched on ports: %s' % (
+						', '.join(failed), new_ports))
 		return (new_ports, new_passwords)
 		
 	
 	def _shutdown(self, ports, remove_data=False, op=None):
-		is_replication_master = self.is_replication_master
-		freed_ports = []
-		for port in ports:
-			if op:
-				op.step('Shutdown Redis %s on port %s' ('Master' if is_replication_master else 'Slave', port))
-			try:
-				if op:
-					op.__enter__()
-				LOG.debug('Shutting down redis instance on port %s' % (port))
-				instance = redis_service.Redis(port=port)
-				if instance.service.running:
-					password = instance.redis_conf.requirepass
-					instance.password = password
-					LOG.debug('Dumping redis data on disk using password %s from config file %s' % (password, instance.redis_conf.path))
-					instance.redis_cli.save()
-					LOG.debug('Stopping the process')
-					instance.service.stop()
-					freed_ports.append(port)
-				if remove_data and os.path.exists(instance.db_path):
-					os.remove(instance.db_path)
-			except:
-				if op:
-					op.__exit__(sys.exc_info())
-				raise
-			finally:
-				if op:
-					op.__exit__(None)
+		kind = 'Master' if self.is_replication_master else 'Slave'
+
+		def shutdown(port):
+			LOG.debug('Shutting down redis instance on port %s' % (port))
+			instance = redis_service.Redis(port=port)
+			freed = False
+			if instance.service.running:
+				password = instance.redis_conf.requirepass
+				instance.password = password
+				LOG.debug('Dumping redis data on disk using password %s from config file %s' % (password, instance.redis_conf.path))
+				instance.redis_cli.save()
+				LOG.debug('Stopping the process')
+				instance.service.stop()
+				freed = True
+			if remove_data and os.path.exists(instance.db_path):
+				os.remove(instance.db_path)
+			return freed
+
+		results = self._run_parallel(shutdown, list(ports), 
+					op, lambda port: 'Shutdown Redis %s on port %s' % (kind, port))
+
+		freed_ports = [port for port, freed, exc_info in results if freed]
+		failed = ['%s (%s)' % (port, exc_info[1]) for port, _, exc_info in results if exc_info]
+		if failed:
+			raise BaseException('Cannot shutdown Redis on ports: %s. Freed ports: %s' % (
+						', '.join(failed), freed_ports))
 		return dict(ports=freed_ports)
 	
 	
+	def _run_parallel(self, fn, items, op=None, step_name=None):
+		'''
+		Calls fn(item) for each item in at most `max_workers` threads.
+		With op each item is reported as a separate operation step named step_name(item)
+		@return: list of (item, result, exc_info) in the order of items
+		'''
+		results = [None] * len(items)
+		queue = Queue.Queue()
+		for i, item in enumerate(items):
+			queue.put((i, item))
+		
+		def worker():
+			while True:
+				try:
+					i, item = queue.get_nowait()
+				except Queue.Empty:
+					return
+				step = op.concurrent_step(step_name(item)) if op else None
+				if step:
+					step.__enter__()
+				try:
+					results[i] = (item, fn(item), None)
+				except:
+					exc_info = sys.exc_info()
+					LOG.error('%s failed: %s' % (step_name(item) if step_name else item, exc_info[1]), 
+							exc_info=exc_info)
+					results[i] = (item, None, exc_info)
+				if step:
+					step.__exit__(*(results[i][2] or (None, None, None)))
+		
+		workers = [threading.Thread(target=worker) for _ in range(min(self.max_workers, len(items)))]
+		for t in workers:
+			t.start()
+		for t in workers:
+			t.join()
+		return results
+	
+	
 	@property
 	def busy_ports(self):
-		busy_ports = []
-		args = ('ps', '-G', 'redis', '-o', 'command', '--no-headers')
-		out = system2(args, silent=True)[0].split('\n')
-		try:	
-			p = [x for x in out if x and BIN_PATH in x]
-		except PopenError,e:
-			p = []
-		LOG.debug('Running redis processes: %s' % p)
-		#LOG.debug('PORTS_RANGE: %s' % PORTS_RANGE)
-		for redis_process in p:
-			#LOG.debug('checking redis process: %s' % redis_process)
-			for port in PORTS_RANGE:
-				conf_name = redis_service.get_redis_conf_basename(port)
-				#LOG.debug('checking config %s in %s: %s' % (conf_name, redis_process,conf_name in redis_process))
-				if conf_name in redis_process:
-					busy_ports.append(port)
-				elif redis_service.DEFAULT_PORT == port and redis_service.DEFAULT_CONF_PATH in redis_process:
-					busy_ports.append(port)
+		busy_ports = sorted(port for port in redis_service.get_redis_pids() if port in PORTS_RANGE)
 		LOG.debug('busy_ports: %s' % busy_ports)
 		return busy_ports
 	
 	
 	@property
 	def available_ports(self):
-		return [port for port in PORTS_RANGE if port not in self.busy_ports]
+		busy_ports = self.busy_ports
+		return [port for port in PORTS_RANGE if port not in busy_ports]
 	
 	
 	def get_running_processes(self):
-		processes = {}
 		ports = []
 		passwords = []
-		for port in self.busy_ports:
-			conf_path = redis_service.get_redis_conf_path(port)
-			
-			if port == redis_service.DEFAULT_PORT:
-				args = ('ps', '-G', 'redis', '-o', 'command', '--no-headers')
-				out = system2(args, silent=True)[0].split('\n')
-				try:
-					p = [x for x in out if x and BIN_PATH in x and redis_service.DEFAULT_CONF_PATH in x]
-				except PopenError,e:
-					p = []
-				if p:
-					conf_path = redis_service.DEFAULT_CONF_PATH
-					
+		pids = []
+		processes = redis_service.get_redis_pids()
+		for port in sorted(processes):
+			if port not in PORTS_RANGE:
+				continue
+			pid, conf_path = processes[port]
 			LOG.debug('Got config path %s for port %s' % (conf_path, port))
 			redis_conf = redis_service.RedisConf(conf_path)
 			password = redis_conf.requirepass
-			processes[port] = password
 			ports.append(port)
 			passwords.append(password)
+			pids.append(pid)
 			LOG.debug('Redis config %s has password %s' % (conf_path, password))
-		return dict(ports=ports, passwords=passwords)
+		return dict(ports=ports, passwords=passwords, pids=pids)
 								
 		
 	@property
@@ -269,7 +283,7 @@ class RedisAPI(object):
 		while not master_host:
 			try:
 				master_host = list(host 
-					for host in self._queryenv.list_roles(behaviour=BEHAVIOUR)[0].hosts 
+					for host in self._queryenv.list_roles(behaviour=BEHAVIOUR, cached=False)[0].hosts 
 					if host.replication_master)[0]
 			except IndexError:
 				LOG.debug("QueryEnv respond with no %s master. " % BEHAVIOUR + 
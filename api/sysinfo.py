@@ -15,6 +15,7 @@ import glob
 
 from scalarizr import rpc
 from scalarizr.util import system2, dns, disttool
+from scalarizr.linux.procstat import sampler
 
 LOG = logging.getLogger(__name__)
 
@@ -94,11 +95,7 @@ class SysInfoAPI(object):
 		@rtype: list 
 		'''
 
-		lines = self._readlines(self._DISKSTATS)
-		devicelist = []
-		for value in lines:
-			devicelist.append(value.split()[2])
-		return devicelist
+		return [stat.device for stat in sampler.diskstats()]
 
 
 	@rpc.service_method
@@ -218,12 +215,12 @@ class SysInfoAPI(object):
 			'idle': 147309
 		}
 		'''
-		cpu = open('/proc/stat').readline().strip().split()
+		cpu = sampler.cpu()
 		return {
-			'user': int(cpu[1]),
-			'nice': int(cpu[2]),
-			'system': int(cpu[3]),
-			'idle': int(cpu[4])
+			'user': cpu.user,
+			'nice': cpu.nice,
+			'system': cpu.system,
+			'idle': cpu.idle
 		}
 
 
@@ -243,10 +240,7 @@ class SysInfoAPI(object):
 			'cached': 316756
 		}
 		'''
-		info = {}
-		for line in open('/proc/meminfo'):
-			pairs = line.split(':', 1)
-			info[pairs[0]] = int(pairs[1].strip().split(' ')[0])
+		info = sampler.meminfo()
 		return {
 			'total_swap': info['SwapTotal'],
 			'avail_swap': info['SwapFree'],
@@ -288,23 +282,11 @@ class SysInfoAPI(object):
 		'''
 		#http://www.kernel.org/doc/Documentation/iostats.txt
 
-		lines = self._readlines(self._DISKSTATS)
 		devicelist = {}
-		for value in lines:
-			params = value.split()[2:]
-			device = params[0]
-			for i in range(1, len(params)-1):
-				params[i] = int(params[i])
-			if len(params) == 12:
-				read = {'num': params[1], 'sectors': params[3], 'bytes': params[3]*512}
-				write = {'num': params[5], 'sectors': params[7], 'bytes': params[7]*512}
-			elif len(params) == 5:
-				read = {'num': params[1], 'sectors': params[2], 'bytes': params[2]*512}
-				write = {'num': params[3], 'sectors': params[4], 'bytes': params[4]*512}
-			else:
-				raise Exception, 'number of column in %s is unexpected. Count of column =\
-					 %s' % (self._DISKSTATS, len(params)+2)
-			devicelist[device] = {'write': write, 'read': read}
+		for stat in sampler.diskstats():
+			read = {'num': stat.reads, 'sectors': stat.read_sectors, 'bytes': stat.read_sectors*512}
+			write = {'num': stat.writes, 'sectors': stat.write_sectors, 'bytes': stat.write_sectors*512}
+			devicelist[stat.device] = {'write': write, 'read': read}
 		return devicelist
 
 
@@ -329,17 +311,14 @@ class SysInfoAPI(object):
 		}
 		'''
 
-		lines = self._readlines(self._NETSTATS)
 		res = {}
-		for row in lines:
-			if ':' not in row:
-				continue
-			row = row.split(':')
-			iface = row.pop(0).strip()
-			columns = map(lambda x: x.strip(), row[0].split())
-			res[iface] = {
-				'receive': {'bytes': columns[0], 'packets': columns[1], 'errors': columns[2]},
-				'transmit': {'bytes': columns[8], 'packets': columns[9], 'errors': columns[10]},
+		for stat in sampler.netdev():
+			# Values are strings for compatibility with previous versions 
+			res[stat.iface] = {
+				'receive': {'bytes': str(stat.rx_bytes), 'packets': str(stat.rx_packets), 
+						'errors': str(stat.rx_errors)},
+				'transmit': {'bytes': str(stat.tx_bytes), 'packets': str(stat.tx_packets), 
+						'errors': str(stat.tx_errors)},
 			}
 
 		return res
\ No newline at end of file
@@ -31,6 +31,9 @@ class operation(object):
 		self._phase = None
 		self._step = None
 		self._stepnos = {}
+		self._stepno = None
+		self._lock = threading.Lock()
+		self._concurrent = 0
 	
 	def phase(self, name):
 		self._phase = name
@@ -45,9 +48,17 @@ class operation(object):
 		self._warning = warning
 		return self
 	
+	def concurrent_step(self, name, warning=False):
+		'''
+		Step that may run in parallel with other steps of the current phase
+		'''
+		return _concurrent_step(self, name, warning)
+	
 	def __enter__(self):
 		if self._depth == 'step':
-			self._stepnos[self._phase] += 1
+			with self._lock:
+				self._stepnos[self._phase] += 1
+				self._stepno = self._stepnos[self._phase]
 			STATE['operation.id'] = self.id
 			STATE['operation.step'] = self._step
 			STATE['operation.in_progress'] = 1			
@@ -95,15 +106,18 @@ class operation(object):
 	def warning(self, exc_info=None, handler=None):
 		self._send_progress('warning', warning=self._format_error(exc_info, handler))
 
-	def _send_progress(self, status, progress=None, warning=None):
+	def _send_progress(self, status, progress=None, warning=None, step=None):
+		'''
+		@param step: _concurrent_step to report instead of the current one
+		'''
 		if bus.scalr_version >= (2, 6):
 			srv = bus.messaging_service
 			msg = srv.new_message(Messages.OPERATION_PROGRESS, None, {
 				'id': self.id,
 				'name': self.name,
-				'phase': self._phase,
-				'step': self._step,
-				'stepno' : self._stepnos[self._phase],
+				'phase': step.phase if step else self._phase,
+				'step': step.name if step else self._step,
+				'stepno' : step.stepno if step else self._stepno,
 				'status': status,
 				'progress': progress,
 				'warning': warning
@@ -118,7 +132,7 @@ class operation(object):
 		self._send_result('error', error=self._format_error(exc_info, handler))
 		self.finished = True
 	
-	def _send_result(self, status, error=None, data=None):
+	def _send_result(self, status, error=None, data=None, step=None):
 		if bus.scalr_version >= (2, 6):
 			srv = bus.messaging_service
 			msg = srv.new_message(Messages.OPERATION_RESULT, None, {
@@ -130,8 +144,8 @@ class operation(object):
 			if status == 'error':
 				msg.body.update({
 					'error': error,							
-					'phase': self._phase,
-					'step': self._step,
+					'phase': step.phase if step else self._phase,
+					'step': step.name if step else self._step,
 				})
 			srv.get_producer().send(Queues.CONTROL, msg)
 	
@@ -145,6 +159,46 @@ class operation(object):
 		}
 
 
+class _concurrent_step(object):
+	'''
+	Operation step that keeps its own phase, name and step number,
+	so concurrent steps don't overwrite each other's in the operation
+	'''
+	def __init__(self, op, name, warning=False):
+		self.op = op
+		self.phase = op._phase
+		self.name = name
+		self.warning = warning
+		self.stepno = None
+	
+	def __enter__(self):
+		op = self.op
+		with op._lock:
+			op._stepnos[self.phase] += 1
+			self.stepno = op._stepnos[self.phase]
+			op._concurrent += 1
+			STATE['operation.id'] = op.id
+			STATE['operation.step'] = self.name
+			STATE['operation.in_progress'] = 1
+		op._send_progress('running', progress=0, step=self)
+		return self
+	
+	def __exit__(self, *args):
+		op = self.op
+		with op._lock:
+			op._concurrent -= 1
+			if not op._concurrent:
+				STATE['operation.step'] = ''
+				STATE['operation.in_progress'] = 0
+		if not args[0]:
+			op._send_progress('complete', progress=100, step=self)
+		elif self.warning:
+			op._send_progress('warning', warning=op._format_error(args), step=self)
+		else:
+			op._send_result('error', error=op._format_error(args), step=self)
+			op.finished = True
+
+
 class Handler(object):
 	_service_name = behaviour = None
 	_logger = logging.getLogger(__name__)
@@ -177,7 +231,8 @@ class Handler(object):
 		srv = bus.messaging_service
 		msg = msg_name if isinstance(msg_name, Message) else \
 				self.new_message(msg_name, msg_body, msg_meta, broadcast)
-		srv.get_producer().send(queue, msg)
+		# Message should be encrypted with the old key
+		srv.get_producer().send(queue, msg, wait=bool(new_crypto_key))
 		cons = srv.get_consumer()
 		
 		if new_crypto_key:
@@ -661,6 +716,14 @@ class DbMsrMessages:
 
 
 class FarmSecurityMixin(object):
+	FARM_CHAIN = 'SCALARIZR-FARM'
+	'''
+	Chain with ACCEPT rules for all farm servers. Protected ports jump to it 
+	from the firewall chain and are dropped if server is not in the farm
+	'''
+	
+	_farm_chain = None
+	
 	def __init__(self, ports):
 		self._logger = logging.getLogger(__name__)
 		self._ports = ports
@@ -683,16 +746,19 @@ class FarmSecurityMixin(object):
 		self._platform = bus.platform
 	
 	
+	def __get_farm_chain(self):
+		# Shared by all handlers protecting their ports
+		if not FarmSecurityMixin._farm_chain:
+			FarmSecurityMixin._farm_chain = self._iptables.SourceChain(self.FARM_CHAIN)
+		return FarmSecurityMixin._farm_chain
+	
+	
 	def on_HostInit(self, message):
 		# Append new server to allowed list
 		if not self._iptables.enabled():
 			return
 
-		rules = []
-		for port in self._ports:
-			rules += self.__accept_host(message.local_ip, message.remote_ip, port)
-
-		self._iptables.FIREWALL.ensure(rules)
+		self.__get_farm_chain().update(add=self.__host_sources(message.local_ip, message.remote_ip))
 		
 
 	def on_HostDown(self, message):
@@ -700,19 +766,8 @@ class FarmSecurityMixin(object):
 		if not self._iptables.enabled():
 			return
 		
-		rules = []
-		for port in self._ports:
-			rules += self.__accept_host(message.local_ip, message.remote_ip, port)
-		for rule in rules:
-			try:
-				self._iptables.FIREWALL.remove(rule)
-				#self._iptables.delete_rule(rule)
-			except: #?
-				if 'does a matching rule exist in that chain' in str(sys.exc_info()[1]):
-					# When HostDown comes from a server that didn't send HostInit    
-					pass
-				else:
-					raise
+		# Servers that didn't send HostInit are simply not in the chain
+		self.__get_farm_chain().update(remove=self.__host_sources(message.local_ip, message.remote_ip))
 
 
 	def __create_rule(self, source, dport, jump):
@@ -722,48 +777,38 @@ class FarmSecurityMixin(object):
 		return rule
 
 		
-	def __create_accept_rule(self, source, dport):
-		return self.__create_rule(source, dport, 'ACCEPT')
-	
-	
 	def __create_drop_rule(self, dport):
 		return self.__create_rule(None, dport, 'DROP')
 	
 
-	def __accept_host(self, local_ip, public_ip, dport):
+	def __host_sources(self, local_ip, public_ip):
 		ret = []
 		if local_ip == self._platform.get_private_ip():
-			ret.append(self.__create_accept_rule('127.0.0.1', dport))
+			ret.append('127.0.0.1')
 		if local_ip:
-			ret.append(self.__create_accept_rule(local_ip, dport))
-		ret.append(self.__create_accept_rule(public_ip, dport))
+			ret.append(local_ip)
+		if public_ip:
+			ret.append(public_ip)
 		return ret
 
 
 	def __insert_iptables_rules(self, *args, **kwds):
 		# Collect farm servers IP-s
-		hosts = []					
+		sources = self.__host_sources(self._platform.get_private_ip(), 
+									self._platform.get_public_ip())
 		for role in self._queryenv.list_roles(with_init=True):
 			for host in role.hosts:
-				hosts.append((host.internal_ip, host.external_ip))
-		
-		rules = []
-		for port in self._ports:
-			# TODO: this will be duplicated, because current host is in the
-			# hosts list too
-			# TODO: this also duplicates the rules, inserted in on_HostInit
-			# for the current host
-			rules += self.__accept_host(self._platform.get_private_ip(), 
-									self._platform.get_public_ip(), port)
-			for local_ip, public_ip in hosts:
-				rules += self.__accept_host(local_ip, public_ip, port)
+				sources += self.__host_sources(host.internal_ip, host.external_ip)
+		self.__get_farm_chain().sync(sources)
 		
-		# Deny from all
+		# Farm servers are accepted in the farm chain, others get to the end and dropped
+		jump_rules = []
 		drop_rules = []
 		for port in self._ports:
+			jump_rules.append(self.__create_rule(None, port, self.FARM_CHAIN))
 			drop_rules.append(self.__create_drop_rule(port))
 
-		self._iptables.FIREWALL.ensure(rules)
+		self._iptables.FIREWALL.ensure(jump_rules)
 		self._iptables.FIREWALL.ensure(drop_rules, append=True)
 
 
@@ -130,7 +130,7 @@ class MainHandler(handlers.Handler, handlers.FarmSecurityMixin):
 		if is_cloud_controller():
 			host = local_ip()
 		else:
-			roles = _queryenv.list_roles(behaviour=_bhs.cloud_controller)
+			roles = _queryenv.list_roles(behaviour=_bhs.cloud_controller, cached=False)
 			if roles and roles[0].hosts:
 				host = roles[0].hosts[0].internal_ip
 		if host:
@@ -286,7 +286,7 @@ class CloudControllerHandler(handlers.Handler):
 		if 'www' in _bhs:
 			host = local_ip()
 		else:
-			roles = _queryenv.list_roles(behaviour='www')
+			roles = _queryenv.list_roles(behaviour='www', cached=False)
 			if roles and roles[0].hosts:
 				host = roles[0].hosts[0].internal_ip
 		if host:
@@ -53,28 +53,30 @@ class HAProxyHandler(Handler):
 		result = queryenv.list_roles()
 		running_servers = []
 		
-		bnds = []
-		for elem in self.api.list_listeners():
-			bnds.append(elem['backend'])
-		bnds = list(set(bnds))
-
-		for bnd in bnds:
-			for srv in self.api.list_servers(backend=bnd):
-				self.api.remove_server(ipaddr=srv, backend=bnd)
-
-		for d in result:
-			behaviour=', '.join(d.behaviour)
-			for host in d.hosts:
-				try:
-					if 'role:%s' % d.farm_role_id in bnds:
-						self.api.add_server(ipaddr=host.internal_ip, 
-							backend='role:%s' % d.farm_role_id)
-				except:
-					LOG.warn('HAProxyHandler.on_before_host_up.Failed add_server `%s` in'
-							' backend=`role:%s`, details: %s' %	(
-							host.internal_ip.replace('.', '-'),
-							d.farm_role_id, sys.exc_info()[1]))
-				running_servers.append([d.farm_role_id, host.internal_ip])
+		# Write configuration and reload haproxy once for all changes
+		with self.api.batch():
+			bnds = []
+			for elem in self.api.list_listeners():
+				bnds.append(elem['backend'])
+			bnds = list(set(bnds))
+
+			for bnd in bnds:
+				for srv in self.api.list_servers(backend=bnd):
+					self.api.remove_server(ipaddr=srv, backend=bnd)
+
+			for d in result:
+				behaviour=', '.join(d.behaviour)
+				for host in d.hosts:
+					try:
+						if 'role:%s' % d.farm_role_id in bnds:
+							self.api.add_server(ipaddr=host.internal_ip, 
+								backend='role:%s' % d.farm_role_id)
+					except:
+						LOG.warn('HAProxyHandler.on_before_host_up.Failed add_server `%s` in'
+								' backend=`role:%s`, details: %s' %	(
+								host.internal_ip.replace('.', '-'),
+								d.farm_role_id, sys.exc_info()[1]))
+					running_servers.append([d.farm_role_id, host.internal_ip])
 		LOG.debug('running_servers: `%s`', running_servers)
 	
 	
@@ -133,25 +135,26 @@ class HAProxyHandler(Handler):
 
 		data = {'listeners': [], 'healthchecks': []}
 
-		if isinstance(self._listeners, list):
-			for ln in self._listeners:
-				try:
-					ln0 = self.api.create_listener(**ln)
-					data['listeners'].append(ln0)
-				except Exception, e:
-					LOG.error('HAProxyHandler.on_before_host_up. Failed to add listener'\
-						' `%s`. Details: %s', str(ln), e, exc_info=sys.exc_info())
-					#raise Exception, sys.exc_info()[1], sys.exc_info()[2]
-
-		if isinstance(self._healthchecks, list):
-			for hl in self._healthchecks:
-				try:
-					hl0 = self.api.configure_healthcheck(**hl)
-					data['healthchecks'].append(hl0)
-				except Exception, e:
-					LOG.error('HAProxyHandler.on_before_host_up. Failed to configure'\
-						' healthcheck `%s`. Details: %s', str(hl), e, exc_info=sys.exc_info())
-					#raise Exception, sys.exc_info()[1], sys.exc_info()[2]
+		with self.api.batch():
+			if isinstance(self._listeners, list):
+				for ln in self._listeners:
+					try:
+						ln0 = self.api.create_listener(**ln)
+						data['listeners'].append(ln0)
+					except Exception, e:
+						LOG.error('HAProxyHandler.on_before_host_up. Failed to add listener'\
+							' `%s`. Details: %s', str(ln), e, exc_info=sys.exc_info())
+						#raise Exception, sys.exc_info()[1], sys.exc_info()[2]
+
+			if isinstance(self._healthchecks, list):
+				for hl in self._healthchecks:
+					try:
+						hl0 = self.api.configure_healthcheck(**hl)
+						data['healthchecks'].append(hl0)
+					except Exception, e:
+						LOG.error('HAProxyHandler.on_before_host_up. Failed to configure'\
+							' healthcheck `%s`. Details: %s', str(hl), e, exc_info=sys.exc_info())
+						#raise Exception, sys.exc_info()[1], sys.exc_info()[2]
 		msg.haproxy = data
 
 		self._remove_add_servers_from_queryenv()
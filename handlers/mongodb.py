@@ -547,7 +547,7 @@ class MongoDBHandler(ServiceCtlHandler):
 						while not cfg_server_running:
 							try:
 								time.sleep(20)
-								role_hosts = self._queryenv.list_roles(behaviour=BEHAVIOUR)[0].hosts
+								role_hosts = self._queryenv.list_roles(behaviour=BEHAVIOUR, cached=False)[0].hosts
 								for host in role_hosts:
 									if host.shard_index == 0 and host.replica_set_index == 0:
 										cfg_server_running = True
@@ -599,7 +599,7 @@ class MongoDBHandler(ServiceCtlHandler):
 			self._logger.debug('Adding %s as %s to hosts file', message.local_ip, hostname)
 			Hosts.set(message.local_ip, hostname)
 
-			wait_until(lambda: self.mongodb.primary_host, timeout=180,
+			self.mongodb.rs_monitor.wait_until(lambda state: state.primary, timeout=180,
 				start_text='Wait for primary node in replica set', logger=self._logger)
 
 			is_master = self.mongodb.is_replication_master
@@ -614,8 +614,8 @@ class MongoDBHandler(ServiceCtlHandler):
 
 				watcher = StatusWatcher(hostname, self, message.local_ip)
 				self._logger.info('Starting bootstrap watcher for node ip=%s', message.local_ip)
-				watcher.start()
 				self._status_trackers[message.local_ip] = watcher
+				watcher.start()
 
 				
 	def create_shard(self):
@@ -759,7 +759,7 @@ class MongoDBHandler(ServiceCtlHandler):
 					""" Start arbiter if it's not running """
 					self.mongodb.arbiter.start()
 					""" Wait until we become master """
-					wait_until(lambda: self.mongodb.is_replication_master, timeout=180)
+					self.mongodb.rs_monitor.wait_until(lambda state: state.is_primary, timeout=180)
 				else:
 					raise Exception('Arbiter not found')
 			except:
@@ -769,18 +769,18 @@ class MongoDBHandler(ServiceCtlHandler):
 				rs_cfg['members'] = [m for m in rs_cfg['members'] if m['host'] == nodename]
 				self.mongodb.cli.rs_reconfig(rs_cfg, force=True)
 				try:
-					wait_until(lambda: self.mongodb.is_replication_master, timeout=30)
+					self.mongodb.rs_monitor.wait_until(lambda state: state.is_primary, timeout=30)
 				except:
 					""" Looks like mongo stuck in secondary state (syncingTo dead node)
 						Restart should fix this
 					"""
 					if "seconds reached" in str(sys.exc_info()[1]):
 						self.mongodb.mongod.restart(reason="Reconfiguring replica set")
-						wait_until(lambda: self.mongodb.is_replication_master, timeout=30)
+						self.mongodb.rs_monitor.wait_until(lambda state: state.is_primary, timeout=30)
 					else:
 						raise
 		else:
-			wait_until(lambda: self.mongodb.primary_host, timeout=180,
+			self.mongodb.rs_monitor.wait_until(lambda state: state.primary, timeout=180,
 					 start_text='Wait for primary node in replica set', logger=self._logger)
 
 
@@ -870,22 +870,19 @@ class MongoDBHandler(ServiceCtlHandler):
 				return
 
 			def node_terminated_or_deleted(node_name):
-				for node in self.mongodb.cli.get_rs_status()['members']:
-					if node['name'] == node_name:
-						if int(node['health']) == 0:
-							return True
-						else:
-							return False
-						break
-				else:
-					return True
+				def check(state):
+					if state.error:
+						return False
+					node = state.members.get(node_name)
+					return not node or int(node['health']) == 0
+				return check
 
 			self._logger.debug('Wait until node is down or removed from replica set')
-			wait_until(node_terminated_or_deleted,  args=(down_node_name,), logger=self._logger, timeout=180)
+			self.mongodb.rs_monitor.wait_until(node_terminated_or_deleted(down_node_name), timeout=180)
 
 			if down_possible_arbiter in self.mongodb.arbiters:
 				self._logger.debug('Wait until arbiter is down or removed from replica set')
-				wait_until(node_terminated_or_deleted, args=(down_possible_arbiter,), logger=self._logger, timeout=180)
+				self.mongodb.rs_monitor.wait_until(node_terminated_or_deleted(down_possible_arbiter), timeout=180)
 
 			self.on_HostDown(message)
 
@@ -1096,7 +1093,7 @@ class MongoDBHandler(ServiceCtlHandler):
 
 			rs_cfg['version'] += 10
 			self.mongodb.cli.rs_reconfig(rs_cfg, force=True)
-			wait_until(lambda: self.mongodb.is_replication_master, timeout=180)
+			self.mongodb.rs_monitor.wait_until(lambda state: state.is_primary, timeout=180)
 						
 		# Create snapshot
 		self.mongodb.cli.sync(lock=True)
@@ -1172,17 +1169,8 @@ class MongoDBHandler(ServiceCtlHandler):
 						If we're already primary or secondary - no need
 						to wait watcher result from primary """
 
-				try:
-					rs_status = self.mongodb.cli.get_rs_status()
-
-					for member in rs_status['members']:
-						if member['name'] == my_nodename:
-							status = member['state']
-							if status in (1,2):
-								initialized = True
-								break
-				except:
-					pass
+				if self.mongodb.rs_monitor.wait(lambda state: state.member_state(my_nodename) in (1, 2), timeout=1):
+					initialized = True
 
 				""" Check bootstrap result messages """
 
@@ -1204,8 +1192,6 @@ class MongoDBHandler(ServiceCtlHandler):
 					finally:
 						msg_store.mark_as_handled(msg.id)
 
-				time.sleep(1)
-
 			if initialized:
 				self._logger.info('Mongo successfully joined replica set')
 
@@ -1636,49 +1622,45 @@ class DrainingWatcher(threading.Thread):
 
 
 	
-class StatusWatcher(threading.Thread):
+class StatusWatcher(object):
+	'''
+	Reports new replica set member bootstrap result when it becomes
+	primary/secondary or stale. Driven by mongodb.rs_monitor transitions
+	'''
 	
 	def __init__(self, hostname, handler, local_ip):
 		"""
 		@type handler: MongoDBHandler
 		"""
-		super(StatusWatcher, self).__init__()
 		self.hostname = hostname
 		self.handler=handler
 		self.local_ip = local_ip
-		self._stop = threading.Event()
+		self.nodename = '%s:%s' % (self.hostname, mongo_svc.REPLICA_DEFAULT_PORT)
+		self.monitor = self.handler.mongodb.rs_monitor
+		
+	def start(self):
+		self.monitor.subscribe(self._on_transition)
 		
 	def stop(self):
-		self._stop.set()
+		self.monitor.unsubscribe(self._on_transition)
 		
-	def run(self):
-		nodename = '%s:%s' % (self.hostname, mongo_svc.REPLICA_DEFAULT_PORT)
-		initialized = stale = False
-		while not (initialized or stale or self._stop.is_set()):
-			rs_status = self.handler.mongodb.cli.get_rs_status()
-			
-			for member in rs_status['members']:
-				if not member['name'] == nodename:
-					continue
-				
-				status = member['state']
-				
-				if status in (1,2):
-					msg = {'status' : ReplicationState.INITIALIZED}
-					self.handler.send_int_message(self.local_ip, MongoDBMessages.INT_BOOTSTRAP_WATCHER_RESULT, msg)
-					initialized = True
-					break
-				
-				if status == 3:
-					if 'errmsg' in member and 'RS102' in member['errmsg']:
-						msg = {'status' : ReplicationState.STALE}
-						self.handler.send_int_message(self.local_ip, MongoDBMessages.INT_BOOTSTRAP_WATCHER_RESULT, msg)
-						stale = True
+	def _on_transition(self, old_state, state):
+		member = state.members.get(self.nodename)
+		if not member:
+			return
 			
-			time.sleep(3)
-						
-		self.handler._status_trackers.pop(self.local_ip)
-		
+		status = member['state']
+		if status in (1,2):
+			msg = {'status' : ReplicationState.INITIALIZED}
+		elif status == 3 and 'errmsg' in member and 'RS102' in member['errmsg']:
+			msg = {'status' : ReplicationState.STALE}
+		else:
+			return
+
+		self.stop()
+		self.handler.send_int_message(self.local_ip, MongoDBMessages.INT_BOOTSTRAP_WATCHER_RESULT, msg)
+		self.handler._status_trackers.pop(self.local_ip, None)
+
 
 
 class ClusterTerminateWatcher(threading.Thread):
@@ -1464,7 +1464,7 @@ class MysqlHandler(ServiceCtlHandler):
 					while not master_host:
 						try:
 							master_host = list(host 
-								for host in self._queryenv.list_roles(behaviour=BEHAVIOUR)[0].hosts 
+								for host in self._queryenv.list_roles(behaviour=BEHAVIOUR, cached=False)[0].hosts 
 								if host.replication_master)[0]
 						except IndexError:
 							LOG.debug("QueryEnv respond with no mysql master. " + 
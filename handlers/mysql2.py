@@ -11,8 +11,6 @@ import time
 import shutil
 import logging
 import glob
-import tarfile
-import tempfile
 
 # Core
 from scalarizr.bus import bus
@@ -23,14 +21,12 @@ from scalarizr.service import CnfController, _CnfManifest
 from scalarizr.services import ServiceError
 from scalarizr.platform import UserDataOptions
 from scalarizr.util import system2, disttool, firstmatched, initdv2, software, cryptotool, filetool
-from scalarizr.storage import transfer
 
 from scalarizr import storage2
 from scalarizr.linux import iptables	
 from scalarizr.services import backup
 from scalarizr.services import mysql2 as mysql2_svc  # backup/restore providers
 from scalarizr.node import __node__
-from scalarizr.services import make_backup_steps
 
 # Libs
 from scalarizr.libs.metaconf import Configuration, NoPathError
@@ -545,108 +541,32 @@ class MysqlHandler(DBMSRHandler):
 	def on_DbMsr_CreateBackup(self, message):
 		LOG.debug("on_DbMsr_CreateBackup")
 
-		'''
-		bak = backup.backup(
-				type='mysqldump', 
-				file_per_database=True,
-				tmpdir=__mysql__['tmp_dir'],
-				cloudfsdir=self._platform.scalrfs.backups(__mysql__['behavior']),
-				chunk_size=__mysql__['mysqldump_chunk_size'])
-		restore = None
-
 		try:
 			op = operation(name=self._op_backup, phases=[{
 				'name': self._phase_backup, 
-				'steps': [self._phase_backup]
+				'steps': [self._step_upload_to_cloud_storage]
 			}])
 			op.define()
-			with op.phase(self._phase_backup):
-				with op.step(self._phase_backup):
-					restore = bak.run()
-					
-					#- type: mysqldump
-					#- files:
-					#  - size: 1234567
-		            #  - path: s3://farm-2121-44/backups/mysql/20120314.tar.gz.part0
-					#  - size: 3524567
-		            #  - path: s3://farm-2121-44/backups/mysql/20120314.tar.gz.part1
-					#result = list(dict(path=path, size=size) for path, size in zip(cloud_files, sizes))								
-			op.ok(data=restore.files)
-	
-			# Notify Scalr
-			self.send_message(DbMsrMessages.DBMSR_CREATE_BACKUP_RESULT, dict(
-				db_type = __mysql__['behavior'],
-				status = 'ok',
-				backup_parts = restore.files
-			))
-		except:
-			exc = sys.exc_info()[1]
-			LOG.exception(exc)
-			
-			# Notify Scalr about error
-			self.send_message(DbMsrMessages.DBMSR_CREATE_BACKUP_RESULT, dict(
-				db_type = __mysql__['behavior'],
-				status = 'error',
-				last_error = str(exc)
-			))
-
-		'''
-
-
-		tmp_basedir = __mysql__['tmp_dir']
-		if not os.path.exists(tmp_basedir):
-			os.makedirs(tmp_basedir)		
-		# Retrieve password for scalr mysql user
-		backup_path = None
-		tmpdir = None
-		try:
-			# Get databases list
-			databases = self.root_client.list_databases()
-			
-			op = operation(name=self._op_backup, phases=[{
-				'name': self._phase_backup
-			}])
-			op.define()			
 
 			with op.phase(self._phase_backup):
-				# Dump all databases
-				LOG.info("Dumping all databases")
-				tmpdir = tempfile.mkdtemp(dir=tmp_basedir)
+				with op.step(self._step_upload_to_cloud_storage):
+					# Databases are dumped concurrently and streamed 
+					# through pigz right into cloud storage chunks
+					cloud_storage_path = self._platform.scalrfs.backups('mysql')
+					LOG.info("Dumping all databases to cloud storage (%s)", cloud_storage_path)
+					bak = backup.backup(
+							type='mysqldump',
+							file_per_database=True,
+							cloudfs_dir=cloud_storage_path,
+							chunk_size=__mysql__['mysqldump_chunk_size'],
+							parallelism=__mysql__['mysqldump_parallelism'])
+					restore = bak.run()
 
-				backup_filename = 'mysql-backup-%s.tar.gz' % time.strftime('%Y-%m-%d-%H:%M:%S') 
-				backup_path = os.path.join(tmpdir, backup_filename)
-				
-				# Creating archive 
-				backup = tarfile.open(backup_path, 'w:gz')
-				mysqldump = mysql_svc.MySQLDump(root_user=__mysql__['root_user'],
-									root_password=__mysql__['root_password'])
-				dump_options = __mysql__['mysqldump_options'].split(' ')
-
-				def _single_backup(db_name):
-					dump_path = os.path.join(tmpdir, db_name + '.sql') 
-					mysqldump.create(db_name, dump_path, dump_options)
-					backup.add(dump_path, os.path.basename(dump_path))
-
-				make_backup_steps(databases, op, _single_backup)
-						
-				backup.close()
-				
-			with op.step(self._step_upload_to_cloud_storage):
-				# Creating list of full paths to archive chunks
-				if os.path.getsize(backup_path) > __mysql__['mysqldump_chunk_size']:
-					parts = [os.path.join(tmpdir, file) for file in filetool.split(backup_path, backup_filename, __mysql__['mysqldump_chunk_size'] , tmpdir)]
-				else:
-					parts = [backup_path]
-				sizes = [os.path.getsize(file) for file in parts]
-						
-				cloud_storage_path = self._platform.scalrfs.backups('mysql')
-				LOG.info("Uploading backup to cloud storage (%s)", cloud_storage_path)
-				trn = transfer.Transfer()
-				cloud_files = trn.upload(parts, cloud_storage_path)
-				LOG.info("Mysql backup uploaded to cloud storage under %s/%s", 
-								cloud_storage_path, backup_filename)
-
-			result = list(dict(path=path, size=size) for path, size in zip(cloud_files, sizes))								
+					#- size: 1234567
+					#  path: s3://farm-2121-44/backups/mysql/dbname/<transfer_id>/dbname.sql.gz.000
+					#- size: 3524567
+					#  path: s3://farm-2121-44/backups/mysql/dbname/<transfer_id>/dbname.sql.gz.001
+					result = restore.files
 			op.ok(data=result)
 			
 			# Notify Scalr
@@ -665,12 +585,6 @@ class MysqlHandler(DBMSRHandler):
 				status = 'error',
 				last_error = str(e)
 			))
-			
-		finally:
-			if tmpdir:
-				shutil.rmtree(tmpdir, ignore_errors=True)
-			if backup_path and os.path.exists(backup_path):
-				os.remove(backup_path)	
 
 
 	def on_DbMsr_CreateDataBundle(self, message):
@@ -1241,7 +1155,7 @@ class MysqlHandler(DBMSRHandler):
 		while not master_host:
 			try:
 				master_host = list(host 
-					for host in self._queryenv.list_roles(behaviour=__mysql__['behavior'])[0].hosts 
+					for host in self._queryenv.list_roles(behaviour=__mysql__['behavior'], cached=False)[0].hosts 
 					if host.replication_master)[0]
 			except IndexError:
 				LOG.debug("QueryEnv respond with no mysql master. " + 
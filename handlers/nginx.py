@@ -24,6 +24,7 @@ from scalarizr.util.filetool import read_file, write_file
 
 # Stdlibs
 import os, logging, shutil, re, time
+import threading
 from telnetlib import Telnet
 from datetime import datetime
 import ConfigParser
@@ -179,6 +180,68 @@ class NginxCnfController(CnfController):
 		return software.software_info('nginx').version
 
 		
+class UpstreamReconciler(object):
+	'''
+	Coalesces upstream reload requests. Reload happens DELAY seconds after 
+	the last request, but not later than MAX_DELAY seconds after the first one 
+	'''
+	
+	DELAY = 2
+	MAX_DELAY = 15
+	
+	def __init__(self, reload_fn):
+		self._reload_fn = reload_fn
+		self._logger = logging.getLogger(__name__)
+		self._cond = threading.Condition(threading.Lock())
+		self._thread = None
+		self._first = self._last = None
+		self._force = False
+		self.stats = dict(requests=0, reloads=0, coalesced=0)
+	
+	def request(self, force=False):
+		self._cond.acquire()
+		try:
+			self.stats['requests'] += 1
+			now = time.time()
+			if self._first is None:
+				self._first = now
+			else:
+				self.stats['coalesced'] += 1
+			self._last = now
+			self._force = self._force or force
+			if not self._thread or not self._thread.isAlive():
+				self._thread = threading.Thread(target=self._run, name='NginxUpstreamReconciler')
+				self._thread.setDaemon(True)
+				self._thread.start()
+			self._cond.notify()
+		finally:
+			self._cond.release()
+	
+	def _run(self):
+		while True:
+			self._cond.acquire()
+			try:
+				while True:
+					if self._first is not None:
+						timeout = min(self._last + self.DELAY, self._first + self.MAX_DELAY) - time.time()
+						if timeout <= 0:
+							break
+					else:
+						timeout = None
+					self._cond.wait(timeout)
+				force = self._force
+				self._first = self._last = None
+				self._force = False
+				self.stats['reloads'] += 1
+			finally:
+				self._cond.release()
+			
+			try:
+				self._reload_fn(force)
+			except (BaseException, Exception), e:
+				self._logger.exception('Failed to reload nginx upstream: %s', e)
+
+		
 class NginxHandler(ServiceCtlHandler):
 	
 	backends_xpath = "upstream[@value='backend']/server"
@@ -188,6 +251,11 @@ class NginxHandler(ServiceCtlHandler):
 		ServiceCtlHandler.__init__(self, BEHAVIOUR, initdv2.lookup('nginx'), NginxCnfController())
 				
 		self._logger = logging.getLogger(__name__)
+		# Guards nginx.conf, upstream include and their .save/.tmp copies.
+		# Reentrant: _reload_upstream calls _update_main_config
+		self._config_lock = threading.RLock()
+		self._reconciler = UpstreamReconciler(self._reload_upstream_locked)
+		self.upstream_stats = dict(unchanged=0, written=0)
 		
 		bus.define_events("nginx_upstream_reload")
 		bus.on(init=self.on_init, reload=self.on_reload)
@@ -238,17 +306,19 @@ class NginxHandler(ServiceCtlHandler):
 
 	def on_start(self): 
 		if self._cnf.state == ScalarizrState.RUNNING:
-			self._update_vhosts()
-			self._reload_upstream()						
+			with self._config_lock:
+				self._update_vhosts()
+				self._reload_upstream()
 		
 	def on_before_host_up(self, message):
 		with bus.initialization_op as op:
 			with op.phase(self._phase):
 				with op.step(self._step_update_vhosts):
-					self._update_vhosts()
+					with self._config_lock:
+						self._update_vhosts()
 
 				with op.step(self._step_reload_upstream):
-					self._reload_upstream()
+					self._reload_upstream_locked()
 
 				bus.fire('service_configured', service_name=SERVICE_NAME)
 		
@@ -256,11 +326,11 @@ class NginxHandler(ServiceCtlHandler):
 		self._insert_iptables_rules()
 	
 	def on_HostUp(self, message):
-		self._reload_upstream()
+		self._reconciler.request()
 	
 	
 	def on_HostDown(self, message):
-		self._reload_upstream()
+		self._reconciler.request()
 
 
 	def on_BeforeHostTerminate(self, message):
@@ -268,25 +338,27 @@ class NginxHandler(ServiceCtlHandler):
 			self._logger.debug('File %s not exists. Nothing to do', self._app_inc_path)
 			return
 
-		include = Configuration('nginx')	
-		include.read(self._app_inc_path)
-		
-		server_ip = '%s:%s' % (message.local_ip or message.remote_ip, self._app_port)
-		backends = include.get_list(self.backends_xpath)
-		if server_ip in backends:
-			include.remove(self.backends_xpath, server_ip)
-			# Add 127.0.0.1 If it was the last backend
-			if len(backends) == 1:
-				include.add(self.backends_xpath, self.localhost)
+		with self._config_lock:
+			include = Configuration('nginx')	
+			include.read(self._app_inc_path)
+			
+			server_ip = '%s:%s' % (message.local_ip or message.remote_ip, self._app_port)
+			backends = include.get_list(self.backends_xpath)
+			if server_ip in backends:
+				include.remove(self.backends_xpath, server_ip)
+				# Add 127.0.0.1 If it was the last backend
+				if len(backends) == 1:
+					include.add(self.backends_xpath, self.localhost)
 
-		include.write(self._app_inc_path)
-		self._reload_service('%s is to be terminated' % server_ip)
+			include.write(self._app_inc_path)
+			self._reload_service('%s is to be terminated' % server_ip)
 
 
 	def on_VhostReconfigure(self, message):
 		self._logger.info("Received virtual hosts update notification. Reloading virtual hosts configuration")
-		self._update_vhosts()
-		self._reload_upstream(True)
+		with self._config_lock:
+			self._update_vhosts()
+		self._reconciler.request(force=True)
 
 
 	def _test_config(self):
@@ -372,6 +444,11 @@ class NginxHandler(ServiceCtlHandler):
 			self._config.write(nginx_conf_path)		
 	
 	
+	def _reload_upstream_locked(self, force_reload=False):
+		with self._config_lock:
+			self._reload_upstream(force_reload)
+
+
 	def _reload_upstream(self, force_reload=False):
 
 		backend_include = Configuration('nginx')
@@ -399,17 +476,18 @@ class NginxHandler(ServiceCtlHandler):
 			for host in role.hosts:
 				servers.append('%s:%s' % (host.internal_ip or host.external_ip, 2222))
 
+		servers = set(servers)
 		for entry in backend_include.get_list(self.backends_xpath):
-			for server in servers:
-				if entry.startswith(server):
-					self._logger.debug("Server %s already in upstream list" % server)
-					servers.remove(server)
-					break
+			# Entry may have parameters: '10.0.0.1:80 weight=2'
+			server = entry.split()[0] if entry.strip() else entry
+			if server in servers:
+				self._logger.debug("Server %s already in upstream list" % server)
+				servers.discard(server)
 			else:
 				self._logger.debug("Removing old entry %s from upstream list" % entry) 
 				backend_include.remove(self.backends_xpath, entry)
 		
-		for server in servers:
+		for server in sorted(servers):
 			self._logger.debug("Adding new server %s to upstream list" % server)
 			backend_include.add(self.backends_xpath, server)
 			
@@ -433,30 +511,35 @@ class NginxHandler(ServiceCtlHandler):
 				pass
 
 		
-		old_include = None
+		new_data = self._dump_config(backend_include)
+		old_data = None
 		if os.path.isfile(self._app_inc_path):
 			self._logger.debug("Reading old configuration from %s" % self._app_inc_path)
-			old_include = Configuration('nginx')
-			old_include.read(self._app_inc_path)
+			old_data = read_file(self._app_inc_path, logger=self._logger)
 			
-		if old_include \
-				and not force_reload \
-				and	backend_include.get_list(self.backends_xpath) == old_include.get_list(self.backends_xpath) :
+		if old_data == new_data and not force_reload:
+			self.upstream_stats['unchanged'] += 1
 			self._logger.debug("nginx upstream configuration unchanged")
 		else:
+			self.upstream_stats['written'] += 1
 			self._logger.debug("nginx upstream configuration was changed")
 			
-			if os.access(self._app_inc_path, os.F_OK):
+			if old_data is not None:
 				self._logger.debug('Backup file %s as %s', self._app_inc_path, self._app_inc_path + '.save')				
-				shutil.move(self._app_inc_path, self._app_inc_path+".save")
+				shutil.copy(self._app_inc_path, self._app_inc_path + '.save')
 				
+			# Replace file atomically, so nginx never reads a partially written one
 			self._logger.debug('Write new %s', self._app_inc_path)
-			backend_include.write(self._app_inc_path)
+			tmp_path = self._app_inc_path + '.tmp'
+			write_file(tmp_path, new_data, logger=self._logger)
+			os.rename(tmp_path, self._app_inc_path)
 			
 			self._update_main_config()
 			
 			self._test_config()
 
+		self._logger.debug('Upstream reloads avoided: %d coalesced, %d unchanged', 
+				self._reconciler.stats['coalesced'], self.upstream_stats['unchanged'])
 		bus.fire("nginx_upstream_reload")	
 
 	
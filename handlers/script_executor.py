@@ -29,6 +29,11 @@ import signal
 import logging
 import binascii
 import Queue
+import collections
+import itertools
+import hashlib
+import glob
+import re
 
 
 def get_handlers ():
@@ -46,6 +51,15 @@ exec_dir_prefix = '/usr/local/bin/scalr-scripting.'
 logs_dir = '/var/log/scalarizr/scripting'
 logs_truncate_over = 20 * 1000
 
+# Queued scripts are written to disk when they start, 
+# so scripts created at the same time should not share exec dir
+_script_seq = itertools.count()
+
+staged_ttl = 7 * 24 * 3600
+"""
+@var Seconds to keep staged script that wasn't executed
+"""
+
 
 def get_truncated_log(logfile, maxsize=None):
 	maxsize = maxsize or logs_truncate_over
@@ -108,14 +122,16 @@ class ScriptExecutor2(Handler):
 		except ConfigParser.Error:
 			pass
 		
-		self.log_rotate_thread = threading.Thread(name='ScriptingLogRotate', 
-									target=LogRotateRunnable())
-		self.log_rotate_thread.setDaemon(True)
+		# max_concurrency
+		try:
+			reactor.max_concurrency = int(ini.get(self.name, 'max_concurrency'))
+		except ConfigParser.Error:
+			pass
 
 	
 	def on_start(self):
-		# Start log rotation
-		self.log_rotate_thread.start()
+		# Start supervision and log rotation
+		reactor.start()
 		
 		# Restore in-progress scripts
 		LOG.debug('STATE[script_executor.in_progress]: %s', szrconfig.STATE['script_executor.in_progress'])
@@ -124,30 +140,37 @@ class ScriptExecutor2(Handler):
 		
 		for sc in scripts:
 			self._execute_one_script(sc)
+			
+		# Resubmit scripts that were queued but not started
+		queued = szrconfig.STATE['script_executor.queued'] or []
+		LOG.debug('Resubmitting %d queued scripts', len(queued))
+		for kwds in queued:
+			try:
+				reactor.submit(Script(**kwds), self._send_result)
+			except (BaseException, Exception), e:
+				LOG.error("Cannot resubmit queued script '%s': %s", kwds.get('name'), e)
+		szrconfig.STATE['script_executor.queued'] = []
 		
 	
 	def on_shutdown(self):
 		# save state
-		LOG.debug('Saving Work In Progress (%d items)', len(self.in_progress))
+		self.in_progress, queued = reactor.snapshot()
+		LOG.debug('Saving Work In Progress (%d items, %d queued)', 
+				len(self.in_progress), len(queued))
 		szrconfig.STATE['script_executor.in_progress'] = [sc.state() for sc in self.in_progress]
+		szrconfig.STATE['script_executor.queued'] = [sc.definition() for sc in queued]
 
 
 	def _execute_one_script(self, script):
 		if script.asynchronous:
-			threading.Thread(target=self._execute_one_script0, 
-							args=(script, )).start()
+			reactor.submit(script, self._send_result)
 		else:
-			self._execute_one_script0(script)
+			self._send_result(script, reactor.execute(script))
 
 	
-	def _execute_one_script0(self, script):
-		try:
-			self.in_progress.append(script)
-			if not script.start_time:
-				script.start()
-			self.send_message(Messages.EXEC_SCRIPT_RESULT, script.wait(), queue=Queues.LOG)
-		finally:
-			self.in_progress.remove(script)
+	def _send_result(self, script, result):
+		if result:
+			self.send_message(Messages.EXEC_SCRIPT_RESULT, result, queue=Queues.LOG)
 			
 	
 	def execute_scripts(self, scripts):
@@ -261,7 +284,7 @@ class Script(object):
 		assert self.exec_timeout, '`exec_timeout` required'
 		
 		if self.name and self.body:
-			self.id = str(time.time())
+			self.id = '%s.%d' % (time.time(), _script_seq.next())
 			interpreter = read_shebang(script=self.body)
 			if not interpreter:
 				raise HandlerError("Can't execute script '%s' cause it hasn't shebang.\n"
@@ -275,7 +298,13 @@ class Script(object):
 			assert self.start_time, '`start_time` required'
 
 		self.logger = logging.getLogger('%s.%s' % (__name__, self.id))
-		self.exec_path = os.path.join(exec_dir_prefix + self.id, self.name)
+		if self.body:
+			# Scripts are staged once per body and reused across events
+			body_hash = hashlib.sha1(self.body.encode('utf-8')).hexdigest()
+			self.exec_path = os.path.join(exec_dir_prefix + body_hash, self.name)
+		elif not self.exec_path:
+			# Restored from the state of previous version
+			self.exec_path = os.path.join(exec_dir_prefix + self.id, self.name)
 		args = (self.name, self.event_name, self.role_name, self.id)
 		self.stdout_path = os.path.join(logs_dir, '%s.%s.%s.%s-out.log' % args)
 		self.stderr_path = os.path.join(logs_dir, '%s.%s.%s.%s-err.log' % args)
@@ -291,12 +320,7 @@ class Script(object):
 
 
 		# Write script to disk, prepare execution
-		exec_dir = os.path.dirname(self.exec_path)
-		if not os.path.exists(exec_dir):
-			os.makedirs(exec_dir)
-
-		write_file(self.exec_path, self.body.encode('utf-8'), logger=LOG)
-		os.chmod(self.exec_path, stat.S_IREAD | stat.S_IEXEC)
+		self._stage()
 
 		stdout = open(self.stdout_path, 'w+')
 		stderr = open(self.stderr_path, 'w+')
@@ -315,24 +339,50 @@ class Script(object):
 		self.start_time = time.time()		
 
 	
-	def wait(self):
+	def _stage(self):
+		body = self.body.encode('utf-8')
+		exec_dir = os.path.dirname(self.exec_path)
+		if os.path.isfile(self.exec_path) and os.access(self.exec_path, os.X_OK) \
+				and os.path.getsize(self.exec_path) == len(body):
+			self.logger.debug('Using staged %s', self.exec_path)
+			# Mark as recently used
+			os.utime(exec_dir, None)
+			return
+
+		if not os.path.exists(exec_dir):
+			os.makedirs(exec_dir)
+		# Same script can be started concurrently, and the staged one may be running.
+		# Write a copy and atomically replace.
+		tmp_path = '%s.%s' % (self.exec_path, self.id)
+		write_file(tmp_path, body, logger=LOG)
+		os.chmod(tmp_path, stat.S_IREAD | stat.S_IEXEC)
+		os.rename(tmp_path, self.exec_path)
+
+	
+	def poll(self):
+		'''
+		Kills process when exec_timeout is over
+		@return: Return code when process terminated or killed, None when it's still running
+		'''
+		if self._proc_poll() is not None:
+			self.logger.debug('Process terminated')
+			self.return_code = self._proc_complete()
+		elif time.time() >= self.deadline:
+			self.return_code = self._proc_kill()
+		return self.return_code
+	
+	
+	@property
+	def deadline(self):
+		return self.start_time + self.exec_timeout
+
+	
+	def finish(self):
+		'''
+		Cleanups execution directory
+		@return: ExecScriptResult message body
+		'''
 		try:
-			# Communicate with process
-			self.logger.debug('Communicating with %s (pid: %s)', self.interpreter, self.pid)
-			while time.time() - self.start_time < self.exec_timeout:
-				if self._proc_poll() is None:
-					time.sleep(0.5)
-				else:
-					# Process terminated
-					self.logger.debug('Process terminated')
-					self.return_code = self._proc_complete()
-					break
-			else:
-				# Process timeouted
-				self.logger.debug('Timeouted: %s seconds. Killing process %s (pid: %s)', 
-									self.exec_timeout, self.interpreter, self.pid)
-				self.return_code = self._proc_kill()
-		
 			elapsed_time = time.time() - self.start_time
 			self.logger.debug('Finished %s' 
 					'\n  %s' 
@@ -366,10 +416,26 @@ class Script(object):
 
 		finally:
 			f = os.path.dirname(self.exec_path)
-			if os.path.exists(f):
+			if f == exec_dir_prefix + self.id and os.path.exists(f):
+				# Not staged: started by previous version
 				shutil.rmtree(f) 
 
 	
+	def definition(self):
+		'''
+		@return: Keyword arguments to recreate script that wasn't started yet
+		'''
+		return {
+			'name': self.name,
+			'body': self.body,
+			'asynchronous': self.asynchronous,
+			'exec_timeout': self.exec_timeout,
+			'event_name': self.event_name,
+			'role_name': self.role_name,
+			'event_server_id': self.event_server_id
+		}
+	
+	
 	def state(self):
 		return {
 			'id': self.id,
@@ -380,7 +446,8 @@ class Script(object):
 			'asynchronous': self.asynchronous,
 			'event_name': self.event_name,
 		    'role_name' : self.role_name,
-			'exec_timeout': self.exec_timeout
+			'exec_timeout': self.exec_timeout,
+			'exec_path': self.exec_path
 		}
 	
 	def _proc_poll(self):
@@ -413,14 +480,179 @@ class Script(object):
 			return 0
 	
 
-class LogRotateRunnable(object):
-	def __call__(self):
+class ScriptReactor(object):
+	'''
+	Supervises all script processes from a single thread.
+	Asynchronous scripts are queued while `max_concurrency` of them are running,
+	synchronous ones start right away and don't count against the limit. Each process is killed exactly at its deadline, 
+	and its result is delivered as soon as it exits.
+	Scripting logs are rotated from the same thread.
+	'''
+	
+	poll_interval = 0.2
+	'''
+	Child processes are polled rather than waited by SIGCHLD: 
+	signal handlers run in the main thread only and reaping any child 
+	would race with subprocess calls all over scalarizr
+	'''
+	
+	log_rotate_interval = 3600
+	logs_keep = 100
+	
+	_staged_re = re.compile(r'^[0-9a-f]{40}$')
+	
+	max_concurrency = 10
+	'''
+	Maximum number of asynchronous scripts running at the same time
+	'''
+	
+	def __init__(self, max_concurrency=None):
+		if max_concurrency:
+			self.max_concurrency = max_concurrency
+		self._cond = threading.Condition()
+		self._queue = collections.deque()
+		self._running = {}
+		self._thread = None
+		self._next_rotate = 0
+
+
+	def start(self):
+		with self._cond:
+			if not self._thread:
+				self._thread = threading.Thread(name='ScriptReactor', target=self._loop)
+				self._thread.setDaemon(True)
+				self._thread.start()
+
+
+	def submit(self, script, callback):
+		'''
+		Queue script for execution.
+		@param callback: callback(script, result) is called in reactor thread 
+		with ExecScriptResult message body (or None on failure)
+		'''
+		self.start()
+		with self._cond:
+			self._queue.append((script, callback))
+			self._cond.notify()
+
+
+	def execute(self, script):
+		'''
+		Start script without queueing and wait for its termination
+		@return: ExecScriptResult message body
+		'''
+		if not script.start_time:
+			script.start()
+		done = threading.Event()
+		ret = []
+		def callback(script, result):
+			ret.append(result)
+			done.set()
+		self._watch(script, callback)
+		done.wait()
+		return ret[0]
+
+
+	def running(self):
+		with self._cond:
+			return self._running.keys()
+
+
+	def snapshot(self):
+		'''
+		@return: (running scripts, queued scripts) taken at the same moment
+		'''
+		with self._cond:
+			return self._running.keys(), [script for script, _ in self._queue]
+
+
+	def pending(self):
+		with self._cond:
+			return len(self._queue)
+
+
+	def _watch(self, script, callback):
+		self.start()
+		with self._cond:
+			self._running[script] = callback
+			self._cond.notify()
+
+
+	def _loop(self):
 		while True:
+			finished = []
+			with self._cond:
+				while self._queue and self._num_async() < self.max_concurrency:
+					script, callback = self._queue.popleft()
+					try:
+						if not script.start_time:
+							script.start()
+					except:
+						script.logger.exception('Cannot start script %s', script.name)
+						continue
+					self._running[script] = callback
+				
+				for script in self._running.keys():
+					try:
+						done = script.poll() is not None
+					except:
+						script.logger.exception('Cannot poll script %s process', script.name)
+						done = True
+					if done:
+						finished.append((script, self._running.pop(script)))
+						
+				if not finished:
+					self._cond.wait(self._timeout())
+					
+			for script, callback in finished:
+				try:
+					callback(script, script.finish())
+				except:
+					LOG.exception('Caught exception in script %s result callback', script.name)
+					
+			if time.time() >= self._next_rotate:
+				self._rotate_logs()
+				self._prune_staged()
+				self._next_rotate = time.time() + self.log_rotate_interval
+
+
+	def _num_async(self):
+		return len([script for script in self._running if script.asynchronous])
+
+
+	def _timeout(self):
+		timeout = self._next_rotate - time.time()
+		if self._running:
+			timeout = min(timeout, self.poll_interval, 
+						min(script.deadline for script in self._running) - time.time())
+		return max(timeout, 0)
+	
+	
+	def _rotate_logs(self):
+		try:
 			files = os.listdir(logs_dir)
 			files.sort()
-			for file in files[0:-100]:
+			for file in files[0:-self.logs_keep]:
 				os.remove(os.path.join(logs_dir, file))
-			time.sleep(3600)
+		except OSError, e:
+			LOG.warn('Failed to rotate scripting logs: %s', e)
+
+
+	def _prune_staged(self):
+		in_use = set(os.path.dirname(script.exec_path) for script in self.running())
+		expire_time = time.time() - staged_ttl
+		for path in glob.glob(exec_dir_prefix + '*'):
+			if not self._staged_re.match(path[len(exec_dir_prefix):]) or path in in_use:
+				continue
+			try:
+				if os.stat(path).st_mtime < expire_time:
+					LOG.debug('Removing staged scripts %s', path)
+					shutil.rmtree(path)
+			except OSError, e:
+				LOG.warn('Failed to remove staged scripts %s: %s', path, e)
+
+
+reactor = ScriptReactor()
 
 '''
 class ScriptExecutor(Handler):
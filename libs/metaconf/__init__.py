@@ -12,6 +12,8 @@ Primary goal: support Ini, Xml, Yaml, ProtocolBuffers, Nginx, Apache2
 import sys
 import re
 import os
+import time
+import threading
 
 from utils import quote, unquote, indent, strip_quotes
 
@@ -46,6 +48,93 @@ class NoPathError(MetaconfError):
 	pass
 
 
+_providers = {}
+
+def _provider_class(format):
+	if format not in _providers:
+		pvd_name = '%sFormatProvider' % format.capitalize()
+		pvd_module = __import__('providers.%s_pvd' % format, globals(), locals(), [pvd_name], -1)
+		_providers[format] = getattr(pvd_module, pvd_name)
+	return _providers[format]
+
+
+def _copy_tree(node):
+	copy = node.makeelement(node.tag, node.attrib.copy())
+	copy.text = node.text
+	copy.tail = node.tail
+	for child in node:
+		copy.append(_copy_tree(child))
+	return copy
+
+
+class _ParseCache:
+	'''
+	Provider output for configuration files, keyed by path and format.
+	Entry is valid while file mtime, size and inode are the same.
+	Callers always get their own copy of the nodes, so cached ones are never modified
+	'''
+	
+	MAX_ENTRIES = 64
+	
+	RACY_INTERVAL = 1
+	'''
+	Files modified less than RACY_INTERVAL seconds before parsing are not cached:
+	another write in the same mtime tick with the same size would go unnoticed
+	'''
+
+	def __init__(self):
+		self._entries = {}
+		self._lock = threading.Lock()
+		self._tick = 0
+		self.hits = 0
+		self.misses = 0
+	
+	def _signature(self, st):
+		return (st.st_mtime, st.st_size, st.st_ino)
+	
+	def get(self, path, format, st):
+		self._lock.acquire()
+		try:
+			entry = self._entries.get((path, format))
+			if entry and entry[0] == self._signature(st):
+				self._tick += 1
+				entry[2] = self._tick
+				self.hits += 1
+				nodes = entry[1]
+			else:
+				self.misses += 1
+				return None
+		finally:
+			self._lock.release()
+		return [_copy_tree(node) for node in nodes]
+	
+	def put(self, path, format, st, nodes):
+		if time.time() - st.st_mtime < self.RACY_INTERVAL:
+			return
+		nodes = [_copy_tree(node) for node in nodes]
+		self._lock.acquire()
+		try:
+			if len(self._entries) >= self.MAX_ENTRIES:
+				lru = min(self._entries, key=lambda key: self._entries[key][2])
+				del self._entries[lru]
+			self._tick += 1
+			self._entries[(path, format)] = [self._signature(st), nodes, self._tick]
+		finally:
+			self._lock.release()
+	
+	def invalidate(self, path):
+		self._lock.acquire()
+		try:
+			for key in self._entries.keys():
+				if key[0] == path:
+					del self._entries[key]
+		finally:
+			self._lock.release()
+		
+
+parse_cache = _ParseCache()
+
+
 class Configuration:
 	etree = None
 	"""
@@ -70,9 +159,7 @@ class Configuration:
 			raise MetaconfError("etree param must be instance of ElementTree. %s passed" % (etree,))
 		
 		try:
-			pvd_name = '%sFormatProvider' % format.capitalize()
-			pvd_module = __import__('providers.%s_pvd' % format, globals(), locals(), [pvd_name], -1)
-			self._provider = getattr(pvd_module, pvd_name)()
+			self._provider = _provider_class(format)()
 		except:
 			raise MetaconfError('Unknown or broken format provider: %s' % format)
 		#if not format_providers.has_key(format):
@@ -119,23 +206,24 @@ class Configuration:
 
 	
 	def _read0(self, file):
-		fp = open(file)
-		self.readfp(fp)
-
+		path = os.path.abspath(file)
+		st = os.stat(path)
+		self._init()
+		nodes = parse_cache.get(path, self._format, st)
+		if nodes is None:
+			fp = open(path)
+			try:
+				nodes = self._provider.read(fp)
+			finally:
+				fp.close()
+			parse_cache.put(path, self._format, st, nodes)
+		self._append(nodes)
 
 		
 	def readfp(self, fp):
 		try:
 			self._init()
-			nodes = self._provider.read(fp)
-			if self._config_count > 0:
-				for node in nodes:
-					self._extend(node)			
-			else:
-				root = self.etree.getroot()
-				for node in nodes:
-					root.append(node)
-			self._config_count += 1
+			self._append(self._provider.read(fp))
 		finally:
 			fp.close()
 		"""
@@ -143,6 +231,16 @@ class Configuration:
 		for child in :
 			self.etree.getroot().append(child)
 		"""
+	
+	def _append(self, nodes):
+		if self._config_count > 0:
+			for node in nodes:
+				self._extend(node)			
+		else:
+			root = self.etree.getroot()
+			for node in nodes:
+				root.append(node)
+		self._config_count += 1
 			
 	def write_fp(self, fp, close = True):
 		"""
@@ -154,17 +252,33 @@ class Configuration:
 		self._provider.write(fp, self.etree, close)
 		
 	def write(self, file_path):
+		"""
+		Writes configuration to file_path.
+		File is not touched when it already has the same content.
+		@return: True if file was written
+		"""
 		if not self.etree or self.etree.getroot() == None:
 			raise MetaconfError("Nothing to write! Create the tree first (readfp or read)")
 		
 		tmp_str = StringIO()
+		self._provider.write(tmp_str, self.etree, close = False)
+		content = tmp_str.getvalue()
+		
+		if os.path.isfile(file_path) and os.path.getsize(file_path) == len(content):
+			fp = open(file_path)
+			try:
+				if fp.read() == content:
+					return False
+			finally:
+				fp.close()
+
+		fp = open(file_path, 'w')
 		try:
-			self._provider.write(tmp_str, self.etree, close = False)
-			fp = open(file_path, 'w')
-			fp.write(tmp_str.getvalue())
+			fp.write(content)
+		finally:
 			fp.close()
-		except:
-			raise
+		parse_cache.invalidate(os.path.abspath(file_path))
+		return True
 	
 	def extend(self, conf):
 		"""
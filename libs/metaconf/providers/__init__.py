@@ -3,12 +3,28 @@ from ..utils import quote, unquote, indent
 
 import sys
 import os
+import re
 
 if sys.version_info[0:2] >= (2, 7):
 	from xml.etree import ElementTree as ET 
 else:
 	from scalarizr.externals.etree import ElementTree as ET
 	
+
+_compiled = {}
+
+def compiled(pattern, flags=0):
+	'''
+	Compiled regex shared by all providers.
+	Subclasses override pattern strings (_opt_re_string and co),
+	so regexes are cached by pattern rather than stored on a class
+	'''
+	try:
+		return _compiled[(pattern, flags)]
+	except KeyError:
+		regex = _compiled[(pattern, flags)] = re.compile(pattern, flags)
+		return regex
+
 	
 class FormatProvider:
 	_readers = None
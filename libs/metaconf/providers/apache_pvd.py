@@ -21,6 +21,12 @@ try:
 except ImportError:
 	from StringIO import StringIO
 
+
+OPT_RE = re.compile(r'\s*(?P<option>[^<].*?)\s+(?P<value>.*?)\s*?(?P<backslash>\\?)$')
+SECT_RE = re.compile('\s*<(?P<option>[^\s]+)\s*(?P<value>.*?)\s*>\s*$')
+BODY_RE = re.compile('.*?>\s*\n(.*)<.*?>', re.S)
+
+
 class ApacheFormatProvider(IniFormatProvider):
 	
 	_readers = None
@@ -47,9 +53,7 @@ class ApacheFormatProvider(IniFormatProvider):
 		self._pad = '	'
 		
 	def read_option(self, line, root):
-		if not hasattr(self, "_opt_re"):
-			self._opt_re = re.compile(r'\s*(?P<option>[^<].*?)\s+(?P<value>.*?)\s*?(?P<backslash>\\?)$')
-		result = self._opt_re.match(line)
+		result = OPT_RE.match(line)
 		if result:
 			new_opt = ET.SubElement(self._cursect, quote(result.group('option').strip()))
 			new_opt.attrib['mc_type'] = 'option'
@@ -85,10 +89,7 @@ class ApacheFormatProvider(IniFormatProvider):
 		return False
 	
 	def read_section(self, line, root):
-		if not hasattr(self, "_sect_re"):
-			self._sect_re = re.compile('\s*<(?P<option>[^\s]+)\s*(?P<value>.*?)\s*>\s*$')
-			
-		result = self._sect_re.match(line)
+		result = SECT_RE.match(line)
 		if result:
 			tag = result.group('option').strip()
 			new_section = ET.SubElement(self._cursect, quote(tag))
@@ -114,7 +115,7 @@ class ApacheFormatProvider(IniFormatProvider):
 			self._sections.append(self._cursect)
 			self._cursect = new_section
 			old_fp = self._fp
-			content = re.search(re.compile('.*?>\s*\n(.*)<.*?>',re.S), line).group(1).strip()
+			content = BODY_RE.search(line).group(1).strip()
 			self.read(StringIO(content), self._lineno)
 			self._fp = old_fp
 			self._cursect = self._sections.pop()
@@ -1,6 +1,6 @@
 __author__ = 'Nicholas Demyanchuk'
 
-from . import FormatProvider
+from . import FormatProvider, compiled
 from .ini_pvd import IniFormatProvider
 from .. import MetaconfError
 from ..utils import quote, unquote
@@ -45,10 +45,7 @@ class HaproxyFormatProvider(IniFormatProvider):
 
 
 	def read_section(self, line, root):
-		if not hasattr(self, '_section_re'):
-			self._section_re = re.compile(self._section_re_string)
-
-		res = re.match(self._section_re, line)
+		res = compiled(self._section_re_string).match(line)
 		if res:
 			if res.group('comment'):
 				comment = ET.Comment(res.group('comment')[1:])
@@ -84,10 +81,7 @@ class HaproxyFormatProvider(IniFormatProvider):
 
 
 	def read_option(self, line, root):
-		if not hasattr(self, '_option_re'):
-			self._option_re = re.compile(self._opt_re_string)
-
-		res = re.match(self._option_re, line)
+		res = compiled(self._opt_re_string).match(line)
 
 		if res:
 			if res.group('comment'):
@@ -3,7 +3,7 @@ Created on Feb 7, 2011
 
 @author: spike
 ''' 
-from . import FormatProvider
+from . import FormatProvider, compiled
 from .. import MetaconfError
 from ..utils import quote, unquote
 import os
@@ -15,6 +15,11 @@ if sys.version_info[0:2] >= (2, 7):
 else:
 	from scalarizr.externals.etree import ElementTree as ET
 
+
+SECT_RE = re.compile(r'\[(?P<header>[^]]+)\]')
+SPACE_RE = re.compile('\s')
+
+
 class IniFormatProvider(FormatProvider):
 	
 	_readers = None
@@ -52,19 +57,17 @@ class IniFormatProvider(FormatProvider):
 
 		
 	def read_comment(self, line, root):	
-		if not hasattr(self, "_comment_re"):
-			self._comment_re = re.compile(self._comment_re_string)
-		if self._comment_re.match(line):
-			comment = ET.Comment(self._comment_re.match(line).group(1))
+		result = compiled(self._comment_re_string).match(line)
+		if result:
+			comment = ET.Comment(result.group(1))
 			self._cursect.append(comment)
 			return True
 		return False
 	
 	def read_section(self, line, root):
-		if not hasattr(self, "_sect_re"):
-			self._sect_re = re.compile(r'\[(?P<header>[^]]+)\]')
-		if self._sect_re.match(line):
-			self._cursect = ET.SubElement(root, quote(self._sect_re.match(line).group('header')))
+		result = SECT_RE.match(line)
+		if result:
+			self._cursect = ET.SubElement(root, quote(result.group('header')))
 			self._cursect.attrib['mc_type'] = 'section'
 			return True
 		return False
@@ -78,14 +81,13 @@ class IniFormatProvider(FormatProvider):
 
 
 	def read_option(self, line, root):
-		if not hasattr(self, "_opt_re"):
-			self._opt_re = re.compile(self._opt_re_string)
-		if self._opt_re.match(line):
-			if self._opt_re.match(line).group('comment'):
-				comment = ET.Comment(self._opt_re.match(line).group('comment')[1:])
+		result = compiled(self._opt_re_string).match(line)
+		if result:
+			if result.group('comment'):
+				comment = ET.Comment(result.group('comment')[1:])
 				self._cursect.append(comment)
-			new_opt = ET.SubElement(self._cursect, quote(self._opt_re.match(line).group('option').strip()))
-			value = self._opt_re.match(line).group('value')
+			new_opt = ET.SubElement(self._cursect, quote(result.group('option').strip()))
+			value = result.group('value')
 			if len(value) > 1 and value[0] in ('"', "'") and value[-1] in ('"', "'") and value[0] == value[-1]:
 				value = value[1:-1]
 			new_opt.text = value
@@ -114,7 +116,7 @@ class IniFormatProvider(FormatProvider):
 	def write_option(self, fp, node):
 		if node.attrib.has_key('mc_type') and node.attrib['mc_type'] == 'option':
 			value = str(node.text if node.text else '')
-			if re.search('\s', value) or value == '':
+			if SPACE_RE.search(value) or value == '':
 				value = '"' + value + '"'
 			fp.write(unquote(node.tag)+"\t= "+value+'\n')
 			return True
@@ -18,6 +18,11 @@ else:
 	from scalarizr.externals.etree import ElementTree as ET
 
 
+STAT_RE = re.compile(r'\s*([^#=\s\[\]]+)\s*$')
+INC_RE = re.compile(r'\s*(!include(dir)?)\s+(.+)$')
+
+
+
 class MysqlFormatProvider(IniFormatProvider):
 
 	_opt_re_string		= r'(?P<option>[^:=\s][^:=]*)\s*(?P<vi>[:=])\s*(?P<value>.*?)\s*(?P<comment>#(.*))?$'
@@ -50,20 +55,18 @@ class MysqlFormatProvider(IniFormatProvider):
 		return el
 	
 	def read_statement(self, line, root):
-		if not hasattr(self, "_stat_re"):
-			self._stat_re = re.compile(r'\s*([^#=\s\[\]]+)\s*$')
-		if self._stat_re.match(line):
-			new_statement = ET.SubElement(self._cursect, quote(self._stat_re.match(line).group(1)))
+		result = STAT_RE.match(line)
+		if result:
+			new_statement = ET.SubElement(self._cursect, quote(result.group(1)))
 			new_statement.attrib['mc_type'] = 'statement'
 			return True
 		return False
 		
 	def read_include(self, line, root):
-		if not hasattr(self, "_inc_re"):
-			self._inc_re = re.compile(r'\s*(!include(dir)?)\s+(.+)$')
-		if self._inc_re.match(line):
-			new_include = ET.SubElement(self._cursect, quote(self._inc_re.match(line).group(1)))
-			new_include.text = self._inc_re.match(line).group(3).strip()
+		result = INC_RE.match(line)
+		if result:
+			new_include = ET.SubElement(self._cursect, quote(result.group(1)))
+			new_include.text = result.group(3).strip()
 			new_include.attrib['mc_type'] = 'include'
 			return True
 		return False
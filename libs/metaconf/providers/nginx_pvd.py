@@ -21,6 +21,15 @@ try:
 except ImportError:
 	from StringIO import StringIO
 
+
+COMMENT_RE = re.compile('\s*#(.*)$')
+MULTI_RE = re.compile("\s*(?P<statement>[^\s]+)\s+(?P<value>.+?)(?P<multi_end>;)?\s*(#(?P<comment>.*))?$")
+MULTI_BLOCK_RE = re.compile("\s*(?P<value>[^#]+?)(?P<multi_end>;)?\s*(#(?P<comment>.*))?$")
+STAT_RE = re.compile(r'\s*([^\s\[\]]*)\s*;\s*$')
+SECT_RE = re.compile('\s*(?P<option>[^\s]+)\s*(?P<value>.*?)\s*{\s*(?P<comment>#(.*))?\s*')
+BODY_RE = re.compile('{(.*)}', re.S)
+
+
 class NginxFormatProvider(IniFormatProvider):
 	
 	def __init__(self):
@@ -46,20 +55,16 @@ class NginxFormatProvider(IniFormatProvider):
 		return el
 			
 	def read_comment(self, line, root):
-		if not hasattr(self, "_comment_re"):
-			self._comment_re = re.compile('\s*#(.*)$')
-		if self._comment_re.match(line):
-			comment = ET.Comment(self._comment_re.match(line).group(1))
+		result = COMMENT_RE.match(line)
+		if result:
+			comment = ET.Comment(result.group(1))
 			self._cursect.append(comment)
 			return True
 		return False
 	
 	
 	def read_option(self, line, root):
-		if not hasattr(self, "_multi_re"):
-			self._multi_re = re.compile("\s*(?P<statement>[^\s]+)\s+(?P<value>.+?)(?P<multi_end>;)?\s*(#(?P<comment>.*))?$")
-
-		result = self._multi_re.match(line)
+		result = MULTI_RE.match(line)
 
 		if result:
 			new_multi = ET.Element(quote(result.group('statement').strip()))
@@ -74,13 +79,11 @@ class NginxFormatProvider(IniFormatProvider):
 				return True
 			else:
 				opened = 1
-				if not hasattr(self, "_multi_block"):
-					self._multi_block = re.compile("\s*(?P<value>[^#]+?)(?P<multi_end>;)?\s*(#(?P<comment>.*))?$")
 				while opened != 0:
 					new_line = self._fp.readline()
 					if not new_line:
 						return False
-					result = self._multi_block.match(new_line)
+					result = MULTI_BLOCK_RE.match(new_line)
 					if not result:
 						return False
 					self._lineno += 1
@@ -96,19 +99,15 @@ class NginxFormatProvider(IniFormatProvider):
 		return False
 	
 	def read_statement(self, line, root):
-		if not hasattr(self, "_stat_re"):
-			self._stat_re = re.compile(r'\s*([^\s\[\]]*)\s*;\s*$')
-		if self._stat_re.match(line):
-			new_statement = ET.SubElement(self._cursect, quote(self._stat_re.match(line).group(1)))
+		result = STAT_RE.match(line)
+		if result:
+			new_statement = ET.SubElement(self._cursect, quote(result.group(1)))
 			new_statement.attrib['mc_type'] = 'statement'			
 			return True
 		return False
 	
 	def read_section(self, line, root):
-		if not hasattr(self, "_sect_re"):
-			self._sect_re = re.compile('\s*(?P<option>[^\s]+)\s*(?P<value>.*?)\s*{\s*(?P<comment>#(.*))?\s*')
-			
-		result = self._sect_re.match(line)
+		result = SECT_RE.match(line)
 		if result:
 			new_section = ET.SubElement(self._cursect, quote(result.group('option').strip()))
 			new_section.attrib['mc_type'] = 'section'
@@ -133,7 +132,7 @@ class NginxFormatProvider(IniFormatProvider):
 			self._sections.append(self._cursect)
 			self._cursect = new_section
 			old_fp = self._fp
-			content = re.search(re.compile('{(.*)}',re.S), line).group(1).strip()
+			content = BODY_RE.search(line).group(1).strip()
 			self.read(StringIO(content), self._lineno)
 			self._fp = old_fp
 			self._cursect = self._sections.pop()
@@ -7,7 +7,7 @@ import os
 import re
 import sys
 
-from . import FormatProvider
+from . import FormatProvider, compiled
 from .ini_pvd import IniFormatProvider
 from .. import MetaconfError
 from ..utils import quote, unquote
@@ -40,11 +40,10 @@ class RedisFormatProvider(IniFormatProvider):
 		return el
 	
 	def read_option(self, line, root):
-		if not hasattr(self, "_opt_re"):
-			self._opt_re = re.compile(self._opt_re_string)
-		if self._opt_re.match(line):
-			new_opt = ET.SubElement(self._cursect, quote(self._opt_re.match(line).group('option').strip()))
-			value = self._opt_re.match(line).group('value')
+		result = compiled(self._opt_re_string).match(line)
+		if result:
+			new_opt = ET.SubElement(self._cursect, quote(result.group('option').strip()))
+			value = result.group('value')
 			new_opt.text = value
 			new_opt.attrib['mc_type'] = 'option'
 			return True
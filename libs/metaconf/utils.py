@@ -28,12 +28,10 @@ def indent(elem, level=0):
 			elem.tail = i
 			
 def quote(line):
-	line = re.sub(' ', '%20', line)
-	return re.sub('"', '%22', line)
+	return line.replace(' ', '%20').replace('"', '%22')
 
 def unquote(line):
-	line = re.sub('%20', ' ', line)
-	return re.sub('%22', '"', line)
+	return line.replace('%20', ' ').replace('%22', '"')
 
 			
 class CommentedTreeBuilder ( ET.XMLTreeBuilder ):
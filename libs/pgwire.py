@@ -0,0 +1,421 @@
+'''
+Created on Jan 21, 2013
+
+Minimal PostgreSQL frontend/backend protocol (v3) client.
+Supports trust, peer/ident (by connecting under the role's system user),
+password and md5 authentication, simple and extended (parameterized) queries.
+'''
+
+from __future__ import with_statement
+
+import os
+import pwd
+import errno
+import socket
+import struct
+import hashlib
+import threading
+
+
+SOCKET_DIRS = ('/var/run/postgresql', '/tmp')
+
+PROTOCOL_VERSION = 196608 # 3.0
+
+AUTH_OK = 0
+AUTH_CLEARTEXT = 3
+AUTH_MD5 = 5
+
+_converters = {
+	16: lambda value: value == 't', 	# bool
+	20: int,							# int8
+	21: int,							# int2
+	23: int,							# int4
+	26: int,							# oid
+	700: float,							# float4
+	701: float							# float8
+}
+
+
+class Error(Exception):
+	pass
+
+
+class ConnectionError(Error):
+	'''
+	Server is not reachable
+	'''
+
+
+class AuthError(Error):
+	'''
+	Server requested authentication method that is not supported or failed
+	'''
+
+
+class DatabaseError(Error):
+	'''
+	ErrorResponse from server
+	'''
+	def __init__(self, fields):
+		self.fields = fields
+		self.code = fields.get('C')
+		self.severity = fields.get('S')
+		Error.__init__(self, '%s:  %s' % (self.severity, fields.get('M')))
+
+
+class Result(object):
+	columns = None
+	rows = None
+	status = None
+	'''
+	Command tag, e.g. 'SELECT 3', 'DROP ROLE'
+	'''
+
+	def __init__(self, columns=None, rows=None, status=None):
+		self.columns = columns or []
+		self.rows = rows or []
+		self.status = status
+
+	def __iter__(self):
+		return iter(self.rows)
+
+	def __len__(self):
+		return len(self.rows)
+
+	def column(self, index=0):
+		return [row[index] for row in self.rows]
+
+	def scalar(self):
+		return self.rows[0][0] if self.rows else None
+
+
+def quote_ident(name):
+	return '"%s"' % name.replace('"', '""')
+
+
+def quote_literal(value):
+	if value is None:
+		return 'NULL'
+	if isinstance(value, bool):
+		return value and 'true' or 'false'
+	if isinstance(value, (int, long, float)):
+		return str(value)
+	if isinstance(value, unicode):
+		value = value.encode('utf-8')
+	return "E'%s'" % value.replace('\\', '\\\\').replace("'", "''")
+
+
+def find_socket(port=5432):
+	for dir in SOCKET_DIRS:
+		path = os.path.join(dir, '.s.PGSQL.%d' % port)
+		if os.path.exists(path):
+			return path
+	return None
+
+
+class Connection(object):
+	'''
+	Single connection over the local socket.
+	Queries are serialized, so the connection can be shared by threads.
+
+	Example:
+		conn = Connection('postgres')
+		conn.query('SELECT rolname FROM pg_roles WHERE rolsuper = $1', [True]).column()
+	'''
+
+	timeout = 30
+	'''
+	Seconds to connect, authenticate and ping. 
+	Statements run without timeout unless it's passed to query()
+	'''
+
+	def __init__(self, user, database=None, password=None, socket_path=None, port=5432):
+		self.user = user
+		self.database = database or user
+		self.password = password
+		self.socket_path = socket_path or find_socket(port)
+		self.parameters = {}
+		self._sock = None
+		self._buf = ''
+		self._replied = False
+		self._lock = threading.RLock()
+
+
+	@property
+	def connected(self):
+		return self._sock is not None
+
+
+	def connect(self):
+		with self._lock:
+			if self._sock:
+				return
+			if not self.socket_path or not os.path.exists(self.socket_path):
+				raise ConnectionError('PostgreSQL socket not found in %s' % ', '.join(SOCKET_DIRS))
+
+			sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				if os.geteuid() == 0 and self._system_user():
+					self._connect_as(sock, self._system_user())
+				else:
+					sock.connect(self.socket_path)
+			except (socket.error, OSError), e:
+				sock.close()
+				raise ConnectionError('Cannot connect to %s: %s' % (self.socket_path, e))
+			sock.settimeout(self.timeout)
+			self._sock = sock
+			self._buf = ''
+
+			try:
+				self._startup()
+			except:
+				self.close()
+				raise
+
+
+	def close(self):
+		with self._lock:
+			if self._sock:
+				try:
+					self._send('X', '')
+				except socket.error:
+					pass
+				self._sock.close()
+				self._sock = None
+
+
+	def query(self, sql, params=None, timeout=None):
+		'''
+		Executes one statement. With params sql refers them as $1, $2, ...
+		@param timeout: Seconds to wait for the result, None to wait forever
+		@rtype: Result
+		'''
+		if params is None:
+			return self._roundtrip(lambda: self._send('Q', _cstr(sql)), timeout)
+		return self._roundtrip(lambda: self._send_extended(sql, params), timeout)
+
+
+	def ping(self):
+		'''
+		Round trip without planning a query
+		'''
+		self._roundtrip(lambda: self._send('S', ''), self.timeout)
+
+
+	def _roundtrip(self, send, timeout=None):
+		'''
+		Sends request and reads result. Connection left from the previous calls
+		may be dead after server restart: when sending fails or server closes it 
+		before any reply, request is repeated once on a fresh connection.
+		Timeouts are never retried: server may still be executing the request
+		'''
+		with self._lock:
+			for attempt in (1, 2):
+				reused = self._sock is not None
+				self.connect()
+				self._sock.settimeout(timeout)
+				self._replied = False
+				try:
+					try:
+						send()
+					except socket.error, e:
+						raise ConnectionError(str(e))
+					return self._read_result()
+				except ConnectionError, e:
+					self.close()
+					if attempt == 1 and reused and not self._replied:
+						continue
+					raise
+				except socket.error, e:
+					self.close()
+					raise ConnectionError(str(e))
+
+
+	def _system_user(self):
+		try:
+			return pwd.getpwnam(self.user)
+		except KeyError:
+			return None
+
+
+	def _connect_as(self, sock, user):
+		'''
+		Peer and ident authentication check the credentials of a process that
+		called connect(). Socket is connected from the child running under role's
+		system user, just like `su - postgres -c psql` does.
+		'''
+		pid = os.fork()
+		if not pid:
+			code = 1
+			try:
+				os.setgid(user.pw_gid)
+				os.setuid(user.pw_uid)
+				sock.connect(self.socket_path)
+				code = 0
+			finally:
+				os._exit(code)
+		while True:
+			try:
+				status = os.waitpid(pid, 0)[1]
+				break
+			except OSError, e:
+				if e.errno != errno.EINTR:
+					raise
+		if status:
+			raise ConnectionError('Cannot connect to %s as %s' % (self.socket_path, user.pw_name))
+
+
+	def _startup(self):
+		body = struct.pack('!i', PROTOCOL_VERSION) + \
+				_cstr('user') + _cstr(self.user) + \
+				_cstr('database') + _cstr(self.database) + \
+				_cstr('client_encoding') + _cstr('UTF8') + '\0'
+		self._sock.sendall(struct.pack('!i', len(body) + 4) + body)
+
+		while True:
+			type, data = self._read_message()
+			if type == 'R':
+				self._authenticate(data)
+			elif type == 'S':
+				name, value = data.split('\0')[:2]
+				self.parameters[name] = value
+			elif type == 'E':
+				raise self._auth_error(_parse_fields(data))
+			elif type == 'Z':
+				return
+
+
+	def _authenticate(self, data):
+		code = struct.unpack('!i', data[:4])[0]
+		if code == AUTH_OK:
+			return
+		if code in (AUTH_CLEARTEXT, AUTH_MD5) and self.password is None:
+			raise AuthError('Server requested password for %s' % self.user)
+		if code == AUTH_CLEARTEXT:
+			self._send('p', _cstr(self.password))
+		elif code == AUTH_MD5:
+			inner = hashlib.md5(self.password + self.user).hexdigest()
+			self._send('p', _cstr('md5' + hashlib.md5(inner + data[4:8]).hexdigest()))
+		else:
+			raise AuthError('Unsupported authentication method %d' % code)
+
+
+	def _auth_error(self, fields):
+		# 28000 invalid_authorization_specification, 28P01 invalid_password
+		if fields.get('C', '').startswith('28'):
+			return AuthError(fields.get('M'))
+		return DatabaseError(fields)
+
+
+	def _send_extended(self, sql, params):
+		values = []
+		for value in params:
+			if value is None:
+				values.append(struct.pack('!i', -1))
+				continue
+			if isinstance(value, bool):
+				value = value and 't' or 'f'
+			elif isinstance(value, unicode):
+				value = value.encode('utf-8')
+			else:
+				value = str(value)
+			values.append(struct.pack('!i', len(value)) + value)
+
+		self._send('P', _cstr('') + _cstr(sql) + struct.pack('!h', 0))
+		self._send('B', _cstr('') + _cstr('') + struct.pack('!hh', 0, len(values)) +
+					''.join(values) + struct.pack('!h', 0))
+		self._send('D', 'P' + _cstr(''))
+		self._send('E', _cstr('') + struct.pack('!i', 0))
+		self._send('S', '')
+
+
+	def _read_result(self):
+		result = Result()
+		converters = []
+		error = None
+		while True:
+			type, data = self._read_message()
+			if type == 'T':
+				result.columns, converters = _parse_row_description(data)
+			elif type == 'D':
+				result.rows.append(_parse_row(data, converters))
+			elif type == 'C':
+				result.status = data.rstrip('\0')
+			elif type == 'E':
+				# Server skips the rest of the statement and sends ReadyForQuery
+				error = DatabaseError(_parse_fields(data))
+			elif type == 'S':
+				name, value = data.split('\0')[:2]
+				self.parameters[name] = value
+			elif type == 'Z':
+				if error:
+					raise error
+				return result
+			# Ignore NoticeResponse, ParseComplete, BindComplete, NoData,
+			# EmptyQueryResponse and notifications
+
+
+	def _send(self, type, body):
+		self._sock.sendall(type + struct.pack('!i', len(body) + 4) + body)
+
+
+	def _read_message(self):
+		header = self._recv(5)
+		self._replied = True
+		type, length = header[0], struct.unpack('!i', header[1:])[0]
+		return type, self._recv(length - 4)
+
+
+	def _recv(self, size):
+		while len(self._buf) < size:
+			chunk = self._sock.recv(max(size - len(self._buf), 8192))
+			if not chunk:
+				raise ConnectionError('Server closed the connection')
+			self._buf += chunk
+		ret, self._buf = self._buf[:size], self._buf[size:]
+		return ret
+
+
+def _cstr(value):
+	if isinstance(value, unicode):
+		value = value.encode('utf-8')
+	return value + '\0'
+
+
+def _parse_fields(data):
+	fields = {}
+	for field in data.split('\0'):
+		if field:
+			fields[field[0]] = field[1:]
+	return fields
+
+
+def _parse_row_description(data):
+	count = struct.unpack('!h', data[:2])[0]
+	pos = 2
+	columns = []
+	converters = []
+	for _ in range(count):
+		end = data.index('\0', pos)
+		columns.append(data[pos:end])
+		type_oid = struct.unpack('!i', data[end + 7:end + 11])[0]
+		converters.append(_converters.get(type_oid))
+		pos = end + 19
+	return columns, converters
+
+
+def _parse_row(data, converters):
+	count = struct.unpack('!h', data[:2])[0]
+	pos = 2
+	row = []
+	for i in range(count):
+		length = struct.unpack('!i', data[pos:pos + 4])[0]
+		pos += 4
+		if length == -1:
+			row.append(None)
+			continue
+		value = data[pos:pos + length]
+		pos += length
+		convert = converters[i] if i < len(converters) else None
+		row.append(convert(value) if convert else value)
+	return tuple(row)
@@ -0,0 +1,227 @@
+'''
+Created on Jan 24, 2013
+
+Minimal Redis client speaking the REdis Serialization Protocol (RESP).
+Connections are pooled, commands can be pipelined.
+'''
+
+from __future__ import with_statement
+
+import socket
+import threading
+import contextlib
+
+
+class Error(Exception):
+	pass
+
+
+class ConnectionError(Error):
+	'''
+	Server is not reachable or closed the connection
+	'''
+
+
+class ResponseError(Error):
+	'''
+	Error reply from server, e.g. 'ERR unknown command', 'LOADING ...'
+	'''
+	def __init__(self, message):
+		Error.__init__(self, message)
+		self.kind = message.split(' ', 1)[0]
+
+
+def encode_command(args):
+	parts = ['*%d\r\n' % len(args)]
+	for arg in args:
+		if isinstance(arg, unicode):
+			arg = arg.encode('utf-8')
+		elif not isinstance(arg, str):
+			arg = str(arg)
+		parts.append('$%d\r\n%s\r\n' % (len(arg), arg))
+	return ''.join(parts)
+
+
+class Connection(object):
+
+	timeout = 30
+
+	def __init__(self, host='127.0.0.1', port=6379, password=None):
+		self.host = host
+		self.port = int(port)
+		self.password = password
+		self._sock = None
+		self._buf = ''
+		self.replied = False
+		'''
+		Whether server sent anything in response to the last pipeline
+		'''
+
+
+	@property
+	def connected(self):
+		return self._sock is not None
+
+
+	def connect(self):
+		if self._sock:
+			return
+		try:
+			self._sock = socket.create_connection((self.host, self.port), self.timeout)
+		except socket.error, e:
+			raise ConnectionError('Cannot connect to %s:%s: %s' % (self.host, self.port, e))
+		self._buf = ''
+		if self.password:
+			try:
+				self.execute('AUTH', self.password)
+			except ResponseError, e:
+				# Redis 2.4 rejects AUTH when requirepass is not set
+				if 'no password is set' not in str(e):
+					self.close()
+					raise
+
+
+	def close(self):
+		if self._sock:
+			self._sock.close()
+			self._sock = None
+
+
+	def execute(self, *args):
+		return self.pipeline([args])[0]
+
+
+	def pipeline(self, commands, raise_on_error=True):
+		'''
+		Sends all commands in one write and reads replies in order.
+		@param raise_on_error: When False, error replies are returned in place
+		as ResponseError instances
+		@return: list of replies
+		'''
+		self.connect()
+		self.replied = False
+		try:
+			self._sock.sendall(''.join(encode_command(args) for args in commands))
+			replies = [self._read_reply() for _ in commands]
+		except socket.error, e:
+			self.close()
+			raise ConnectionError(str(e))
+		except:
+			# Unread replies are left in the socket, connection can't be reused
+			self.close()
+			raise
+		if raise_on_error:
+			for reply in replies:
+				if isinstance(reply, ResponseError):
+					raise reply
+		return replies
+
+
+	def _read_reply(self):
+		line = self._readline()
+		type, data = line[0], line[1:]
+		if type == '+':
+			return data
+		elif type == '-':
+			return ResponseError(data)
+		elif type == ':':
+			return int(data)
+		elif type == '$':
+			length = int(data)
+			if length == -1:
+				return None
+			return self._recv(length + 2)[:-2]
+		elif type == '*':
+			count = int(data)
+			if count == -1:
+				return None
+			return [self._read_reply() for _ in range(count)]
+		raise ConnectionError('Protocol error: unexpected reply %r' % line)
+
+
+	def _readline(self):
+		while True:
+			pos = self._buf.find('\r\n')
+			if pos != -1:
+				line, self._buf = self._buf[:pos], self._buf[pos + 2:]
+				return line
+			self._fill()
+
+
+	def _recv(self, size):
+		while len(self._buf) < size:
+			self._fill()
+		ret, self._buf = self._buf[:size], self._buf[size:]
+		return ret
+
+
+	def _fill(self):
+		chunk = self._sock.recv(65536)
+		if not chunk:
+			raise ConnectionError('Server closed the connection')
+		self.replied = True
+		self._buf += chunk
+
+
+class ConnectionPool(object):
+	'''
+	Keeps up to `max_idle` idle connections to one server.
+	Connection is checked out for the duration of a command or pipeline,
+	so concurrent threads never share a socket
+	'''
+
+	max_idle = 4
+
+	def __init__(self, host='127.0.0.1', port=6379, password=None, max_idle=None):
+		self.host = host
+		self.port = int(port)
+		self.password = password
+		if max_idle is not None:
+			self.max_idle = max_idle
+		self._idle = []
+		self._lock = threading.Lock()
+
+
+	@contextlib.contextmanager
+	def connection(self):
+		with self._lock:
+			conn = self._idle.pop() if self._idle else None
+		if not conn:
+			conn = Connection(self.host, self.port, self.password)
+		try:
+			yield conn
+		finally:
+			# Connection with unread replies is closed on error, don't reuse it
+			if conn.connected:
+				with self._lock:
+					if len(self._idle) < self.max_idle:
+						self._idle.append(conn)
+						conn = None
+			if conn:
+				conn.close()
+
+
+	def execute(self, *args):
+		return self.pipeline([args])[0]
+
+
+	def pipeline(self, commands, raise_on_error=True):
+		for attempt in (1, 2):
+			with self.connection() as conn:
+				reused = conn.connected
+				try:
+					return conn.pipeline(commands, raise_on_error)
+				except ConnectionError:
+					# Idle connections are dead after server restart. 
+					# Drop them and repeat on a new one
+					if attempt == 1 and reused and not conn.replied:
+						self.disconnect()
+						continue
+					raise
+
+
+	def disconnect(self):
+		with self._lock:
+			idle, self._idle = self._idle, []
+		for conn in idle:
+			conn.close()
@@ -269,16 +269,166 @@ class _Chain(object):
 		# NOTE: rule comparison is far from ideal, check _to_inner method
 		# NOTE: existing rules don't have table attribute
 
-		existing = self.list()
+		existing = set(_rule_key(_to_inner(rule)) for rule in self.list())
+		trans = Transaction()
 		for rule in reversed(rules):
-			rule_repr = _to_inner(rule)
-			if rule_repr not in existing:
+			key = _rule_key(_to_inner(rule))
+			if key not in existing:
+				existing.add(key)
 				if not append:
-					self.insert(None, rule)
-					existing.insert(0, rule_repr)
+					trans.insert(self.name, rule)
 				else:
-					self.append(rule)
-					existing.append(rule_repr)
+					trans.append(self.name, rule)
+		trans.commit()
+
+
+class Transaction(object):
+	'''
+	Collects rule changes and applies them at once
+	with a single `iptables-restore --noflush` call.
+	Changes are atomic per table: either all of them are applied or none.
+	'''
+
+	def __init__(self):
+		self._tables = OrderedDict()
+
+
+	def new_chain(self, name, table='filter'):
+		# Only for chains that don't exist: iptables-restore flushes declared chains
+		self._table(table)[0].append(name)
+
+
+	def append(self, chain, rule):
+		self._add(['-A', chain], rule)
+
+
+	def insert(self, chain, rule, index=1):
+		self._add(['-I', chain, str(index)], rule)
+
+
+	def delete(self, chain, rule):
+		self._add(['-D', chain], rule)
+
+
+	def __len__(self):
+		return sum(len(chains) + len(lines) for chains, lines in self._tables.values())
+
+
+	def commit(self):
+		if not len(self):
+			return
+		if not os.access(IPTABLES_RESTORE, os.X_OK):
+			# Fallback to one iptables call per change
+			for table, (chains, lines) in self._tables.items():
+				for chain in chains:
+					iptables(table=table, **{'new-chain': chain})
+				for args in lines:
+					linux.system([IPTABLES_BIN, '--table', table] + args)
+		else:
+			data = []
+			for table, (chains, lines) in self._tables.items():
+				data.append('*%s' % table)
+				data.extend(':%s - [0:0]' % chain for chain in chains)
+				data.extend(' '.join(map(_quote, args)) for args in lines)
+				data.append('COMMIT')
+			LOG.debug('Applying %d iptables changes', len(self))
+			linux.system([IPTABLES_RESTORE, '--noflush'], stdin='\n'.join(data) + '\n')
+		self._tables.clear()
+
+
+	def _table(self, name):
+		return self._tables.setdefault(name, ([], []))
+
+
+	def _add(self, args, rule):
+		rule = copy(rule)
+		table = rule.pop('table', 'filter')
+		self._table(table)[1].append(args + _rule_args(rule))
+
+
+class SourceChain(object):
+	'''
+	User defined chain of "--source <ip> --jump <target>" rules.
+	Sources are kept in memory, so adding or removing a host is a set
+	operation which calls iptables only when the set actually changes.
+	'''
+
+	def __init__(self, name, target='ACCEPT'):
+		self.name = name
+		self.target = target
+		self._sources = None
+		self._new = False
+
+
+	def __contains__(self, source):
+		self._load()
+		return _normalize_source(source) in self._sources
+
+
+	def update(self, add=(), remove=()):
+		self._load()
+		trans = Transaction()
+		if self._new:
+			trans.new_chain(self.name)
+			self._new = False
+		for source in sorted(set(map(_normalize_source, add)) - self._sources):
+			trans.append(self.name, {'source': source, 'jump': self.target})
+			self._sources.add(source)
+		for source in sorted(set(map(_normalize_source, remove)) & self._sources):
+			trans.delete(self.name, {'source': source, 'jump': self.target})
+			self._sources.discard(source)
+		trans.commit()
+
+
+	def sync(self, sources):
+		'''
+		Make chain contain exactly the given sources
+		'''
+		self._load()
+		sources = set(map(_normalize_source, sources))
+		self.update(add=sources - self._sources, remove=self._sources - sources)
+
+
+	def _load(self):
+		if self._sources is not None:
+			return
+		try:
+			rules = chains[self.name].list()
+		except linux.LinuxError, e:
+			if 'No chain/target/match' not in e.err:
+				raise
+			# Chain will be created with the first update
+			self._new = True
+			rules = []
+		self._sources = set(rule['source'] for rule in rules
+						if rule.get('jump') == self.target and 'source' in rule)
+
+
+def _rule_args(rule):
+	# the same options order as in iptables()
+	ordered = OrderedDict()
+	for key in ("protocol", "match"):
+		if key in rule:
+			ordered[key] = rule[key]
+	for key, value in rule.items():
+		if key not in ordered:
+			ordered[key] = value
+	return [str(arg) for arg in linux.build_cmd_args(long=ordered)]
+
+
+def _rule_key(rule):
+	return tuple(sorted((key, tuple(value) if hasattr(value, '__iter__') else value) 
+					for key, value in rule.items()))
+
+
+def _quote(arg):
+	if not arg or ' ' in arg or '"' in arg:
+		return '"%s"' % arg.replace('"', '\\"')
+	return arg
+
+
+def _normalize_source(source):
+	return source + '/32' if _is_plain_ip(source) else source
 
 
 #? Group this two functions in a Rule class?
@@ -0,0 +1,186 @@
+'''
+Created on Jan 14, 2013
+
+Cached samples of /proc statistics.
+SysInfo API and SNMP MIBs read the same snapshot, so each file is parsed
+at most once per Sampler.interval no matter how many values are requested.
+'''
+
+from __future__ import with_statement
+
+import collections
+import threading
+import time
+
+
+CpuStat = collections.namedtuple('CpuStat',
+				'user nice system idle iowait irq softirq steal')
+
+DiskStat = collections.namedtuple('DiskStat',
+				'device reads read_sectors writes write_sectors')
+
+NetStat = collections.namedtuple('NetStat',
+				'iface rx_bytes rx_packets rx_errors tx_bytes tx_packets tx_errors')
+
+
+def _parse_stat(fp):
+	cpu = fp.readline().split()[1:9]
+	cpu += ['0'] * (8 - len(cpu))
+	return CpuStat(*map(int, cpu))
+
+
+def _parse_meminfo(fp):
+	ret = {}
+	for line in fp:
+		key, value = line.split(':', 1)
+		ret[key] = int(value.split()[0])
+	return ret
+
+
+def _parse_diskstats(fp):
+	ret = []
+	for line in fp:
+		cols = line.split()
+		if len(cols) == 7:
+			# Partition on 2.6 kernels before 2.6.25:
+			# reads, read sectors, writes, write sectors
+			ret.append(DiskStat(cols[2], int(cols[3]), int(cols[4]), int(cols[5]), int(cols[6])))
+		elif len(cols) >= 14:
+			ret.append(DiskStat(cols[2], int(cols[3]), int(cols[5]), int(cols[7]), int(cols[9])))
+	return ret
+
+
+def _parse_netdev(fp):
+	ret = []
+	for line in fp:
+		if ':' not in line:
+			continue
+		iface, cols = line.split(':', 1)
+		cols = cols.split()
+		ret.append(NetStat(iface.strip(), int(cols[0]), int(cols[1]), int(cols[2]),
+						int(cols[8]), int(cols[9]), int(cols[10])))
+	return ret
+
+
+class Sampler(object):
+	'''
+	Reads /proc statistics files not more often than once per `interval` seconds.
+	Keeps the previous sample of each file to calculate rates
+	'''
+
+	FILES = {
+		'stat': ('/proc/stat', _parse_stat),
+		'meminfo': ('/proc/meminfo', _parse_meminfo),
+		'diskstats': ('/proc/diskstats', _parse_diskstats),
+		'netdev': ('/proc/net/dev', _parse_netdev)
+	}
+
+	interval = None
+
+	def __init__(self, interval=1):
+		self.interval = interval
+		self._lock = threading.Lock()
+		self._samples = {}
+		self._previous = {}
+		self._indexes = {}
+
+
+	def cpu(self):
+		'''
+		@rtype: CpuStat
+		'''
+		return self._get('stat')
+
+
+	def meminfo(self):
+		'''
+		@return: dict of /proc/meminfo values in kB
+		'''
+		return self._get('meminfo')
+
+
+	def diskstats(self):
+		'''
+		@return: list of DiskStat in /proc/diskstats order
+		'''
+		return self._get('diskstats')
+
+
+	def netdev(self):
+		'''
+		@return: list of NetStat in /proc/net/dev order
+		'''
+		return self._get('netdev')
+
+
+	def find(self, name, key):
+		'''
+		Row of the 'diskstats' or 'netdev' sample by device or interface name
+		@return: DiskStat, NetStat or None
+		'''
+		with self._lock:
+			data = self._refresh(name)
+			index = self._indexes.get(name)
+			if not index or index[0] is not data:
+				index = (data, dict((row[0], row) for row in data))
+				self._indexes[name] = index
+			return index[1].get(key)
+
+
+	def rates(self, name):
+		'''
+		Per second rates of counters between the last two samples.
+		@param name: One of 'stat', 'diskstats', 'netdev'
+		@return: CpuStat for 'stat', {device: DiskStat} or {iface: NetStat} for others.
+		Empty dict when there is only one sample yet
+		'''
+		with self._lock:
+			self._refresh(name)
+			if name not in self._previous:
+				return {}
+			prev_time, prev = self._previous[name]
+			cur_time, cur = self._samples[name]
+
+		dt = cur_time - prev_time
+		if name == 'stat':
+			return self._rate(prev, cur, dt)
+		prev = dict((row[0], row) for row in prev)
+		return dict((row[0], self._rate(prev[row[0]], row, dt))
+					for row in cur if row[0] in prev)
+
+
+	def _rate(self, prev, cur, dt):
+		values = []
+		for name, a, b in zip(cur._fields, prev, cur):
+			if name in ('device', 'iface'):
+				values.append(b)
+			else:
+				# Counter reset or overflow gives negative delta
+				values.append(max(b - a, 0) / dt)
+		return cur.__class__(*values)
+
+
+	def _get(self, name):
+		with self._lock:
+			return self._refresh(name)
+
+
+	def _refresh(self, name):
+		now = time.time()
+		sample = self._samples.get(name)
+		if sample and now - sample[0] < self.interval:
+			return sample[1]
+
+		path, parse = self.FILES[name]
+		fp = open(path)
+		try:
+			data = parse(fp)
+		finally:
+			fp.close()
+		if sample:
+			self._previous[name] = sample
+		self._samples[name] = (now, data)
+		return data
+
+
+sampler = Sampler()
@@ -1,6 +1,5 @@
 from scalarizr.libs.bases import Observable
-from scalarizr.util import xml_strip
-import xml.dom.minidom as dom
+from xml.parsers import expat
 import threading
 import logging
 
@@ -77,74 +76,118 @@ class Message(object):
 		pass
 
 	def fromxml (self, xml):
-		if isinstance(xml, str):
-			xml = xml.decode('utf-8')
-		doc = dom.parseString(xml.encode('utf-8'))
-		xml_strip(doc)
-
-		root = doc.documentElement
-		self.id = root.getAttribute("id")
-		self.name = root.getAttribute("name")
-
-		for ch in root.firstChild.childNodes:
-			self.meta[ch.nodeName] = self._walk_decode(ch)
-		for ch in root.childNodes[1].childNodes:
-			self.body[ch.nodeName] = self._walk_decode(ch)
-
-	def _walk_decode(self, el):
-		if el.firstChild and el.firstChild.nodeType == 1:
-			if all((ch.nodeName == "item" for ch in el.childNodes)):
-				return list(self._walk_decode(ch) for ch in el.childNodes)
-			else:
-				return dict(tuple((ch.nodeName, self._walk_decode(ch)) for ch in el.childNodes))
-		else:
-			return el.firstChild and el.firstChild.nodeValue or None
+		if isinstance(xml, unicode):
+			xml = xml.encode('utf-8')
+		root = _MessageDecoder().decode(xml)
+		self.id = root.attrs.get('id', u'')
+		self.name = root.attrs.get('name', u'')
+
+		meta, body = root.children[0][1], root.children[1][1]
+		for name, node in meta.children:
+			self.meta[name] = node.value
+		for name, node in body.children:
+			self.body[name] = node.value
 
 	def __str__(self):
-		from xml.dom.minidom import getDOMImplementation
-		impl = getDOMImplementation()
-		doc = impl.createDocument(None, "message", None)
-
-		root = doc.documentElement;
-		root.setAttribute("id", str(self.id))
-		root.setAttribute("name", str(self.name))
-
-		meta = doc.createElement("meta")
-		root.appendChild(meta)
-		self._walk_encode(self.meta, meta, doc)
-
-		body = doc.createElement("body")
-		root.appendChild(body)
-		self._walk_encode(self.body, body, doc)
-
-		return doc.toxml('utf-8')
+		parts = [u'<?xml version="1.0" encoding="utf-8"?>']
+		parts.append(u'<message id="%s" name="%s">' % (
+				_xml_escape(str(self.id).decode('utf-8')), 
+				_xml_escape(str(self.name).decode('utf-8'))))
+		self._walk_encode(self.meta, 'meta', parts)
+		self._walk_encode(self.body, 'body', parts)
+		parts.append(u'</message>')
+		return u''.join(parts).encode('utf-8')
 
 	toxml = __str__
 
-	def _walk_encode(self, value, el, doc):
+	def _walk_encode(self, value, tag, parts):
 		if getattr(value, '__iter__', False):
+			start = len(parts)
 			if getattr(value, "keys", False):
 				for k, v in value.items():
-					itemEl = doc.createElement(str(k))
-					el.appendChild(itemEl)
-					self._walk_encode(v, itemEl, doc)
+					self._walk_encode(v, str(k), parts)
 			else:
 				for v in value:
-					itemEl = doc.createElement("item")
-					el.appendChild(itemEl)
-					self._walk_encode(v, itemEl, doc)
+					self._walk_encode(v, 'item', parts)
+			if len(parts) == start:
+				parts.append(u'<%s/>' % tag)
+			else:
+				parts.insert(start, u'<%s>' % tag)
+				parts.append(u'</%s>' % tag)
 		else:
-			'''
-			if not isinstance(value, unicode):
-				if value is not None:
-					value = str(value)
-				else:
-					value = ''
-			el.appendChild(doc.createTextNode(value))
-			'''
 			if value is not None and not isinstance(value, unicode):
 				value = str(value).decode('utf-8')
-			el.appendChild(doc.createTextNode(value or ''))
+			parts.append(u'<%s>%s</%s>' % (tag, _xml_escape(value or u''), tag))
+
+
+def _xml_escape(data):
+	# The same escaping as xml.dom.minidom does
+	return data.replace(u"&", u"&amp;").replace(u"<", u"&lt;"). \
+				replace(u"\"", u"&quot;").replace(u">", u"&gt;")
+
+
+class _Node(object):
+	__slots__ = ('attrs', 'children', 'text', 'value')
+
+	def __init__(self, attrs=None):
+		self.attrs = attrs
+		# Child elements and non-whitespace text nodes: [(name, _Node), ...]
+		self.children = []
+		self.text = None
+		self.value = None
+
+
+class _MessageDecoder(object):
+	'''
+	Expat based message decoder. Values are built while parsing by the rules
+	of the former minidom decoder: element which first child is an element becomes 
+	a list if all children are <item>, or a dict otherwise; element with text becomes 
+	an unicode string; empty element becomes None. Whitespace-only text is ignored
+	'''
+
+	def __init__(self):
+		self._stack = []
+		self._texts = []
+		self.root = None
+
+	def decode(self, xml):
+		parser = expat.ParserCreate()
+		parser.buffer_text = True
+		parser.StartElementHandler = self._start
+		parser.EndElementHandler = self._end
+		parser.CharacterDataHandler = self._texts.append
+		parser.Parse(xml, True)
+		return self.root
+
+	def _flush_text(self):
+		if self._texts:
+			text = u''.join(self._texts)
+			del self._texts[:]
+			if text.strip() and self._stack:
+				node = _Node()
+				node.text = text
+				self._stack[-1].children.append(('#text', node))
+
+	def _start(self, name, attrs):
+		self._flush_text()
+		node = _Node(attrs)
+		if self._stack:
+			self._stack[-1].children.append((name, node))
+		else:
+			self.root = node
+		self._stack.append(node)
+
+	def _end(self, name):
+		self._flush_text()
+		node = self._stack.pop()
+		if node.children:
+			first = node.children[0][1]
+			if first.text is not None:
+				node.value = first.text
+			elif all(ch_name == 'item' for ch_name, ch in node.children):
+				node.value = list(ch.value for ch_name, ch in node.children)
+			else:
+				node.value = dict((ch_name, ch.value) for ch_name, ch in node.children)
 
 
 class MessageProducer(Observable):
@@ -8,6 +8,12 @@ from __future__ import with_statement
 import logging
 import threading
 import copy
+import time
+import sys
+if sys.version_info[0:2] >= (2, 7):
+	from collections import OrderedDict
+else:
+	from scalarizr.externals.collections import OrderedDict
 
 from scalarizr.bus import bus
 from scalarizr.messaging import MessageService, Message, MetaOptions, MessagingError
@@ -27,8 +33,10 @@ class P2pConfigOptions:
 	PRODUCER_URL 					= "producer_url"
 	PRODUCER_RETRIES_PROGRESSION 	= "producer_retries_progression"
 	PRODUCER_SENDER					= "producer_sender"
+	PRODUCER_ASYNC					= "producer_async"
 	CONSUMER_URL 					= "consumer_url"
 	MSG_HANDLER_ENABLED				= 'msg_handler_enabled'
+	STORE_BATCH_WRITES				= 'store_batch_writes'
 
 
 class P2pMessageService(MessageService):
@@ -42,6 +50,8 @@ class P2pMessageService(MessageService):
 			self._params[P2pConfigOptions.SERVER_ID],
 			self._params[P2pConfigOptions.CRYPTO_KEY_PATH]
 		)
+		if _is_true(self._params.get(P2pConfigOptions.STORE_BATCH_WRITES)):
+			P2pMessageStore().enable_batch_writes()
 
 	def new_message(self, name=None, meta=None, body=None):
 		return P2pMessage(name, meta, body)
@@ -65,6 +75,7 @@ class P2pMessageService(MessageService):
 			self._default_producer = self.new_producer(
 				endpoint=self._params[P2pConfigOptions.PRODUCER_URL],
 				retries_progression=self._params[P2pConfigOptions.PRODUCER_RETRIES_PROGRESSION],
+				async_delivery=_is_true(self._params.get(P2pConfigOptions.PRODUCER_ASYNC))
 				)
 		return self._default_producer
 
@@ -75,30 +86,139 @@ class P2pMessageService(MessageService):
 		return p
 
 
+def _is_true(value):
+	return str(value).lower() in ('1', 'true', 'yes', 'on')
+
 def new_service(**kwargs):
 	return P2pMessageService(**kwargs)
 
+class _UnhandledMessages(object):
+	'''
+	Unhandled ingoing messages in obtaining order, 
+	indexed by message_id and by message name + server_id from message body
+	'''
+
+	def __init__(self, pairs=None):
+		self._messages = OrderedDict()
+		self._by_name = {}
+		self._seq = 0
+		for queue, message in pairs or ():
+			self.add(queue, message)
+
+	def add(self, queue, message):
+		self._seq += 1
+		self._messages[message.id] = (queue, message, self._seq)
+		key = (message.name, message.body.get('server_id'))
+		self._by_name.setdefault(key, OrderedDict())[message.id] = self._seq
+
+	def remove(self, message_id):
+		try:
+			queue, message, seq = self._messages.pop(message_id)
+		except KeyError:
+			return
+		key = (message.name, message.body.get('server_id'))
+		ids = self._by_name[key]
+		del ids[message_id]
+		if not ids:
+			del self._by_name[key]
+
+	def find(self, name, server_id):
+		'''
+		Find the first message with the name, which body server_id is equal to `server_id` or absent
+		@return: (queue, message) or None
+		'''
+		found = None
+		for key in ((name, server_id), (name, None)):
+			ids = self._by_name.get(key)
+			if ids:
+				message_id, seq = iter(ids.items()).next()
+				if not found or seq < found[1]:
+					found = (message_id, seq)
+		if found:
+			queue, message, seq = self._messages[found[0]]
+			return queue, message
+
+	def items(self):
+		return list((queue, message) for queue, message, seq in self._messages.itervalues())
+
+	def __contains__(self, message_id):
+		return message_id in self._messages
+
+	def __len__(self):
+		return len(self._messages)
+
+
 class _P2pMessageStore:
 	_logger = None
 
 	TAIL_LENGTH = 50
 
+	INDEXES = (
+		'CREATE INDEX IF NOT EXISTS p2p_message_message_id ON p2p_message (message_id, is_ingoing)',
+		'CREATE INDEX IF NOT EXISTS p2p_message_unhandled ON p2p_message (is_ingoing, in_is_handled)'
+	)
+
+	batch_writes = False
+	'''
+	When True, writes are grouped into short transactions by SQLite server. 
+	See scalarizr.util.sqlite_server.FLUSH_DELAY
+	'''
+
 	def __init__(self):
 		self._logger = logging.getLogger(__name__)
 		self._local_storage_lock = threading.Lock()
+		self._unhandled_cond = threading.Condition(self._local_storage_lock)
+		self._unhandled_version = 0
+		self._received_at = {}
 		ex = bus.periodical_executor
 		if ex:
 			self._logger.debug('Add rotate messages table task for periodical executor')
 			ex.add_task(self.rotate, 3600, 'Rotate messages sqlite table') # execute rotate task each hour
+		if self._conn():
+			self._create_indexes()
 
 	def _conn(self):
 		return bus.db
 
 
+	def _create_indexes(self):
+		try:
+			self._conn().executescript(';'.join(self.INDEXES))
+		except (BaseException, Exception), e:
+			self._logger.warn('Cannot create p2p_message indexes: %s', e)
+
+
+	def enable_batch_writes(self):
+		self._logger.debug('Enable batch writes for p2p_message table')
+		self._conn().executescript('PRAGMA journal_mode=WAL')
+		self.batch_writes = True
+
+
+	def flush(self):
+		'''
+		Durability fence. Returns when all previous writes are committed
+		'''
+		if self.batch_writes:
+			self._conn().flush()
+
+
+	def _execute_write(self, sql, params):
+		conn = self._conn()
+		if self.batch_writes:
+			conn.execute_deferred(sql, params)
+			return
+		cur = conn.cursor()
+		try:
+			cur.execute(sql, params)
+			conn.commit()
+		finally:
+			cur.close()
+
+
 	@property
 	def _unhandled_messages(self):
 		if not hasattr(self, '_unhandled'):
-			self._unhandled = self._get_unhandled_from_db()
+			self._unhandled = _UnhandledMessages(self._get_unhandled_from_db())
 		return self._unhandled
 
 
@@ -113,46 +233,81 @@ class _P2pMessageStore:
 		conn.commit()
 
 	def put_ingoing(self, message, queue, consumer_id):
+		sql = """INSERT INTO p2p_message (id, message, message_id,
+					message_name, queue, is_ingoing, in_is_handled, in_consumer_id)
+				VALUES
+					(NULL, ?, ?, ?, ?, ?, ?, ?)"""
+
+		#self._logger.debug('Representation mes: %s', repr(str(message)))
+		self._execute_write(sql, [message.toxml().decode('utf-8'), message.id, message.name, queue, 1, 0, consumer_id])
+		if message.meta.has_key(MetaOptions.REQUEST_ID):
+			self._execute_write("""UPDATE p2p_message
+					SET response_uuid = ? WHERE message_id = ?""",
+				[message.id, message.meta[MetaOptions.REQUEST_ID]])
+
+		# Sender treats message as received, so it should be on disk
+		self._logger.debug("Commiting put_ingoing")
+		self.flush()
+		self._logger.debug("Commited put_ingoing")
+
+		# Message is visible to handler only after it was persisted
+		with self._unhandled_cond:
+			self._unhandled_messages.add(queue, self._snapshot(message))
+			self._received_at[message.id] = time.time()
+			self._unhandled_version += 1
+			self._unhandled_cond.notifyAll()
+
+
+	def get_unhandled(self, consumer_id):
 		with self._local_storage_lock:
-			self._unhandled_messages.append((queue, message))
+			return self._unhandled_messages.items()
 
-		conn = self._conn()
-		cur = conn.cursor()
-		try:
-			sql = """INSERT INTO p2p_message (id, message, message_id,
-						message_name, queue, is_ingoing, in_is_handled, in_consumer_id)
-					VALUES
-						(NULL, ?, ?, ?, ?, ?, ?, ?)"""
+
+	def find_unhandled(self, name, server_id):
+		'''
+		Find the first unhandled message with the name, addressed to `server_id` 
+		(or without server_id in body)
+		@return: (queue, message) or None
+		'''
+		with self._local_storage_lock:
+			return self._unhandled_messages.find(name, server_id)
 
 
-			#self._logger.debug('Representation mes: %s', repr(str(message)))
-			cur.execute(sql, [message.toxml().decode('utf-8'), message.id, message.name, queue, 1, 0, consumer_id])
-			'''
-			cur.execute(sql, [str(message), message.id.decode('utf-8'),
-					message.name.decode('utf-8'), queue.encode('utf-8'), 1, 0,
-					consumer_id.encode('utf-8')])
-			'''
-			if message.meta.has_key(MetaOptions.REQUEST_ID):
-				cur.execute("""UPDATE p2p_message
-						SET response_uuid = ? WHERE message_id = ?""",
-					[message.id, message.meta[MetaOptions.REQUEST_ID]])
+	def wait_unhandled(self, version=None, timeout=None):
+		'''
+		Block until unhandled messages list changes after `version`
+		@return: current version of unhandled messages list
+		'''
+		with self._unhandled_cond:
+			if version is not None and version == self._unhandled_version:
+				self._unhandled_cond.wait(timeout)
+			return self._unhandled_version
 
-			self._logger.debug("Commiting put_ingoing")
-			conn.commit()
-			self._logger.debug("Commited put_ingoing")
-		finally:
-			cur.close()
 
+	def notify_unhandled(self):
+		'''
+		Wake up threads blocked in wait_unhandled
+		'''
+		with self._unhandled_cond:
+			self._unhandled_version += 1
+			self._unhandled_cond.notifyAll()
 
-	def get_unhandled(self, consumer_id):
+
+	def received_time(self, message_id):
 		with self._local_storage_lock:
-			ret = []
-			for queue, message in self._unhandled_messages:
-				msg_copy = P2pMessage()
-				msg_copy.fromxml(message.toxml())
-				ret.append((queue, msg_copy))
+			return self._received_at.get(message_id)
 
-			return ret
+
+	def _snapshot(self, message):
+		'''
+		Copy message once on enqueue, instead of xml round-trip on each get_unhandled
+		'''
+		ret = P2pMessage()
+		ret.id = message.id
+		ret.name = message.name
+		ret.meta = copy.deepcopy(message.meta)
+		ret.body = copy.deepcopy(message.body)
+		return ret
 
 
 	def _get_unhandled_from_db(self):
@@ -174,7 +329,7 @@ class _P2pMessageStore:
 			cur.execute(sql, [1, 0])
 
 			ret = []
-			for r in cur.fetchall():
+			for r in cur:
 				ret.append((r["queue"], self.load(r["message_id"], True)))
 			return ret
 		finally:
@@ -183,33 +338,20 @@ class _P2pMessageStore:
 
 	def mark_as_handled(self, message_id):
 		with self._local_storage_lock:
-			filter_fn = lambda x: x[1].id != message_id
-			self._unhandled_messages = filter(filter_fn, self._unhandled_messages)
+			self._unhandled_messages.remove(message_id)
+			self._received_at.pop(message_id, None)
 
-		conn = self._conn()
-		cur = conn.cursor()
-		try:
-			sql = """UPDATE p2p_message SET in_is_handled = ? 
-					WHERE message_id = ? AND is_ingoing = ?"""
-			cur.execute(sql, [1, message_id, 1])
-			conn.commit()
-		finally:
-			cur.close()
+		sql = """UPDATE p2p_message SET in_is_handled = ? 
+				WHERE message_id = ? AND is_ingoing = ?"""
+		self._execute_write(sql, [1, message_id, 1])
 
 
 	def put_outgoing(self, message, queue, sender):
-		conn = self._conn()
-		cur = conn.cursor()
-		try:
-			sql = """INSERT INTO p2p_message (id, message, message_id, message_name, queue, 
-						is_ingoing, out_is_delivered, out_delivery_attempts, out_sender) 
-					VALUES 
-						(NULL, ?, ?, ?, ?, ?, ?, ?, ?)"""
-
-			cur.execute(sql, [message.toxml().decode('utf-8'), message.id, message.name, queue, 0, 0, 0, sender])
-			conn.commit()
-		finally:
-			cur.close()
+		sql = """INSERT INTO p2p_message (id, message, message_id, message_name, queue, 
+					is_ingoing, out_is_delivered, out_delivery_attempts, out_sender) 
+				VALUES 
+					(NULL, ?, ?, ?, ?, ?, ?, ?, ?)"""
+		self._execute_write(sql, [message.toxml().decode('utf-8'), message.id, message.name, queue, 0, 0, 0, sender])
 
 
 	def get_undelivered(self, sender):
@@ -222,7 +364,7 @@ class _P2pMessageStore:
 					WHERE is_ingoing = ? AND out_is_delivered = ? AND out_sender = ? ORDER BY id"""
 			cur.execute(sql, [0, 0, sender])
 			ret = []
-			for r in cur.fetchall():
+			for r in cur:
 				ret.append((r[0], self.load(r[1], False)))
 			return ret
 		finally:
@@ -236,17 +378,11 @@ class _P2pMessageStore:
 		return self._mark_as_delivered(message_id, 0)
 
 	def _mark_as_delivered (self, message_id, delivered):
-		conn = self._conn()
-		cur = conn.cursor()
-		try:
-			sql = """UPDATE p2p_message SET out_delivery_attempts = out_delivery_attempts + 1, 
-						out_last_attempt_time = datetime('now'), out_is_delivered = ? 
-					WHERE 
-						message_id = ? AND is_ingoing = ?"""
-			cur.execute(sql, [int(bool(delivered)), message_id, 0])
-			conn.commit()
-		finally:
-			cur.close()
+		sql = """UPDATE p2p_message SET out_delivery_attempts = out_delivery_attempts + 1, 
+					out_last_attempt_time = datetime('now'), out_is_delivered = ? 
+				WHERE 
+					message_id = ? AND is_ingoing = ?"""
+		self._execute_write(sql, [int(bool(delivered)), message_id, 0])
 
 	def load(self, message_id, is_ingoing):
 		cur = self._conn().cursor()
@@ -266,9 +402,7 @@ class _P2pMessageStore:
 
 	def is_handled(self, message_id):
 		with self._local_storage_lock:
-			filter_fn = lambda x: x[1].id == message_id
-			filtered = filter(filter_fn, self._unhandled_messages)
-			return not filtered
+			return message_id not in self._unhandled_messages
 
 		'''
 		cur = self._conn().cursor()
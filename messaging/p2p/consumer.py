@@ -32,6 +32,12 @@ class P2pMessageConsumer(MessageConsumer):
 	handler_locked = False
 	handler_status = 'stopped'
 	handing_message_id = None	
+	dispatch_stats = None
+	'''
+	Message dispatch latency (time between receive and handling start), seconds
+	'''
+
+	IDLE_TIMEOUT = 1
 	
 	def __init__(self, endpoint=None, msg_handler_enabled=True):
 		MessageConsumer.__init__(self)
@@ -44,6 +50,7 @@ class P2pMessageConsumer(MessageConsumer):
 			self._handler_thread = None
 		self.message_to_ack = None
 		self.ack_event = threading.Event()
+		self.dispatch_stats = dict(count=0, last=0.0, max=0.0, total=0.0)
 		#self._not_empty = threading.Event()
 			
 	def start(self):
@@ -153,15 +160,17 @@ class P2pMessageConsumer(MessageConsumer):
 
 		self._logger.debug("Shutdown message handler")
 		self.handler_locked = True
+		P2pMessageStore().notify_unhandled()
 		if not force:
 			t = 120
 			self._logger.debug('Waiting for message handler to complete it`s task. Timeout: %d seconds', t)
 			wait_until(lambda: self.handler_status in ('idle', 'stopped'), 
 					timeout=t, error_text='Message consumer is busy', logger=self._logger)
 		
+		store = P2pMessageStore()
 		if self.handing_message_id:
-			store = P2pMessageStore()
 			store.mark_as_handled(self.handing_message_id)
+		store.flush()
 	
 		if self._handler_thread:
 			self._handler_thread.join()
@@ -172,6 +181,7 @@ class P2pMessageConsumer(MessageConsumer):
 	def _handle_one_message(self, message, queue, store):
 		try:
 			self.handler_status = 'running'					
+			self._update_dispatch_stats(message, store)
 			self._logger.debug('Notify message listeners (message_id: %s)', message.id)
 			self.handing_message_id = message.id
 			for ln in list(self.listeners):
@@ -184,10 +194,25 @@ class P2pMessageConsumer(MessageConsumer):
 			self.handler_status = 'idle'
 			self.handing_message_id = None
 		
+	def _update_dispatch_stats(self, message, store):
+		received = store.received_time(message.id)
+		if received is None:
+			# Message was loaded from database after restart
+			return
+		latency = time.time() - received
+		stats = self.dispatch_stats
+		stats['count'] += 1
+		stats['last'] = latency
+		stats['max'] = max(stats['max'], latency)
+		stats['total'] += latency
+		self._logger.debug('Message dispatch latency: %.3f seconds (message_id: %s)', 
+						latency, message.id)
+
 	def wait_acknowledge(self, message):
 		self.message_to_ack = message
 		self.return_on_ack = False
 		self.ack_event.clear()
+		P2pMessageStore().notify_unhandled()
 		self._logger.debug('Waiting message acknowledge event: %s', message.name)
 		self.ack_event.wait()
 		self._logger.debug('Fired message acknowledge event: %s', message.name)
@@ -217,24 +242,29 @@ class P2pMessageConsumer(MessageConsumer):
 		
 		self._logger.debug('Starting message handler')
 		
+		version = None
 		while self.running:
+			# Sleep until new message arrives or handler state changes
+			version = store.wait_unhandled(version, self.IDLE_TIMEOUT)
+			if not self.running:
+				break
 			if not self.handler_locked:
 				try:
 					if self.message_to_ack:
-						for queue, message in store.get_unhandled(self.endpoint):
-							sid = self.message_to_ack.meta['server_id']
-							if message.name == self.message_to_ack.name and \
-									message.body.get('server_id', sid) == sid:
-								self._logger.debug('Going to handle_one_message. Thread: %s', threading.currentThread().getName())
-								self._handle_one_message(message, queue, store)
-								self._logger.debug('Completed handle_one_message. Thread: %s', threading.currentThread().getName())
-								
-								self.message_to_ack = None
-								self.ack_event.set()
-								if self.return_on_ack:
-									return
-								break
-						time.sleep(0.1)
+						sid = self.message_to_ack.meta['server_id']
+						found = store.find_unhandled(self.message_to_ack.name, sid)
+						if found:
+							queue, message = found
+							self._logger.debug('Going to handle_one_message. Thread: %s', threading.currentThread().getName())
+							self._handle_one_message(message, queue, store)
+							self._logger.debug('Completed handle_one_message. Thread: %s', threading.currentThread().getName())
+							
+							self.message_to_ack = None
+							self.ack_event.set()
+							if self.return_on_ack:
+								return
+							# Don't wait, other messages may be already pending
+							version = None
 						continue
 					
 					for queue, message in store.get_unhandled(self.endpoint):
@@ -242,9 +272,6 @@ class P2pMessageConsumer(MessageConsumer):
 												
 				except (BaseException, Exception), e:
 					self._logger.exception(e)
-			time.sleep(0.1)
 			
 		self.handler_status = 'stopped'
-		self._logger.debug('Message handler stopped')		
-
-			
+		self._logger.debug('Message handler stopped')
@@ -4,7 +4,10 @@ Created on Dec 5, 2009
 @author: marat
 '''
 
+from __future__ import with_statement
+
 import logging
+import random
 import threading
 import time
 import uuid
@@ -12,7 +15,7 @@ import urllib
 import urllib2
 
 from scalarizr import messaging, util
-from scalarizr.messaging import p2p
+from scalarizr.messaging import p2p, Messages, Queues
 from scalarizr.util import urltool
 import sys
 
@@ -22,13 +25,24 @@ class P2pMessageProducer(messaging.MessageProducer):
 	retries_progression = None
 	no_retry = False
 	sender = 'daemon'
+	async_delivery = False
+	'''
+	When True, send() returns right after message is stored, 
+	and background thread delivers undelivered messages in order
+	'''
 	_store = None
 	_logger = None
 	_stop_delivery = None
+
+	BACKOFF_BASE = 1
+	BACKOFF_MAX = 300
+	LOG_BATCH_ENTRIES = 500
+	IDLE_TIMEOUT = 30
 	
-	def __init__(self, endpoint=None, retries_progression=None):
+	def __init__(self, endpoint=None, retries_progression=None, async_delivery=False):
 		messaging.MessageProducer.__init__(self)
 		self.endpoint = endpoint
+		self.async_delivery = async_delivery
 		if retries_progression:
 			self.retries_progression = util.split_ex(retries_progression, ",")
 		else:
@@ -40,16 +54,41 @@ class P2pMessageProducer(messaging.MessageProducer):
 		
 		self._local = threading.local()
 		self._local_defaults = dict(interval=None, next_retry_index=0, delivered=False)
+		self._http = urltool.HTTPConnectionPool()
+
+		self._deliverer = None
+		self._deliverer_lock = threading.Lock()
+		self._wake_deliverer = threading.Event()
+		self._delivery_waiters = {}
 
 	def shutdown(self):
 		self._stop_delivery.set()
+		if self._deliverer:
+			self._wake_deliverer.set()
+			self._deliverer.join(5)
+		self._http.close()
+
+	def connection_stats(self):
+		'''
+		@return: dict with number of HTTP connections opened and reused
+		'''
+		return dict(opened=self._http.opened, reused=self._http.reused)
 	
-	def send(self, queue, message):
+	def send(self, queue, message, wait=False):
+		'''
+		@param wait: In async delivery mode, block until message is delivered.
+		Use it when next actions depends on delivery (ex: crypto key rotation)
+		'''
 		self._logger.debug("Sending message '%s' into queue '%s'", message.name, queue)
 
 		if message.id is None:
 			message.id = str(uuid.uuid4())
 		self.fire("before_send", queue, message)
+
+		if self.async_delivery:
+			self._send_async(queue, message, wait)
+			return
+
 		self._store.put_outgoing(message, queue, self.sender)
 		
 		if not self.no_retry:
@@ -77,6 +116,108 @@ class P2pMessageProducer(messaging.MessageProducer):
 			self._send0(queue, message, self._delivered_cb, self._undelivered_cb_raises)
 
 
+	def _send_async(self, queue, message, wait):
+		waiter = None
+		if wait:
+			waiter = threading.Event()
+			with self._deliverer_lock:
+				self._delivery_waiters[message.id] = waiter
+		self._store.put_outgoing(message, queue, self.sender)
+		self._start_deliverer()
+		self._wake_deliverer.set()
+		if waiter:
+			while not waiter.isSet() and not self._stop_delivery.isSet():
+				waiter.wait(1)
+
+	def _start_deliverer(self):
+		with self._deliverer_lock:
+			if not self._deliverer:
+				self._deliverer = threading.Thread(target=self._deliver_undelivered, 
+												name='MessageDeliverer')
+				self._deliverer.setDaemon(True)
+				self._deliverer.start()
+
+	def _deliver_undelivered(self):
+		failures = 0
+		while not self._stop_delivery.isSet():
+			self._wake_deliverer.wait(self.IDLE_TIMEOUT)
+			self._wake_deliverer.clear()
+			try:
+				batch = self._coalesce(self._store.get_undelivered(self.sender))
+			except (BaseException, Exception), e:
+				self._logger.warning('Cannot load undelivered messages: %s', e)
+				continue
+
+			for queue, message, merged_ids in batch:
+				if self._stop_delivery.isSet():
+					break
+				result = []
+				self._send0(queue, message, 
+						lambda *args: result.append(True), lambda *args: result.append(False))
+				if not result or not result[0]:
+					# Retry from the head of queue to keep delivery order
+					failures += 1
+					interval = self._get_backoff_interval(failures)
+					self._logger.debug("Sleep %.1f seconds before next attempt", interval)
+					self._stop_delivery.wait(interval)
+					self._wake_deliverer.set()
+					break
+				failures = 0
+				for message_id in merged_ids:
+					self._store.mark_as_delivered(message_id)
+				self._notify_delivered([message.id] + merged_ids)
+
+	def _get_backoff_interval(self, failures):
+		interval = min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** min(failures, 16))
+		# Jitter prevents farm servers to retry simultaneously
+		return interval / 2.0 + random.uniform(0, interval / 2.0)
+
+	def _notify_delivered(self, message_ids):
+		with self._deliverer_lock:
+			for message_id in message_ids:
+				waiter = self._delivery_waiters.pop(message_id, None)
+				if waiter:
+					waiter.set()
+
+	def _coalesce(self, pending):
+		'''
+		Merge pending Log messages into batches and skip OperationProgress 
+		superseded by a later progress of the same operation step.
+		@return: [(queue, message, ids of messages merged into it), ...]
+		'''
+		def progress_key(message):
+			if message.name == Messages.OPERATION_PROGRESS and message.body.get('status') == 'running':
+				return (message.body.get('id'), message.body.get('phase'), message.body.get('step'))
+
+		latest_progress = {}
+		for queue, message in pending:
+			key = progress_key(message)
+			if key:
+				latest_progress[key] = message.id
+
+		ret = []
+		superseded = {}
+		log_batch = None
+		for queue, message in pending:
+			key = progress_key(message)
+			if key and latest_progress[key] != message.id:
+				superseded.setdefault(latest_progress[key], []).append(message.id)
+				continue
+
+			if message.name == Messages.LOG and queue == Queues.LOG:
+				entries = message.body.get('entries') or []
+				if log_batch and len(log_batch[1].body['entries']) + len(entries) <= self.LOG_BATCH_ENTRIES:
+					log_batch[1].body['entries'] += entries
+					log_batch[2].append(message.id)
+					continue
+				message.body['entries'] = list(entries)
+				log_batch = (queue, message, [])
+				ret.append(log_batch)
+				continue
+
+			ret.append((queue, message, superseded.get(message.id, [])))
+		return ret
+
 	def _undelivered_cb_raises(self, queue, message, ex):
 		raise ex
 
@@ -107,9 +248,7 @@ class P2pMessageProducer(messaging.MessageProducer):
 				data = f(self, queue, xml, headers)
 			
 			url = self.endpoint + "/" + queue
-			req = urllib2.Request(url, data, headers)
-			opener = urllib2.build_opener(urltool.HTTPRedirectHandler())
-			opener.open(req)
+			self._post(url, data, headers)
 			
 			self._message_delivered(queue, message, success_callback)
 		
@@ -142,6 +281,18 @@ class P2pMessageProducer(messaging.MessageProducer):
 				fail_callback(queue, message, e)
 
 
+	def _post(self, url, data, headers):
+		try:
+			self._http.post(url, data, headers)
+		except urllib2.HTTPError, e:
+			if e.code not in (301, 302, 303, 305, 307):
+				raise
+			# Leave redirects to urllib2
+			req = urllib2.Request(url, data, headers)
+			opener = urllib2.build_opener(urltool.HTTPRedirectHandler())
+			opener.open(req)
+
+
 	def _message_delivered(self, queue, message, callback=None):
 		if message.name not in ('Log', 'OperationDefinition', 
 							'OperationProgress', 'OperationResult'):
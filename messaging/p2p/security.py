@@ -27,9 +27,8 @@ class P2pMessageSecurity(object):
 	def in_protocol_filter(self, consumer, queue, message):
 		try:
 			# Decrypt message
-			cnf = bus.cnf			
 			self._logger.debug('Decrypting message')
-			crypto_key = binascii.a2b_base64(cnf.read_key(self.crypto_key_path))
+			crypto_key = cryptotool.read_key(self.crypto_key_path)
 			xml = cryptotool.decrypt(message, crypto_key)
 			
 			# Remove special chars
@@ -41,9 +40,8 @@ class P2pMessageSecurity(object):
 	def out_protocol_filter(self, producer, queue, message, headers):
 		try:
 			# Encrypt message
-			cnf = bus.cnf
 			self._logger.debug('Encrypting message')
-			crypto_key = binascii.a2b_base64(cnf.read_key(self.crypto_key_path))
+			crypto_key = cryptotool.read_key(self.crypto_key_path)
 			data = cryptotool.encrypt(message, crypto_key)
 			
 			# Generate signature
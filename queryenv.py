@@ -3,9 +3,13 @@ Created on Dec 23, 2009
 
 @author: Dmytro Korsakov
 '''
+from __future__ import with_statement
+
 import binascii
+import copy
 import logging
 import sys
+import threading
 import urllib
 import urllib2
 import time
@@ -29,13 +33,49 @@ class QueryEnvService(object):
 	api_version = None
 	key_path = None
 	server_id = None
-	
-	def __init__(self, url, server_id=None, key_path=None, api_version='2012-04-17'):
+
+	CACHE_TTL = {
+		'list-roles': 30,
+		'list-role-params': 300,
+		'list-virtualhosts': 300,
+		'get-scaling-metrics': 300
+	}
+	'''
+	Seconds to keep a response of a command. Commands not listed here are never cached
+	'''
+	
+	CACHE_INVALIDATE_ON = {
+		'HostInit': ('list-roles',),
+		'HostUp': ('list-roles',),
+		'HostDown': ('list-roles',),
+		'BeforeHostTerminate': ('list-roles',),
+		'DbMsr_NewMasterUp': ('list-roles',),
+		'DbMsr_PromoteToMaster': ('list-roles',),
+		'DbMsr_PromoteToMasterResult': ('list-roles',),
+		'Mysql_NewMasterUp': ('list-roles',),
+		'Mysql_PromoteToMaster': ('list-roles',),
+		'Mysql_PromoteToMasterResult': ('list-roles',),
+		'VhostReconfigure': ('list-virtualhosts',),
+		'UpdateServiceConfiguration': ('list-role-params',)
+	}
+	'''
+	Incoming messages that make cached responses obsolete
+	'''
+	
+	def __init__(self, url, server_id=None, key_path=None, api_version='2012-04-17', cache_ttl=None):
 		self._logger = logging.getLogger(__name__)
 		self.url = url if url[-1] != "/" else url[0:-1]
 		self.server_id = server_id		
 		self.key_path = key_path
 		self.api_version = api_version
+		self.cache_ttl = dict(self.CACHE_TTL)
+		if cache_ttl:
+			self.cache_ttl.update(cache_ttl)
+		self._cache = {}
+		self._cache_cond = threading.Condition(threading.Lock())
+		self._inflight = set()
+		self._generation = {}
+		self.cache_stats = dict(hits=0, misses=0, shared=0, unchanged=0)
 	
 	def fetch(self, command, **params):
 		"""
@@ -50,9 +90,7 @@ class QueryEnvService(object):
 			for key, value in params.items():
 				request_body[key] = value
 		
-		file = open(self.key_path)
-		key = binascii.a2b_base64(file.read())
-		file.close()
+		key = cryptotool.read_key(self.key_path)
 
 		signature, timestamp = cryptotool.sign_http_request(request_body, key)		
 		
@@ -93,8 +131,10 @@ class QueryEnvService(object):
 		return resp_body
 	
 	
-	def list_roles(self, role_name=None, behaviour=None, with_init=None):
+	def list_roles(self, role_name=None, behaviour=None, with_init=None, cached=True):
 		"""
+		@param cached: False to ask QueryEnv right now, e.g. when polling until 
+		replication master appears
 		@return Role[]
 		"""
 		parameters = {}
@@ -105,7 +145,7 @@ class QueryEnvService(object):
 		if None != with_init:
 			parameters["showInitServers"] = "1"
 			
-		return self._request("list-roles", parameters, self._read_list_roles_response)
+		return self._request("list-roles", parameters, self._read_list_roles_response, cached=cached)
 	
 	def list_role_params(self, name=None):
 		"""
@@ -202,10 +242,84 @@ class QueryEnvService(object):
 		"""
 		return {'params':self._request("get-global-config", {}, self._read_get_global_config_response)}
 
-	def _request (self, command, params={}, response_reader=None, response_reader_args=None):
-		xml = self.fetch(command, **params)
+	def _request (self, command, params={}, response_reader=None, response_reader_args=None, cached=True):
 		response_reader_args = response_reader_args or ()
-		return response_reader(xml, *response_reader_args)
+		ttl = self.cache_ttl.get(command)
+		if not ttl:
+			xml = self.fetch(command, **params)
+			return response_reader(xml, *response_reader_args)
+		
+		key = (command, tuple(sorted(params.items())), tuple(response_reader_args))
+		if not cached:
+			# Bypass the cache, but let the fresh response serve the next callers 
+			with self._cache_cond:
+				generation = self._generation.get(command, 0)
+			xml = self.fetch(command, **params)
+			result = response_reader(xml, *response_reader_args)
+			with self._cache_cond:
+				if self._generation.get(command, 0) == generation:
+					self._cache[key] = (time.time() + ttl, xml, result)
+			return copy.deepcopy(result)
+
+		with self._cache_cond:
+			while True:
+				entry = self._cache.get(key)
+				if entry and entry[0] > time.time():
+					self.cache_stats['hits'] += 1
+					return copy.deepcopy(entry[2])
+				if key not in self._inflight:
+					break
+				# The same request is already on the wire. Wait for its response
+				self._cache_cond.wait()
+				entry = self._cache.get(key)
+				if entry and entry[0] > time.time():
+					self.cache_stats['shared'] += 1
+					return copy.deepcopy(entry[2])
+			self._inflight.add(key)
+			self.cache_stats['misses'] += 1
+			generation = self._generation.get(command, 0)
+		
+		try:
+			xml = self.fetch(command, **params)
+			if entry and entry[1] == xml:
+				# Response didn't change since the last time. Skip parsing 
+				self.cache_stats['unchanged'] += 1
+				result = entry[2]
+			else:
+				result = response_reader(xml, *response_reader_args)
+			with self._cache_cond:
+				if self._generation.get(command, 0) == generation:
+					self._cache[key] = (time.time() + ttl, xml, result)
+			return copy.deepcopy(result)
+		finally:
+			with self._cache_cond:
+				self._inflight.discard(key)
+				self._cache_cond.notifyAll()
+
+
+	def invalidate(self, *commands):
+		'''
+		Drop cached responses of the given commands (all commands when called without arguments)
+		'''
+		with self._cache_cond:
+			commands = commands or self.cache_ttl.keys()
+			for command in commands:
+				self._generation[command] = self._generation.get(command, 0) + 1
+			for key in self._cache.keys():
+				if key[0] in commands:
+					del self._cache[key]
+
+
+	def on_message(self, message, queue):
+		'''
+		Message consumer listener. Invalidates responses made obsolete by an incoming message
+		'''
+		commands = self.CACHE_INVALIDATE_ON.get(message.name)
+		if commands:
+			self._logger.debug('Invalidate QueryEnv cache for %s (message: %s)', 
+							', '.join(commands), message.name)
+			self.invalidate(*commands)
+
 
 	def _read_get_global_config_response(self, xml):
 		"""
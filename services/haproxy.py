@@ -283,6 +283,12 @@ class HAProxyCfg(filetool.ConfigurationFile):
 		self.conf = metaconf.Configuration('haproxy')
 		self.cnf_path = path or HAPROXY_CFG_PATH
 		self.conf.read(self.cnf_path)
+		self._reset_index()
+
+	def __str__(self):
+		fp = cStringIO.StringIO()
+		self.conf.write_fp(fp, close=False)
+		return fp.getvalue()
 
 	def __getitem__(self, name):
 		cls = self.section_group
@@ -375,6 +381,95 @@ class HAProxyCfg(filetool.ConfigurationFile):
 		LOG.debug('services.haproxy.HAProxyCfg.reload path=`%s`', self.cnf_path)
 		self.conf = metaconf.Configuration('haproxy')
 		self.conf.read(self.cnf_path)
+		self._reset_index()
+
+
+	def backend_servers(self, backend):
+		'''
+		Servers of backend section, looked up through dict indexes 
+		instead of xpath walking
+		@param backend: full backend name, e.g. `scalr:backend:role:1234:tcp:2254`
+		@return: dict {<server name>: <server dict>}
+		'''
+		return dict((name, _serializers['server'].unserialize(el.text.split(None, 1)[1] 
+												if ' ' in el.text.strip() else ''))
+					for name, el in self._servers_index(backend).items())
+
+
+	def set_server(self, backend, name, server):
+		'''Add or update server in backend section'''
+		index = self._servers_index(backend)
+		line = '%s %s' % (name, _serializers['server'].serialize(dict(server)))
+		if name in index:
+			index[name].text = line
+		else:
+			section = self._section_element('backend', backend)
+			el = metaconf.ET.Element('server')
+			el.attrib['mc_type'] = 'option'
+			el.text = line
+			children = list(section)
+			pos = len(children)
+			for i in range(len(children) - 1, -1, -1):
+				if children[i].tag == 'server':
+					# Right after the last server
+					pos = i + 1
+					break
+			else:
+				# Before trailing blank lines
+				while pos and children[pos - 1].tag == '':
+					pos -= 1
+			section.insert(pos, el)
+			index[name] = el
+			self._index_sizes[('backend', backend)] = len(section)
+
+
+	def remove_server(self, backend, name):
+		'''
+		Remove server from backend section
+		@return: True if server was found
+		'''
+		index = self._servers_index(backend)
+		if name not in index:
+			return False
+		section = self._section_element('backend', backend)
+		section.remove(index.pop(name))
+		self._index_sizes[('backend', backend)] = len(section)
+		return True
+
+
+	def _reset_index(self):
+		self._sections = None
+		self._servers = {}
+		self._index_sizes = {}
+
+
+	def _section_element(self, type_, name):
+		root = self.conf.etree.getroot()
+		if self._sections is None or self._index_sizes.get(None) != len(root):
+			# Sections were added or removed through metaconf
+			self._sections = {}
+			for el in root:
+				if el.attrib.get('mc_type') == 'section':
+					self._sections[(metaconf.unquote(el.tag), (el.text or '').strip())] = el
+			self._index_sizes = {None: len(root)}
+			self._servers = {}
+		try:
+			return self._sections[(type_, name)]
+		except KeyError:
+			raise KeyError('Section `%s %s` not found' % (type_, name))
+
+
+	def _servers_index(self, backend):
+		section = self._section_element('backend', backend)
+		key = ('backend', backend)
+		if key not in self._servers or self._index_sizes.get(key) != len(section):
+			index = {}
+			for el in section:
+				if el.tag == 'server' and el.text and el.text.strip():
+					index[el.text.split()[0]] = el
+			self._servers[key] = index
+			self._index_sizes[key] = len(section)
+		return self._servers[key]
 
 
 class OptionSerializer(object):
@@ -548,7 +643,8 @@ class StatSocket(object):
 	'''
 	haproxy unix socket API
 	- one-to-one naming
-	- connect -> request -> disconnect
+	- persistent connection in interactive mode, reconnects on failure
+	- pipelined commands: execute() sends several commands in one write
 
 	Create object:
 	>> ss = StatSocket('/var/run/haproxy-stats.sock')
@@ -557,24 +653,106 @@ class StatSocket(object):
 	>> ss.show_stat()
 	[{'status': 'UP', 'lastchg': '68', 'weight': '1', 'slim': '', 'pid': '1', 'rate_lim': '', 
 	'check_duration': '0', 'rate': '0', 'req_rate': '', 'check_status': 'L4OK', 'econ': '0', 
-	...'''
+	...
+
+	Change server state (requires `stats socket ... level admin`):
+	>> ss.disable_server('scalr:backend:role:1234:tcp:80', '10-0-0-1')
+	'''
+
+	PROMPT = '\n> '
 
 	def __init__(self, address='/var/run/haproxy-stats.sock'):
+		self.adress = address
+		self.sock = None
 		try:
-			self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-			self.sock.connect(address)
-			self.adress = address
+			self._connect()
 		except:
 			raise Exception, "Couldn't connect to socket on address: %s%s" % (address, sys.exc_info()[1]), sys.exc_info()[2]
 
 
+	def _connect(self):
+		self.close()
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.connect(self.adress)
+		# Interactive mode keeps connection open between commands
+		self.sock.sendall('prompt\n')
+		self._read_responses(1)
+
+
+	def _read_responses(self, count):
+		buf = ''
+		responses = []
+		while len(responses) < count:
+			data = self.sock.recv(65536)
+			if not data:
+				raise socket.error('Connection closed by haproxy')
+			buf += data
+			while self.PROMPT in buf and len(responses) < count:
+				response, buf = buf.split(self.PROMPT, 1)
+				responses.append(response)
+		return responses
+
+
+	def close(self):
+		if self.sock:
+			try:
+				self.sock.close()
+			except socket.error:
+				pass
+			self.sock = None
+
+
+	def execute(self, *commands):
+		'''
+		Send commands in one write and read their responses
+		@return: list of response strings, one per command
+		'''
+		data = ''.join('%s\n' % cmd for cmd in commands)
+		for attempt in (1, 2):
+			try:
+				if not self.sock:
+					self._connect()
+				self.sock.sendall(data)
+				return self._read_responses(len(commands))
+			except socket.error:
+				self.close()
+				if attempt == 2:
+					raise
+
+
+	def _execute_checked(self, *commands):
+		for cmd, response in zip(commands, self.execute(*commands)):
+			if response.strip():
+				# Successful state commands return nothing
+				raise HAProxyError('`%s` failed: %s' % (cmd, response.strip()))
+
+
+	def disable_server(self, backend, server):
+		self._execute_checked('disable server %s/%s' % (backend, server))
+
+
+	def enable_server(self, backend, server):
+		self._execute_checked('enable server %s/%s' % (backend, server))
+
+
+	def set_weight(self, backend, server, weight):
+		self._execute_checked('set weight %s/%s %s' % (backend, server, weight))
+
+
+	def drain_server(self, backend, server):
+		'''
+		Stop sending new sessions to server and put it into maintenance mode
+		'''
+		self._execute_checked('set weight %s/%s 0' % (backend, server), 
+							'disable server %s/%s' % (backend, server))
+
+
 	def show_stat(self):
 		'''
 		@rtype: list[dict]
 		'''
 		try:
-			self.sock.send('show stat\n')
-			stat = self.sock.makefile('r').read()
+			stat = self.execute('show stat')[0]
 
 			fieldnames = filter(None, stat[2:stat.index('\n')].split(','))
 			reader = csv.DictReader(cStringIO.StringIO(stat[stat.index('\n'):]), fieldnames)
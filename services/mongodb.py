@@ -3,6 +3,8 @@ Created on Sep 30, 2011
 
 @author: Dmytro Korsakov
 '''
+from __future__ import with_statement
+
 import re
 import os
 import time
@@ -10,6 +12,7 @@ import glob
 import shutil
 import logging
 import functools
+import threading
 
 
 from scalarizr.config import BuiltinBehaviours
@@ -193,7 +196,7 @@ class MongoDB(BaseService):
 		@return (host:port)
 		'''
 		self.cli.initiate_rs()
-		wait_until(lambda: self.is_replication_master, sleep=5, logger=self._logger,
+		self.rs_monitor.wait_until(lambda state: state.is_primary, logger=self._logger,
 					timeout=120, start_text='Wait until node becomes replication primary')		
 		self._logger.debug('Server became replication master')
 
@@ -377,6 +380,14 @@ class MongoDB(BaseService):
 		self._set('cli', obj)
 
 
+	@property
+	def rs_monitor(self):
+		'''
+		@rtype: ReplicaSetMonitor
+		'''
+		return ReplicaSetMonitor.find(self.cli)
+
+
 	def _get_working_directory(self):
 		return self._get('working_directory', WorkingDirectory.find, self.config)
 		
@@ -1085,4 +1096,215 @@ class MongoCLI(object):
 
 	@autoreconnect
 	def list_shards(self):
-		return list(self.connection.config.shards.find())
\ No newline at end of file
+		return list(self.connection.config.shards.find())
+
+
+class ReplicaSetState(object):
+	'''
+	replSetGetStatus snapshot. `version` grows on each transition:
+	change of member states, health, error messages or of the command error
+	'''
+	version = None
+	status = None
+	error = None
+	timestamp = None
+
+	def __init__(self, version, status=None, error=None, timestamp=None):
+		self.version = version
+		self.status = status or {}
+		self.error = error
+		self.timestamp = timestamp or time.time()
+		self.members = dict((m['name'], m) for m in self.status.get('members', []))
+
+
+	@property
+	def my_state(self):
+		return int(self.status['myState']) if 'myState' in self.status else None
+
+
+	@property
+	def is_primary(self):
+		return self.my_state == 1
+
+
+	@property
+	def primary(self):
+		for name, member in self.members.items():
+			if int(member['state']) == 1:
+				return name
+		return None
+
+
+	def member_state(self, name):
+		member = self.members.get(name)
+		return int(member['state']) if member else None
+
+
+	@property
+	def key(self):
+		return (self.error, self.my_state, tuple(sorted(
+				(name, int(m['state']), int(m.get('health', 1)), m.get('errmsg'))
+				for name, m in self.members.items())))
+
+
+
+class ReplicaSetMonitor(object):
+	'''
+	Single replSetGetStatus poller per mongod shared by all watchers and waiters.
+	Polls every `interval` seconds while there are subscribers, every
+	`wait_interval` while someone blocks in wait(), and not at all otherwise.
+
+	Example:
+		monitor = ReplicaSetMonitor.find(MongoCLI.find(REPLICA_DEFAULT_PORT))
+		monitor.wait_until(lambda state: state.my_state == 1, timeout=180)
+	'''
+
+	interval = 3
+	wait_interval = 1
+
+	_instances = {}
+	_instances_lock = threading.Lock()
+
+	def __init__(self, cli):
+		self.cli = cli
+		self._logger = logging.getLogger(__name__)
+		self._state = None
+		self._subscribers = {}
+		self._waiters = 0
+		self._cond = threading.Condition()
+		self._wake = threading.Event()
+		self._thread = None
+
+
+	@classmethod
+	def find(cls, cli):
+		with cls._instances_lock:
+			if cli.port not in cls._instances:
+				cls._instances[cli.port] = cls(cli)
+			return cls._instances[cli.port]
+
+
+	@property
+	def state(self):
+		'''
+		Last snapshot, None if never polled
+		@rtype: ReplicaSetState
+		'''
+		return self._state
+
+
+	def refresh(self):
+		'''
+		Polls server now and notifies subscribers that haven't seen the result
+		@rtype: ReplicaSetState
+		'''
+		status = error = None
+		started = time.time()
+		try:
+			status = self.cli.get_rs_status()
+			if 'errmsg' in status and not int(status.get('ok', 0)):
+				error = status['errmsg']
+		except (BaseException, Exception), e:
+			error = str(e)
+
+		with self._cond:
+			prev = self._state
+			state = ReplicaSetState(prev.version if prev else 0, status, error, started)
+			if not prev or prev.key != state.key:
+				state.version += 1
+				if prev:
+					self._logger.debug('Replica set state changed: %s -> %s', prev.key, state.key)
+			self._state = state
+			subscribers = [(callback, seen) for callback, seen in self._subscribers.items()
+						if seen != state.version]
+			for callback, _ in subscribers:
+				self._subscribers[callback] = state.version
+			self._cond.notify_all()
+
+		for callback, seen in subscribers:
+			try:
+				callback(prev if seen is not None else None, state)
+			except (BaseException, Exception), e:
+				self._logger.exception('Replica set subscriber %s failed: %s', callback, e)
+		return state
+
+
+	def subscribe(self, callback):
+		'''
+		callback(old_state, new_state) is called from the monitor thread with
+		the first state polled after subscription and then on every transition.
+		old_state is None on the first call
+		'''
+		with self._cond:
+			self._subscribers[callback] = None
+			self._start()
+			self._cond.notify_all()
+		self._wake.set()
+
+
+	def unsubscribe(self, callback):
+		with self._cond:
+			self._subscribers.pop(callback, None)
+
+
+	def wait(self, predicate, timeout=None):
+		'''
+		Blocks until predicate(state) returns true. Only states polled after
+		the call are checked, waiters started together share the same polls
+		@return: predicate result or None when timeout reached
+		'''
+		started = time.time()
+		deadline = started + timeout if timeout is not None else None
+		with self._cond:
+			self._waiters += 1
+			try:
+				self._start()
+				self._cond.notify_all()
+				self._wake.set()
+				last = self._state
+				while True:
+					remaining = None
+					if deadline is not None:
+						remaining = deadline - time.time()
+						if remaining <= 0:
+							return None
+					self._cond.wait(remaining)
+					if self._state is not last and self._state.timestamp >= started:
+						last = self._state
+						ret = predicate(last)
+						if ret:
+							return ret
+			finally:
+				self._waiters -= 1
+
+
+	def wait_until(self, predicate, timeout=None, logger=None, start_text=None, error_text=None):
+		'''
+		wait() that raises on timeout, with util.wait_until messages
+		'''
+		if start_text and logger:
+			logger.info('%s. (timeout: %d seconds)', start_text, timeout)
+		ret = self.wait(predicate, timeout)
+		if not ret:
+			msg = error_text + '. ' if error_text else ''
+			msg += 'Timeout: %d seconds reached' % (timeout, )
+			raise BaseException(msg)
+		return ret
+
+
+	def _start(self):
+		if not self._thread or not self._thread.isAlive():
+			self._thread = threading.Thread(target=self._run, name='ReplicaSetMonitor-%s' % self.cli.port)
+			self._thread.setDaemon(True)
+			self._thread.start()
+
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while not (self._subscribers or self._waiters):
+					self._cond.wait()
+				interval = self.wait_interval if self._waiters else self.interval
+			self._wake.clear()
+			self.refresh()
+			self._wake.wait(interval)
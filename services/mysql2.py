@@ -7,7 +7,10 @@ import glob
 import string
 import shutil
 import logging
+import tempfile
+import threading
 import subprocess
+import Queue
 
 from scalarizr import linux, storage2
 from scalarizr.linux import coreutils, pkgmgr
@@ -49,6 +52,7 @@ __mysql__.update({
 	'my.cnf': '/etc/my.cnf' if linux.os['family'] in ('RedHat', 'Oracle') else '/etc/mysql/my.cnf',
 	#'mysqld_exec': util.try_exec('/usr/sbin/mysqld', '/usr/libexec/mysqld')
 	'mysqldump_chunk_size': 200 * 1024 * 1024,
+	'mysqldump_parallelism': 2,
 	'stop_slave_timeout': 180,
 	'change_master_timeout': 60,
 	'defaults': {
@@ -434,6 +438,10 @@ backup.restore_types['xtrabackup'] = XtrabackupRestore
 
 class MySQLDumpBackup(backup.Backup):
 	'''
+	Streams `mysqldump` output through (p)gzip into cloud storage chunks,
+	nothing is written to disk. With file_per_database up to `parallelism` 
+	databases are dumped at the same time.
+	
 	Example:
 		bak = backup.backup(
 				type='mysqldump',
@@ -441,14 +449,22 @@ class MySQLDumpBackup(backup.Backup):
 		bak.run()
 	'''
 
+	upload_workers = 4
+	'''
+	Upload threads shared by concurrent dumps. Each of them keeps a chunk in tmpfs
+	'''
+	upload_retries = 3
+
 	def __init__(self,
 				cloudfs_dir=None,
 				file_per_database=True,
 				chunk_size=None,
+				parallelism=None,
 				**kwds):
 		super(MySQLDumpBackup, self).__init__(cloudfs_dir=cloudfs_dir, 
 				file_per_database=file_per_database, 
 				chunk_size=chunk_size or __mysql__['mysqldump_chunk_size'],
+				parallelism=parallelism or __mysql__['mysqldump_parallelism'],
 				**kwds)
 		self.features.update({
 			'start_slave': False
@@ -456,45 +472,139 @@ class MySQLDumpBackup(backup.Backup):
 
 
 	def _run(self):
-		client = mysql_svc.MySQLClient(
-					__mysql__['root_user'],
-					__mysql__['root_password'])
-		self._databases = client.list_databases()
-		transfer = LargeTransfer(self._gen_src, self._gen_dst, 'upload', 
-								tar_it=False, chunk_size=self.chunk_size)
-		transfer.run()
-		return backup.restore(type='mysqldump', 
-						files=transfer.result()['completed'])
-
-
-	def _gen_src(self):
 		if self.file_per_database:
-			for db_name in self._databases:
-				self._current_db = db_name
-				cmd = linux.build_cmd_args(
-					executable='/usr/bin/mysqldump',
-					params=__mysql__['mysqldump_options'].split() + [db_name])
-				mysql_dump = subprocess.Popen(cmd, bufsize=-1, 
-								stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-				yield mysql_dump.stdout
+			client = mysql_svc.MySQLClient(
+						__mysql__['root_user'],
+						__mysql__['root_password'])
+			databases = client.list_databases()
 		else:
-			cmd = linux.build_cmd_args(
-				executable='/usr/bin/mysqldump',
-				params=__mysql__['mysqldump_options'].split() + ['--all-databases'])
-			mysql_dump = subprocess.Popen(cmd, bufsize=-1, 
-							stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-			yield mysql_dump.stdout
+			databases = [None]
+
+		queue = Queue.Queue()
+		for db_name in databases:
+			queue.put(db_name)
+		self._files = []
+		self._errors = []
+		
+		num_threads = max(min(self.parallelism, len(databases)), 1)
+		LOG.info('Dumping %d database(s), %d at a time', len(databases), num_threads)
+		pool = []
+		for n in range(num_threads):
+			thread = threading.Thread(name='mysqldump-%s' % n, 
+									target=self._worker, args=(queue, num_threads))
+			thread.start()
+			pool.append(thread)
+		for thread in pool:
+			thread.join()
+		
+		if self._errors:
+			raise Error('Failed to dump databases: %s' % 
+						', '.join('%s (%s)' % item for item in self._errors))
+		return backup.restore(type='mysqldump', files=self._files)
+
+
+	def _worker(self, queue, num_threads):
+		while not self._errors:
+			try:
+				db_name = queue.get_nowait()
+			except Queue.Empty:
+				return
+			try:
+				self._dump(db_name, max(self.upload_workers / num_threads, 1))
+			except:
+				exc = sys.exc_info()[1]
+				LOG.exception('Failed to dump %s', db_name or 'all databases')
+				self._errors.append((db_name or 'all databases', exc))
+
+
+	def _dump(self, db_name, num_workers):
+		# Credentials go through a file, not argv visible in ps
+		defaults = tempfile.NamedTemporaryFile(prefix='mysqldump-', suffix='.cnf')
+		os.chmod(defaults.name, 0600)
+		quote = lambda value: '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+		defaults.write('[client]\nuser=%s\npassword=%s\n' % (
+					quote(__mysql__['root_user']), quote(__mysql__['root_password'])))
+		defaults.flush()
+		# Stderr is drained by the OS into a file, warnings can't block mysqldump
+		stderr = tempfile.TemporaryFile()
+		try:
+			params = ['--defaults-extra-file=%s' % defaults.name]
+			params += __mysql__['mysqldump_options'].split()
+			params += ['--databases', db_name] if db_name else ['--all-databases']
+			cmd = linux.build_cmd_args(executable='/usr/bin/mysqldump', params=params)
+			mysql_dump = subprocess.Popen(cmd, bufsize=-1, close_fds=True, 
+							stdout=subprocess.PIPE, stderr=stderr)
+			name = db_name or 'mysql'
+			
+			files = []
+			failed = []
+			def on_complete(src, dst, retry, chunk_num):
+				files.append(dict(
+						path=os.path.join(dst, os.path.basename(src)), 
+						size=os.path.getsize(src)))
+	
+			def on_error(src, dst, retry, chunk_num, exc_info):
+				# FileTransfer gives up after `retries` attempts, keeping the chunk in tmpfs
+				if retry > self.upload_retries or isinstance(exc_info[1], AssertionError):
+					failed.append((os.path.basename(src), exc_info[1]))
+					if mysql_dump.poll() is None:
+						mysql_dump.kill()
+			
+			transfer = LargeTransfer(_NamedStream(mysql_dump.stdout, name + '.sql'), 
+							os.path.join(self.cloudfs_dir, name), 'upload', 
+							tar_it=False, 
+							chunk_size=max(self.chunk_size / (1024 * 1024), 1),
+							num_workers=num_workers,
+							retries=self.upload_retries)
+			transfer.on(transfer_complete=on_complete, transfer_error=on_error)
+			try:
+				transfer.run()
+			except:
+				if mysql_dump.poll() is None:
+					mysql_dump.kill()
+				mysql_dump.wait()
+				raise
+			# When the chunk generator stopped early mysqldump gets SIGPIPE
+			mysql_dump.stdout.close()
+			mysql_dump.wait()
+			if failed:
+				raise Error('Failed to upload %s chunk(s): %s' % (len(failed),
+							', '.join('%s (%s)' % item for item in failed)))
+			if mysql_dump.returncode:
+				stderr.seek(0)
+				raise Error('mysqldump exited with code %s. %s' % 
+							(mysql_dump.returncode, stderr.read().strip()))
+			self._files.extend(files)
+		finally:
+			defaults.close()
+			stderr.close()
 
 
-	def _gen_dst(self):
-		while True:
-			if self.file_per_database:
-				yield os.path.join(self.cloudfs_dir, self._current_db)
-			else:
-				yield os.path.join(self.cloudfs_dir, 'mysql')
+class _NamedStream(object):
+	'''
+	Pipe file object that LargeTransfer names chunks after
+	'''
+	def __init__(self, fp, name):
+		self._fp = fp
+		self.name = name
+	
+	def read(self, size=-1):
+		return self._fp.read(size)
+
+	def fileno(self):
+		return self._fp.fileno()
+
+
+class MySQLDumpRestore(backup.Restore):
+	'''
+	Describes uploaded dump chunks. SQL dumps are loaded manually
+	'''
+	def __init__(self, files=None, **kwds):
+		super(MySQLDumpRestore, self).__init__(files=files or [], **kwds)
 
 
 backup.backup_types['mysqldump'] = MySQLDumpBackup
+backup.restore_types['mysqldump'] = MySQLDumpRestore
 
 
 class User(bases.ConfigDriven):
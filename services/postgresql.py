@@ -5,16 +5,19 @@ Created on Jul 7, 2011
 '''
 
 import os
+import re
 import time
 import glob
 import shlex
 import shutil
 import logging
+import threading
 import subprocess
 
 from M2Crypto import RSA
 
 from scalarizr.libs.metaconf import Configuration
+from scalarizr.libs import pgwire
 from scalarizr.util import disttool, firstmatched, wait_until
 from scalarizr import config
 from scalarizr.config import BuiltinBehaviours
@@ -458,7 +461,9 @@ class PgUser(object):
 			
 	def change_role_password(self, password):
 		self._logger.debug('Changing password for pg role %s' % self.name)
-		self.psql.execute("ALTER USER %s WITH PASSWORD '%s';" % (self.name, password), silent=True)
+		# Utility statements don't take parameters
+		self.psql.execute('ALTER USER %s WITH PASSWORD %s' % (pgwire.quote_ident(self.name), 
+								pgwire.quote_literal(password)), silent=True)
 		
 	def _create_pg_database(self):
 		if self._is_pg_database_exist:
@@ -491,69 +496,116 @@ class PgUser(object):
 		
 		
 class PSQL(object):
+	'''
+	Queries go through a persistent connection to the local socket shared by all 
+	PSQL objects of the same user. When server demands authentication 
+	we can't pass, falls back to `su - <user> -c psql`
+	'''
 	path = PSQL_PATH
 	user = None
 	
+	startup_timeout = 120
+	
+	_connections = {}
+	_legacy_users = set()
+	_lock = threading.Lock()
+	
 	def __init__(self, user=DEFAULT_USER):	
 		self.user = user
 		self._logger = logging.getLogger(__name__)
 		
+	@property
+	def connection(self):
+		with self._lock:
+			if self.user not in self._connections:
+				self._connections[self.user] = pgwire.Connection(self.user)
+			return self._connections[self.user]
+		
 	def test_connection(self):
 		self._logger.debug('Checking PostgreSQL service status')
-		
-		def test_recursive(attempt):
+		deadline = time.time() + self.startup_timeout
+		while True:
 			try:
-				self.execute('SELECT 1;', silent=True)
+				if self.user in self._legacy_users:
+					self._query_psql('SELECT 1;')
+				else:
+					self.connection.ping()
+				return True
+			except pgwire.ConnectionError:
+				return False
+			except pgwire.AuthError:
+				# Server is up and answers
+				return True
+			except pgwire.DatabaseError, e:
+				# 57P03: the database system is starting up
+				if e.code != '57P03':
+					return True
 			except PopenError, e:
 				if 'could not connect to server' in str(e):
 					return False
-				elif 'the database system is starting up' in str(e):
-					if not attempt:
-						raise BaseException('Postgresql service stuck on starting up database system')
-					time.sleep(10)
-					return test_recursive(attempt-1)
-			return True
-		return test_recursive(12)
-		
-	def execute(self, query, silent=False):
+				elif 'the database system is starting up' not in str(e):
+					return True
+			if time.time() > deadline:
+				raise BaseException('Postgresql service stuck on starting up database system')
+			time.sleep(1)
+		
+	def query(self, sql, params=None):
+		'''
+		@param params: Values for $1, $2, ... placeholders
+		@rtype: pgwire.Result
+		'''
+		if self.user not in self._legacy_users:
+			try:
+				return self.connection.query(sql, params)
+			except pgwire.AuthError, e:
+				self._logger.debug('Cannot authenticate %s over local socket (%s). '
+								'Using psql', self.user, e)
+				self._legacy_users.add(self.user)
+		return self._query_psql(sql, params)
+		
+	def execute(self, query, params=None, silent=False):
 		try:
-			out = system2([SU_EXEC, '-', self.user, '-c', 'export LANG=en_US; %s -c "%s"' % (self.path, query)], silent=True)[0]
-			return out	
-		except PopenError, e:
+			return self.query(query, params)
+		except (pgwire.Error, PopenError), e:
 			if not silent:
 				self._logger.error('Unable to execute query %s from user %s: %s' % (query, self.user, e))
 			raise		
 
+	def _query_psql(self, sql, params=None):
+		if params:
+			sql = re.sub(r'\$(\d+)', lambda m: pgwire.quote_literal(params[int(m.group(1)) - 1]), sql)
+		out = system2([SU_EXEC, '-', self.user, '-c', 
+					'export LANG=en_US; %s -X -q -A -t -F "\x1f" -v ON_ERROR_STOP=1' % self.path], 
+					stdin=sql.rstrip().rstrip(';') + ';\n', silent=True)[0]
+		rows = [tuple(line.split('\x1f')) for line in out.splitlines()]
+		return pgwire.Result(rows=rows)
+
 	def list_pg_roles(self):
-		out = self.execute('SELECT rolname FROM pg_roles;')
-		roles = out.split()[2:-2]
-		return roles
+		return self.query('SELECT rolname FROM pg_roles').column()
 	
 	def list_pg_databases(self):
-		out = self.execute('SELECT datname FROM pg_database where not datistemplate;')
-		roles = out.split()[2:-2]
-		return roles	
+		return self.query('SELECT datname FROM pg_database WHERE NOT datistemplate').column()
 	
 	def delete_pg_role(self, name):
-		out = self.execute('DROP ROLE IF EXISTS %s;' % name)
-		self._logger.debug(out)
+		out = self.execute('DROP ROLE IF EXISTS %s' % pgwire.quote_ident(name))
+		self._logger.debug(out.status)
 
 	def delete_pg_database(self, name):
-		out = self.execute('DROP DATABASE IF EXISTS %s;' % name)
-		self._logger.debug(out)
+		out = self.execute('DROP DATABASE IF EXISTS %s' % pgwire.quote_ident(name))
+		self._logger.debug(out.status)
 		
 	def start_backup(self):
 		try:
-			out = self.execute("SELECT pg_start_backup('label', true);")
-			self._logger.debug(out)
-		except PopenError, e:
+			out = self.execute("SELECT pg_start_backup($1, true)", ['label'])
+			self._logger.debug('Backup started at %s', out.scalar())
+		except (pgwire.Error, PopenError), e:
 			self._logger.warning('Cannot start backup: %s' % e)
 
 	def stop_backup(self):
 		try:
-			out = self.execute("SELECT pg_stop_backup();")
-			self._logger.debug(out)
-		except PopenError, e:
+			out = self.execute("SELECT pg_stop_backup()")
+			self._logger.debug('Backup stopped at %s', out.scalar())
+		except (pgwire.Error, PopenError), e:
 			self._logger.warning('Cannot stop backup: %s' % e)
 					
 	
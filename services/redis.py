@@ -4,10 +4,15 @@ Created on Aug 10, 2011
 @author: Dmytro Korsakov
 '''
 
+from __future__ import with_statement
+
 import os
+import time
+import shlex
 import signal
 import logging
 import shutil
+import threading
 
 from scalarizr.bus import bus
 from scalarizr.util import initdv2, system2, PopenError, wait_until
@@ -15,6 +20,7 @@ from scalarizr.services import lazy, BaseConfig, BaseService, ServiceError
 from scalarizr.util import disttool, cryptotool, firstmatched
 from scalarizr.util.filetool import rchown
 from scalarizr.libs.metaconf import Configuration, NoPathError
+from scalarizr.libs import resp
 
 
 SERVICE_NAME = CNF_SECTION = DEFAULT_USER = 'redis'
@@ -313,6 +319,9 @@ class Redis(BaseService):
 	port = None
 	password = None
 
+	# Instances share storage directory, only start and sync run concurrently
+	_init_lock = threading.Lock()
+
 
 	def __init__(self, master=False, persistence_type=SNAP_TYPE, port=DEFAULT_PORT, password=None):
 		self._objects = {}
@@ -323,19 +332,21 @@ class Redis(BaseService):
 
 
 	def init_master(self, mpoint):
-		self.service.stop('Configuring master. Moving Redis db files')
-		self.init_service(mpoint)
-		self.redis_conf.masterauth = None
-		self.redis_conf.slaveof = None
+		with self._init_lock:
+			self.service.stop('Configuring master. Moving Redis db files')
+			self.init_service(mpoint)
+			self.redis_conf.masterauth = None
+			self.redis_conf.slaveof = None
 		self.service.start()
 		self.is_replication_master = True
 		return self.current_password
 
 
 	def init_slave(self, mpoint, primary_ip, primary_port):
-		self.service.stop('Configuring slave')
-		self.init_service(mpoint)
-		self.change_primary(primary_ip, primary_port)
+		with self._init_lock:
+			self.service.stop('Configuring slave')
+			self.init_service(mpoint)
+			self.change_primary(primary_ip, primary_port)
 		self.service.start()
 		self.is_replication_master = False
 		return self.current_password
@@ -704,10 +715,21 @@ class RedisConf(BaseRedisConfig):
 
 
 class RedisCLI(object):
+	'''
+	Talks to redis-server over RESP through a connection pool shared by all
+	RedisCLI objects of the same server. INFO is cached for `info_ttl` seconds,
+	so status properties read in a row cost one round trip
+	'''
 
 	port = None
 	password = None
+	host = '127.0.0.1'
 	path = REDIS_CLI_PATH
+	info_ttl = 1
+
+	_pools = {}
+	_snapshots = {}
+	_lock = threading.Lock()
 
 
 	class no_keyerror_dict(dict):
@@ -722,54 +744,67 @@ class RedisCLI(object):
 		self.port = port
 		self.password = password
 
-		if not os.path.exists(self.path):
-			raise OSError('redis-cli not found')
-
 
 	@classmethod
 	def find(cls, redis_conf):
 		return cls(redis_conf.requirepass, port=redis_conf.port)
 
 
-	def execute(self, query, silent=False):
-		if not self.password:
-			full_query = query
-		else:
-			full_query = 'AUTH %s\n%s' % (self.password, query)
-		try:
-			out = system2([self.path, '-p', self.port], stdin=full_query,silent=True, warn_stderr=False)[0]
-
-			#fix for redis 2.4 AUTH
-			if 'Client sent AUTH, but no password is set' in out:
-				out = system2([self.path], stdin=query,silent=True)[0]
+	@property
+	def pool(self):
+		key = (self.host, int(self.port), self.password)
+		with self._lock:
+			if key not in self._pools:
+				self._pools[key] = resp.ConnectionPool(*key)
+			return self._pools[key]
 
-			if out.startswith('ERR') or out.startswith('LOADING'):
-				raise PopenError(out)
 
-			elif out.startswith('OK\n'):
-				out = out[3:]
-			if out.endswith('\n'):
-				out = out[:-1]
-			return out
-		except PopenError, e:
-			if 'LOADING' in str(e):
+	def execute(self, query, silent=False):
+		'''
+		@param query: Command string ('bgsave', 'config get dir') or args sequence
+		@return: Reply: str, int, list or None
+		'''
+		args = shlex.split(query) if isinstance(query, basestring) else list(query)
+		try:
+			if args[0].lower() != 'info':
+				self._invalidate_info()
+			return self.pool.execute(*args)
+		except resp.Error, e:
+			if isinstance(e, resp.ResponseError) and e.kind == 'LOADING':
 				LOG.debug('Unable to execute query %s: Redis is loading the dataset in memory' % query)
 			elif not silent:
-				LOG.error('Unable to execute query %s with redis-cli: %s' % (query, e))
+				LOG.error('Unable to execute query %s on port %s: %s' % (query, self.port, e))
 			raise
 
 
+	def pipeline(self, *queries):
+		'''
+		Sends all queries in one round trip
+		@return: list of replies, ResponseError instances in place of failed queries
+		'''
+		commands = [shlex.split(q) if isinstance(q, basestring) else list(q) for q in queries]
+		if any(args[0].lower() != 'info' for args in commands):
+			self._invalidate_info()
+		return self.pool.pipeline(commands, raise_on_error=False)
+
+
 	def test_connection(self):
 		try:
-			self.execute('select (1)', silent=True)
-		except PopenError, e:
-			if 'LOADING' in str(e):
+			self.execute('ping', silent=True)
+		except resp.ConnectionError:
+			return False
+		except resp.ResponseError, e:
+			if e.kind == 'LOADING':
 				return False
 		return True
 
 
 	@property
 	def info(self):
+		snapshot = self._snapshots.get(self._info_key())
+		if snapshot and time.time() - snapshot[0] < self.info_ttl:
+			return snapshot[1]
+
 		info = self.execute('info')
 		LOG.debug('Redis INFO: %s' % info)
 		d = self.no_keyerror_dict()
@@ -782,9 +817,18 @@ class RedisCLI(object):
 						key, val = kv
 						if key:
 							d[key] = val
+		self._snapshots[self._info_key()] = (time.time(), d)
 		return d
 
 
+	def _info_key(self):
+		return (int(self.port), self.password)
+
+
+	def _invalidate_info(self):
+		self._snapshots.pop(self._info_key(), None)
+
+
 	@property
 	def aof_enabled(self):
 		return True if self.info['aof_enabled']=='1' else False
@@ -899,8 +943,8 @@ def get_port(conf_path=DEFAULT_CONF_PATH):
 	'''
 	if conf_path == DEFAULT_CONF_PATH:
 		return DEFAULT_PORT
-	raw = conf_path.split('.')
-	return raw[-2:-1] if len(raw) > 2 else None
+	raw = os.path.basename(conf_path).split('.')
+	return int(raw[-2]) if len(raw) > 2 and raw[-2].isdigit() else None
 
 
 
@@ -934,6 +978,25 @@ def create_redis_conf_copy(port=DEFAULT_PORT):
 	else:
 		LOG.debug('%s already exists.' % dst)
 
+def get_redis_pids():
+	'''
+	Scans process table once
+	@return: {port: (pid, config path)} of all running redis-server processes
+	'''
+	ret = {}
+	try:
+		out = system2(('ps', '-G', 'redis', '-o', 'pid,command', '--no-headers'), silent=True)[0]
+	except PopenError:
+		out = ''
+	for line in out.splitlines():
+		words = line.split()
+		if len(words) == 3 and words[1] == BIN_PATH:
+			port = get_port(words[2])
+			if port:
+				ret[port] = (int(words[0]), words[2])
+	return ret
+
+
 def get_redis_processes():
 	config_files = list()
 	try:
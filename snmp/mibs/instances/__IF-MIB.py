@@ -4,6 +4,7 @@ from pysnmp import majorVersionId
 import os, re
 from pyasn1.type import constraint, namedval
 from scalarizr.snmp.mibs import validate
+from scalarizr.linux.procstat import sampler
 
 ( Integer, OctetString, ) = mibBuilder.importSymbols("ASN1", "Integer", "OctetString")
 ( DisplayString,) = mibBuilder.importSymbols("SNMPv2-TC", "DisplayString")
@@ -35,7 +36,7 @@ ifOutOctets
     )
 
 
-directions = {'in' : 1, 'out' : 9}
+directions = {'in' : 'rx_bytes', 'out' : 'tx_bytes'}
 
 class GetOctets():
 	def __init__(self, iface=None, direction=None):
@@ -43,26 +44,12 @@ class GetOctets():
 		self.direction = direction
 	def clone(self):
 		if self.iface != None and self.direction !=None:
-			file = open('/proc/net/dev', "r")
-			list = file.readlines()
-			file.close()
-			for row in list:
-				row = re.sub(':', ' ', row)
-				if re.match('^\s+' + self.iface, row):
-					values = row.split()	
-					return validate(Counter32(), values[directions[self.direction]])
+			stat = sampler.find('netdev', self.iface)
+			if stat:
+				return validate(Counter32(), getattr(stat, directions[self.direction]))
 	
 
-file = open('/proc/net/dev', "r")
-ifacesList = file.readlines()
-file.close()
-ifaces = []
-
-for row in ifacesList:
-	row = re.sub(':', ' ', row)
-	if re.match('^\s+\w+(\s+\d+){16}', row):
-		values = row.split()
-		ifaces.append((values[0], values[1], values[9],))
+ifaces = [(stat.iface, stat.rx_bytes, stat.tx_bytes) for stat in sampler.netdev()]
 
 
 for i in range(len(ifaces)):
@@ -10,8 +10,9 @@ import signal
 import os, time, logging
 from subprocess import Popen, PIPE
 from scalarizr.util import system, kill_childs
-from threading import Thread
-from Queue import Queue, Empty
+import errno
+import select
+import threading
 
 # SNMP imports
 from pysnmp.smi.builder import MibBuilder
@@ -85,6 +86,7 @@ mtxId = MibTableColumn((1, 3, 6, 1, 4, 1, 36632, 5, 1, 2), Integer32()).setMaxAc
 mtxName = MibTableColumn((1, 3, 6, 1, 4, 1, 36632, 5, 1, 3), DisplayString()).setMaxAccess("readonly")
 mtxValue = MibTableColumn((1, 3, 6, 1, 4, 1, 36632, 5, 1, 4), DisplayString()).setMaxAccess("readonly")
 mtxError = MibTableColumn((1, 3, 6, 1, 4, 1, 36632, 5, 1, 5), DisplayString()).setMaxAccess("readonly")
+mtxAge = MibTableColumn((1, 3, 6, 1, 4, 1, 36632, 5, 1, 6), Integer32()).setMaxAccess("readonly")
 
 uglyFeatures = MibIdentifier((1, 3, 6, 1, 4, 1, 36632, 6))
 authShutdown = MibScalar((1, 3, 6, 1, 4, 1, 36632, 6, 1), Integer32()).setMaxAccess("readonly")
@@ -106,6 +108,7 @@ def values():
 		'mtxName'  : mtxName,
 		'mtxValue' : mtxValue,
 		'mtxError' : mtxError,
+		'mtxAge'   : mtxAge,
 		'mtxEntry' : mtxEntry,
 		'uglyfeatures': uglyFeatures,
 		'autoshutdown': authShutdown,
@@ -126,51 +129,220 @@ def values():
 		logger.debug('Use cached scaling metrics. Expires: %s', 
 				time.strftime('"%Y-%m-%d %H:%M:%S', time.localtime(_metrics_timestamp + CACHE_TIME)))
 	
+	_collector.refresh(_metrics)
+	if not _collector.collected:
+		# Nothing to report yet. Wait for the first round, but not longer than scripts may run
+		_collector.wait(MtxTableImpl.EXEC_TIMEOUT + 1)
+	
 	index = 0
-	queue = Queue()
 	for metric in _metrics:
-		queue.put(metric)
-	
-	workers = []
-	for i in range(len(_metrics)):
 		index += 1
-		worker = Thread(target = update_metric, name = 'Worker-%s' % i, args = (queue, index, ret))
-		worker.start()
-		workers.append(worker)
-		
-	for worker in workers:
-		worker.join()
+		export_metric(metric, index, ret)
 				
 	return ret
 
-def _get_execute(metric):
-	if not os.access(metric.path, os.X_OK):
-		raise BaseException("File is not executable: '%s'" % metric.path)
+
+class MetricCollector(object):
+	'''
+	Retrieves metric values in a background thread.
+	Scripts run concurrently (not more than MAX_PROCS at a time) and are killed after EXEC_TIMEOUT.
+	SNMP requests read the last good values and never wait for scripts 
+	'''
 	
-	logger.debug('Executing %s', metric.path)
-	proc = Popen(metric.path, stdout=PIPE, stderr=PIPE, close_fds=True)
-	start_time = time.time()
-	while time.time() - start_time < MtxTableImpl.EXEC_TIMEOUT:
-		if proc.poll() is None:
-			time.sleep(0.1)
-		else:
-			break
-	else:
-		if hasattr(proc, 'kill'):
-			# python >= 2.6
-			kill_childs(proc.pid)
-			proc.terminate()
-		else:
-			kill_childs(proc.pid)
-			os.kill(proc.pid, signal.SIGTERM)
-		raise BaseException('Timeouted')
-							
-	stdout, stderr = proc.communicate()
+	MAX_PROCS = 5
+
+	STALE_TIMEOUT = 300
+	'''
+	Seconds the last good value is reported for a failing metric, before the error is exposed
+	'''
+
+	POLL_INTERVAL = 0.1
+	'''
+	Seconds between exit checks of a script that closed its output but still runs
+	'''
+	
+	collected = False
+	
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._values = {}
+		self._metrics = None
+		self._wakeup = threading.Event()
+		self._done = threading.Event()
+		self._thread = None
+	
+	def refresh(self, metrics):
+		'''
+		Schedule a collection round. Does nothing when the previous one is still running
+		'''
+		self._lock.acquire()
+		try:
+			if self._metrics is not None:
+				return
+			self._metrics = list(metrics)
+			self._done.clear()
+			if not self._thread or not self._thread.isAlive():
+				self._thread = threading.Thread(target=self._run, name='MetricCollector')
+				self._thread.setDaemon(True)
+				self._thread.start()
+			self._wakeup.set()
+		finally:
+			self._lock.release()
+	
+	def wait(self, timeout):
+		self._done.wait(timeout)
+	
+	def get(self, metric):
+		'''
+		@return: (value, error, age). age is a number of seconds since the value was retrieved, 
+		-1 when metric has never been retrieved  
+		'''
+		self._lock.acquire()
+		try:
+			entry = self._values.get(metric.id)
+		finally:
+			self._lock.release()
+		if not entry:
+			return 0.0, 'Not retrieved yet', -1
+		
+		now = time.time()
+		if entry['error'] and (entry['success_at'] is None or 
+							now - entry['success_at'] > self.STALE_TIMEOUT):
+			return 0.0, entry['error'], -1
+		return entry['value'], '', int(now - entry['success_at'])
+	
+	
+	def _run(self):
+		while True:
+			self._wakeup.wait()
+			self._wakeup.clear()
+			metrics = self._metrics
+			try:
+				try:
+					self._collect(metrics)
+				except (BaseException, Exception), e:
+					logger.exception('Metrics collection failed')
+			finally:
+				self._lock.acquire()
+				try:
+					self._metrics = None
+					self.collected = True
+				finally:
+					self._lock.release()
+				self._done.set()
 	
-	if proc.returncode > 0:
-		raise BaseException(stderr if stderr else 'exitcode: %d' % proc.returncode)
 	
-	return stdout
+	def _collect(self, metrics):
+		queue = list(metrics)
+		jobs = {}
+		fds = {}
+		while queue or jobs:
+			while queue and len(jobs) < self.MAX_PROCS:
+				metric = queue.pop(0)
+				try:
+					logger.debug('Updating metric %s', metric)
+					if ScalingMetric.RetriveMethod.EXECUTE == metric.retrieve_method:
+						job = self._start(metric)
+						jobs[job['proc'].pid] = job
+						for fd in job['buf']:
+							fds[fd] = job
+					elif ScalingMetric.RetriveMethod.READ  == metric.retrieve_method:
+						self._store(metric, _get_read(metric))
+					else:
+						raise BaseException('Unknown retrieve method %s' % metric.retrieve_method)
+				except (BaseException, Exception), e:
+					self._store(metric, error=e)
+			if not jobs:
+				continue
+			
+			timeout = max(min(job['deadline'] for job in jobs.values()) - time.time(), 0)
+			if len(set(job['proc'].pid for job in fds.values())) < len(jobs):
+				timeout = min(timeout, self.POLL_INTERVAL)
+			try:
+				rlist = select.select(fds.keys(), [], [], timeout)[0]
+			except select.error, e:
+				if e.args[0] != errno.EINTR:
+					raise
+				rlist = []
+			for fd in rlist:
+				job = fds[fd]
+				data = os.read(fd, 4096)
+				if data:
+					job['buf'][fd].append(data)
+				else:
+					del fds[fd]
+
+			now = time.time()
+			for pid, job in jobs.items():
+				# Script may close or pass its output to a daemon and keep running
+				if not [fd for fd in job['buf'] if fd in fds] and job['proc'].poll() is not None:
+					del jobs[pid]
+					self._finish(job)
+				elif now >= job['deadline']:
+					del jobs[pid]
+					for fd in job['buf']:
+						fds.pop(fd, None)
+					self._kill(job)
+
+	
+	def _start(self, metric):
+		if not os.access(metric.path, os.X_OK):
+			raise BaseException("File is not executable: '%s'" % metric.path)
+		logger.debug('Executing %s', metric.path)
+		proc = Popen(metric.path, stdout=PIPE, stderr=PIPE, close_fds=True)
+		return dict(
+			metric=metric, 
+			proc=proc,
+			deadline=time.time() + MtxTableImpl.EXEC_TIMEOUT,
+			buf={proc.stdout.fileno(): [], proc.stderr.fileno(): []}
+		)
+
+
+	def _finish(self, job):
+		proc = job['proc']
+		stdout = ''.join(job['buf'][proc.stdout.fileno()])
+		stderr = ''.join(job['buf'][proc.stderr.fileno()])
+		proc.stdout.close()
+		proc.stderr.close()
+		if proc.returncode > 0:
+			self._store(job['metric'], error=stderr if stderr else 'exitcode: %d' % proc.returncode)
+		else:
+			self._store(job['metric'], stdout)
+		
+	
+	def _kill(self, job):
+		proc = job['proc']
+		try:
+			kill_childs(proc.pid)
+			os.kill(proc.pid, signal.SIGKILL)
+		except OSError:
+			pass
+		proc.wait()
+		proc.stdout.close()
+		proc.stderr.close()
+		self._store(job['metric'], error='Timeouted')
+
+
+	def _store(self, metric, value=None, error=None):
+		if error is None:
+			try:
+				value = float(value)
+			except ValueError, e:
+				error = "Cannot convert value '%s' to float" % value
+		
+		self._lock.acquire()
+		try:
+			entry = self._values.setdefault(metric.id, dict(value=0.0, error='', success_at=None))
+			if error is None:
+				entry.update(value=value, error='', success_at=time.time())
+			else:
+				logger.debug('Failed to update metric %s: %s', metric, error)
+				entry['error'] = str(error)[0:255]
+		finally:
+			self._lock.release()
+
+_collector = MetricCollector()
+
 
 def _get_read( metric):
 	if not os.access(metric.path, os.R_OK):
@@ -187,34 +359,8 @@ def _get_read( metric):
 	
 	return value
 
-def update_metric(queue, index, ret):
-	error = ''
-	value = 0.0
-	try:
-		metric = queue.get(False)
-	except Empty:
-		return
-			
-	try:
-		# Retrieve metric value
-		logger.debug('Updating metric %s', metric)
-		if ScalingMetric.RetriveMethod.EXECUTE == metric.retrieve_method:
-			value = _get_execute(metric)
-		elif ScalingMetric.RetriveMethod.READ  == metric.retrieve_method:
-			value = _get_read(metric)
-		else:
-			raise BaseException('Unknown retrieve method %s' % metric.retrieve_method)
-		
-		# Convert value to float
-		try:
-			value = float(value)
-		except ValueError, e:
-			raise ValueError("Cannot convert value '%s' to float" % value)
-			
-	except (BaseException, Exception), e:
-		value = 0.0
-		error = str(e)[0:255]
-
+def export_metric(metric, index, ret):
+	value, error, age = _collector.get(metric)
 		
 	# Export MibTableRow
 
@@ -233,6 +379,9 @@ def update_metric(queue, index, ret):
 		)),
 		'mtxError%s' % index : MibScalarInstance(mtxError.getName(), (index,), mtxError.getSyntax().clone(
 			error
+		)),
+		'mtxAge%s' % index : MibScalarInstance(mtxAge.getName(), (index,), mtxAge.getSyntax().clone(
+			age
 		))
 	})
 
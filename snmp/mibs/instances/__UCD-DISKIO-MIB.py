@@ -6,6 +6,7 @@ import UserDict
 from pyasn1.type import constraint, namedval
 from pysnmp.smi import error
 from scalarizr.snmp.mibs import validate
+from scalarizr.linux.procstat import sampler
 import time
 
 ( DisplayString,) = mibBuilder.importSymbols("SNMPv2-TC", "DisplayString")
@@ -81,23 +82,20 @@ def values():
 					  #diskIONWrittenX = diskIONWrittenX
 					  )
 
-	fp = open('/proc/diskstats')
-	diskstats = fp.readlines()
-	fp.close()
+	diskstats = sampler.diskstats()
 	
 	for index in range(len(diskstats)):
-		values = diskstats[index].split()
-		is_partition = len(values) == 7
+		stat = diskstats[index]
 
 		devicelist['diskIOIndex' + str(index)]		= MibScalarInstance(diskIOIndex.getName(), (int(index)+1 ,), diskIOIndex.getSyntax().clone(int(index)+1))
-		devicelist['diskIODevice' + str(index)]     = MibScalarInstance(diskIODevice.getName(), (int(index)+1,), diskIODevice.getSyntax().clone(values[2]))
+		devicelist['diskIODevice' + str(index)]     = MibScalarInstance(diskIODevice.getName(), (int(index)+1,), diskIODevice.getSyntax().clone(stat.device))
 		
-		devicelist['diskIONRead' + str(index)]      = MibScalarInstance(diskIONRead.getName(), (int(index)+1,), validate(Counter32(), int(values[5])*512))
-		devicelist['diskIONWritten' + str(index)]   = MibScalarInstance(diskIONWritten.getName(), (int(index)+1,), validate(Counter32(), int(values[9])*512 if not is_partition else 0))
-		devicelist['diskIOReads' + str(index)]		= MibScalarInstance(diskIOReads.getName(), (int(index)+1,), validate(Counter32(), values[3]))
-		devicelist['diskIOWrites' + str(index)]	    = MibScalarInstance(diskIOWrites.getName(), (int(index)+1,), validate(Counter32(), values[7] if not is_partition else 0))
-		#devicelist['diskIONReadX' + str(index)]  	= MibScalarInstance(diskIONReadX.getName(), (int(index)+1,), validate(Counter64(), int(values[5])*512))
-		#devicelist['diskIONWrittenX' + str(index)]	= MibScalarInstance(diskIONWrittenX.getName(), (int(index)+1,), validate(Counter64(), int(values[9])*512)) 
+		devicelist['diskIONRead' + str(index)]      = MibScalarInstance(diskIONRead.getName(), (int(index)+1,), validate(Counter32(), stat.read_sectors*512))
+		devicelist['diskIONWritten' + str(index)]   = MibScalarInstance(diskIONWritten.getName(), (int(index)+1,), validate(Counter32(), stat.write_sectors*512))
+		devicelist['diskIOReads' + str(index)]		= MibScalarInstance(diskIOReads.getName(), (int(index)+1,), validate(Counter32(), stat.reads))
+		devicelist['diskIOWrites' + str(index)]	    = MibScalarInstance(diskIOWrites.getName(), (int(index)+1,), validate(Counter32(), stat.writes))
+		#devicelist['diskIONReadX' + str(index)]  	= MibScalarInstance(diskIONReadX.getName(), (int(index)+1,), validate(Counter64(), stat.read_sectors*512))
+		#devicelist['diskIONWrittenX' + str(index)]	= MibScalarInstance(diskIONWrittenX.getName(), (int(index)+1,), validate(Counter64(), stat.write_sectors*512)) 
 	
 	return devicelist
 
@@ -4,6 +4,7 @@ from pysnmp import majorVersionId
 import os, re
 from pyasn1.type import constraint, namedval
 from scalarizr.snmp.mibs import validate
+from scalarizr.linux.procstat import sampler
 
 
 ( Integer, OctetString, ) = mibBuilder.importSymbols("ASN1", "Integer", "OctetString")
@@ -128,7 +129,7 @@ class MemBuffer(Integer32):
 class MemCached(Integer32):
 	def clone(self, **kwargs):
 		if kwargs.get('value') is None:
-			kwargs['value'] = validate(Integer32(), _get_memory_value('^Cached:'), False)
+			kwargs['value'] = validate(Integer32(), _get_memory_value('Cached'), False)
 			return apply(Integer32.clone, [self], kwargs)
 
 class SsCpuRawUser(Counter32):
@@ -157,21 +158,11 @@ class SsCpuRawSystem(Counter32):
 
 
 def _get_memory_value(key=None):
-	file = open('/proc/meminfo', "r")
-	meminfo = file.readlines()
-	file.close()
-	for line in meminfo:
-		if re.match(key, line) :
-			return int(line.split()[1])
-	return 0
+	return sampler.meminfo().get(key, 0)
 		
 def _get_cpu_value(key=None):
-	cpuvalues = {'user' : 1, 'nice' : 2, 'system' : 3, 'idle' : 4}
-	if  cpuvalues.has_key(key):
-		file = open('/proc/stat', "r")
-		cpuinfo = file.readline()
-		file.close()
-		return int(cpuinfo.split()[cpuvalues[key]])
+	if key in ('user', 'nice', 'system', 'idle'):
+		return getattr(sampler.cpu(), key)
 	return 0
 
 class GetLaLoad():
@@ -351,7 +351,7 @@ class LargeTransfer(bases.Task):
 			self._up = True
 		else:
 			raise ValueError('Eather src or dst should be URL-like string')
-		if self._up and os.path.isdir(src) and not tar_it:
+		if self._up and isinstance(src, basestring) and os.path.isdir(src) and not tar_it:
 			raise ValueError('Passed src is a directory. tar_it=True expected')
 		if self._up:
 			if callable(src):
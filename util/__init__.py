@@ -10,6 +10,9 @@ import signal
 import string
 import pkgutil
 import contextlib
+import heapq
+import random
+import Queue
 
 from scalarizr.bus import bus
 from scalarizr import exceptions
@@ -469,69 +472,198 @@ def port_in_use(port):
 
 		
 class PeriodicalExecutor:
+	'''
+	Runs periodical tasks on a small pool of worker threads. 
+	Tasks are kept in a heap ordered by the next run time, 
+	so executor thread sleeps exactly until the nearest task is due.
+	'''
+
+	MISSED_SKIP = 'skip'
+	'''
+	Missed runs are dropped, next run is aligned to the task schedule
+	'''
+
+	MISSED_CATCHUP = 'catchup'
+	'''
+	Missed runs are executed one after another until task catches up the schedule
+	'''
+
+	default_timeout = 600
+	'''
+	Timeout for tasks added without one. 
+	Task is rescheduled only when its run finishes, so runs never overlap, 
+	but without a timeout hung task would hold its worker forever
+	'''
+
 	_logger = None
 	_tasks = None
 	_lock = None
 	_ex_thread = None
 	_shutdown = None
 	
-	def __init__(self):
+	def __init__(self, pool_size=2):
 		self._logger = logging.getLogger(__name__ + '.PeriodicalExecutor')
 		self._tasks = dict()
+		self._heap = []
+		self._seq = 0
+		self._pool_size = pool_size
+		self._workers = []
+		self._spare_workers = 0
+		self._work_queue = Queue.Queue()
 		self._ex_thread = threading.Thread(target=self._executor, name='PeriodicalExecutor')
 		self._ex_thread.setDaemon(True)
 		self._lock = threading.Lock()
+		self._wakeup = threading.Condition(self._lock)
 	
 	def start(self):
 		self._shutdown = False		
+		for i in range(self._pool_size):
+			self._start_worker()
 		self._ex_thread.start()
 		
 	def shutdown(self):
-		self._shutdown = True
+		with self._lock:
+			self._shutdown = True
+			self._wakeup.notify()
+		for i in range(len(self._workers)):
+			self._work_queue.put(None)
 		self._ex_thread.join(1)
 	
-	def add_task(self, fn, interval, title=None):
-		self._lock.acquire()
-		try:
+	def add_task(self, fn, interval, title=None, timeout=None, jitter=0, missed=MISSED_SKIP):
+		'''
+		@param interval: Seconds between task runs
+		@param timeout: Seconds after which running task is considered hung. 
+		It's reported and it's worker is replaced, so other tasks are not delayed.
+		Defaults to PeriodicalExecutor.default_timeout
+		@param jitter: Max random delay (seconds) added to each run 
+		@param missed: What to do with runs missed while task was running long, 
+		PeriodicalExecutor.MISSED_SKIP or PeriodicalExecutor.MISSED_CATCHUP
+		'''
+		with self._lock:
 			if fn in self._tasks:
 				raise BaseException('Task %s already registered in executor with an interval %s minutes', 
-					fn, self._tasks[fn])
+					fn, self._tasks[fn]['interval'])
 			if interval <= 0:
 				raise ValueError('interval should be > 0')
-			self._tasks[fn] = dict(fn=fn, interval=interval, title=title, last_exec_time=0)
-		finally:
-			self._lock.release()
+			task = dict(fn=fn, interval=interval, title=title, 
+					timeout=timeout or self.default_timeout, 
+					jitter=jitter, missed=missed, running=False, started=None, 
+					scheduled=time.time(), timed_out=False,
+					stats=dict(runs=0, errors=0, timeouts=0, 
+							last_duration=0.0, max_duration=0.0, 
+							last_lateness=0.0, max_lateness=0.0))
+			self._tasks[fn] = task
+			self._schedule(task)
 	
 	def remove_task(self, fn):
-		self._lock.acquire()
-		try:
+		with self._lock:
 			if fn in self._tasks:
 				del self._tasks[fn]
-		finally:
-			self._lock.release()
-		
-	def _tasks_to_execute(self):
-		self._lock.acquire()		
-		try:
-			now = time.time()			
-			return list(task for task in self._tasks.values()
-					if now - task['last_exec_time'] > task['interval'])
-		finally:
-			self._lock.release()
-		
+	
+	def get_stats(self):
+		'''
+		@return: {task title: {runs, errors, timeouts, last_duration, max_duration, 
+				last_lateness, max_lateness}}
+		'''
+		with self._lock:
+			return dict((task['title'] or str(task['fn']), dict(task['stats'])) 
+					for task in self._tasks.values())
+
+	def _schedule(self, task):
+		# Called with lock held
+		self._seq += 1
+		at = task['scheduled'] + random.uniform(0, task['jitter'])
+		heapq.heappush(self._heap, (at, self._seq, task))
+		self._wakeup.notify()
+
+	def _start_worker(self):
+		t = threading.Thread(target=self._worker, name='PeriodicalExecutorWorker')
+		t.setDaemon(True)
+		self._workers.append(t)
+		t.start()
+
 	def _executor(self):
-		while not self._shutdown:
-			for task in self._tasks_to_execute():
-				self._logger.debug('Executing task %s', task['title'] or task['fn'])
-				try:
-					task['last_exec_time'] = time.time()
-					task['fn']()
-				except (BaseException, Exception), e:
-					self._logger.exception(e)
+		while True:
+			with self._lock:
 				if self._shutdown:
 					break
-			if not self._shutdown:
-				time.sleep(1)
+				now = time.time()
+				timeout = None
+				while self._heap and self._heap[0][0] <= now:
+					at, seq, task = heapq.heappop(self._heap)
+					if self._tasks.get(task['fn']) is not task:
+						# Task was removed
+						continue
+					task['running'] = True
+					self._work_queue.put((task, at))
+				if self._heap:
+					timeout = self._heap[0][0] - now
+				timeout = self._check_timeouts(now, timeout)
+				self._wakeup.wait(timeout)
+
+	def _check_timeouts(self, now, timeout):
+		# Called with lock held. Returns how long executor may sleep
+		for task in self._tasks.values():
+			if not task['running'] or not task['timeout'] or not task['started'] or task['timed_out']:
+				continue
+			deadline = task['started'] + task['timeout']
+			if deadline <= now:
+				task['timed_out'] = True
+				task['stats']['timeouts'] += 1
+				self._logger.warning('Task %s is running more then %s seconds. Starting another worker', 
+						task['title'] or task['fn'], task['timeout'])
+				self._spare_workers += 1
+				self._start_worker()
+			else:
+				timeout = min(timeout, deadline - now) if timeout is not None else deadline - now
+		return timeout
+
+	def _worker(self):
+		while True:
+			job = self._work_queue.get()
+			if job is None:
+				return
+			task, at = job
+			started = time.time()
+			with self._lock:
+				task['started'] = started
+				# Executor should watch task timeout
+				self._wakeup.notify()
+			self._logger.debug('Executing task %s', task['title'] or task['fn'])
+			error = False
+			try:
+				task['fn']()
+			except (BaseException, Exception), e:
+				error = True
+				self._logger.exception(e)
+			finished = time.time()
+
+			with self._lock:
+				stats = task['stats']
+				stats['runs'] += 1
+				stats['errors'] += int(error)
+				stats['last_duration'] = finished - started
+				stats['max_duration'] = max(stats['max_duration'], stats['last_duration'])
+				stats['last_lateness'] = max(0.0, started - at)
+				stats['max_lateness'] = max(stats['max_lateness'], stats['last_lateness'])
+
+				next_run = task['scheduled'] + task['interval']
+				if next_run < finished and task['missed'] != self.MISSED_CATCHUP:
+					missed_runs = int((finished - next_run) / task['interval']) + 1
+					next_run += missed_runs * task['interval']
+				task['scheduled'] = next_run
+				timed_out = task['timed_out']
+				task['running'] = task['timed_out'] = False
+				task['started'] = None
+				if self._tasks.get(task['fn']) is task:
+					self._schedule(task)
+
+				if timed_out and self._spare_workers:
+					# Replacement worker was started while this task was hanging
+					self._spare_workers -= 1
+					self._workers.remove(threading.currentThread())
+					return
+
 			
 				
 				
@@ -4,12 +4,19 @@ Created on Apr 7, 2010
 @author: marat
 '''
 
+from __future__ import with_statement
+
 from M2Crypto.EVP import Cipher
 from M2Crypto.Rand import rand_bytes
+from M2Crypto import m2
 import binascii
 import hmac
 import hashlib
+import os
 import re
+import threading
+
+from scalarizr.bus import bus
 try:
 	import timemodule as time
 except ImportError:
@@ -21,24 +28,81 @@ crypto_algo = dict(name="des_ede3_cbc", key_size=24, iv_size=8)
 def keygen(length=40):
 	return binascii.b2a_base64(rand_bytes(length))	
 
+_key_cache = {}
+_key_cache_lock = threading.Lock()
+
+# Keys modified less than this seconds ago are not cached: 
+# key rotated within the same mtime tick has the same size
+_KEY_RACY_INTERVAL = 1
+
+def read_key(path):
+	'''
+	Read base64 encoded key file and return decoded key. 
+	Key is cached until file modification time or size changes
+	'''
+	st = os.stat(path)
+	stamp = (st.st_mtime, st.st_size)
+	with _key_cache_lock:
+		if path in _key_cache and _key_cache[path][0] == stamp:
+			return _key_cache[path][1]
+	fp = open(path)
+	try:
+		key = binascii.a2b_base64(fp.read().strip())
+	finally:
+		fp.close()
+	if time.time() - st.st_mtime >= _KEY_RACY_INTERVAL:
+		with _key_cache_lock:
+			_key_cache[path] = (stamp, key)
+	return key
+
+def invalidate_keys(*args):
+	with _key_cache_lock:
+		_key_cache.clear()
+
+bus.on('reload', invalidate_keys)
+
+
+_MAX_PREPARED = 16
+_ciphers = threading.local()
+
 def _init_cipher(key, op_enc=1):
 	skey = key[0:crypto_algo["key_size"]] 	# Use first n bytes as crypto key
 	iv = key[-crypto_algo["iv_size"]:] 		# Use last m bytes as IV
 	return Cipher(crypto_algo["name"], skey, iv, op_enc)
+
+def _prepared_cipher(key, op_enc=1):
+	'''
+	Return cipher context for the key, reused by the calling thread. 
+	Context is reset to initial key and IV after each use
+	'''
+	if not hasattr(_ciphers, 'cache'):
+		_ciphers.cache = {}
+	c = _ciphers.cache.get((key, op_enc))
+	if c:
+		m2.cipher_init(c.ctx, c.cipher, key[0:crypto_algo["key_size"]], 
+					key[-crypto_algo["iv_size"]:], op_enc)
+		return c
+	if len(_ciphers.cache) >= _MAX_PREPARED:
+		_ciphers.cache.clear()
+	c = _ciphers.cache[(key, op_enc)] = _init_cipher(key, op_enc)
+	return c
+
+def _crypt(s, key, op_enc):
+	c = _prepared_cipher(key, op_enc)
+	try:
+		ret = c.update(s)
+		ret += c.final()
+		return ret
+	except:
+		# Don't reuse context in unknown state
+		_ciphers.cache.pop((key, op_enc), None)
+		raise
 		
 def encrypt (s, key):
-	c = _init_cipher(key, 1)
-	ret = c.update(s)
-	ret += c.final()
-	del c
-	return binascii.b2a_base64(ret)
+	return binascii.b2a_base64(_crypt(s, key, 1))
 	
 def decrypt (s, key):
-	c = _init_cipher(key, 0)
-	ret = c.update(binascii.a2b_base64(s))
-	ret += c.final()
-	del c
-	return ret
+	return _crypt(binascii.a2b_base64(s), key, 0)
 
 _READ_BUF_SIZE = 1024 * 1024	 # Buffer size in bytes
 	
@@ -65,12 +129,27 @@ def _get_canonical_string (params={}):
 		s = s + str(key) + str(value)
 	return s
 		
+_hmacs = {}
+
+def _prepared_hmac(key):
+	'''
+	HMAC with key pads already digested. Caller should use a copy() of it
+	'''
+	h = _hmacs.get(key)
+	if not h:
+		if len(_hmacs) >= _MAX_PREPARED:
+			_hmacs.clear()
+		h = _hmacs[key] = hmac.new(key, digestmod=hashlib.sha1)
+	return h
+		
 def sign_http_request(data, key, timestamp=None):
 	date = time.strftime("%a %d %b %Y %H:%M:%S %Z", timestamp or time.gmtime())
 	canonical_string = _get_canonical_string(data) if hasattr(data, "__iter__") else data
 	canonical_string += date
 	
-	digest = hmac.new(key, canonical_string, hashlib.sha1).digest()
+	h = _prepared_hmac(key).copy()
+	h.update(canonical_string)
+	digest = h.digest()
 	sign = binascii.b2a_base64(digest)
 	if sign.endswith('\n'):
 		sign = sign[:-1]
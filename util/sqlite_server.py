@@ -4,6 +4,8 @@ Created on Mar 14, 2012
 @author: marat
 '''
 
+from __future__ import with_statement
+
 import time
 import Queue
 import threading
@@ -18,10 +20,113 @@ import sqlite3
 LOG = logging.getLogger(__name__)
 GLOBAL_TIMEOUT = 30
 
+FLUSH_DELAY = 0.1
+'''
+Max time (seconds) deferred writes stay uncommitted
+'''
+
+FLUSH_MAX_STATEMENTS = 500
+'''
+Max number of deferred writes grouped into one transaction
+'''
+
+ARRAYSIZE = 100
+'''
+Rows per page, that server sends to cursor proxy
+'''
+
+CURSOR_IDLE_TIMEOUT = 60
+'''
+Server side cursor is closed when client doesn't fetch from it for this time (seconds)
+'''
+
+_DEFERRED_METHODS = ('conn_execute_deferred', 'cursor_close')
+'''
+Methods that are executed without sending result back to client
+'''
+
+class CallStats(object):
+	'''
+	Proxy calls diagnostics: number of calls and time spent waiting for result
+	'''
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.calls = 0
+		self.reads = 0
+		self.wait_total = 0.0
+		self.wait_max = 0.0
+
+
+	def add(self, wait, read=False):
+		with self._lock:
+			self.calls += 1
+			if read:
+				self.reads += 1
+			self.wait_total += wait
+			self.wait_max = max(self.wait_max, wait)
+
+
+class ReadPool(object):
+	'''
+	Read-only connections to serve SELECTs concurrently with a single writer.
+	Connections are per calling thread, concurrency is bounded by pool size
+	'''
+
+	def __init__(self, conn_creator, size):
+		self.size = size
+		self._creator = conn_creator
+		self._local = threading.local()
+		self._semaphore = threading.BoundedSemaphore(size)
+		self._deferred_lock = threading.Lock()
+		# Sequence numbers of last deferred write sent to server and committed by it
+		self.deferred_seq = 0
+		self.committed_seq = 0
+
+
+	def can_read(self, sql):
+		# Readers can't see uncommitted deferred writes
+		return self.deferred_seq == self.committed_seq and \
+				sql.lstrip()[:6].upper() == 'SELECT'
+
+
+	def put_deferred(self, tasks_queue, args, conn):
+		with self._deferred_lock:
+			self.deferred_seq += 1
+			tasks_queue.put(('conn_execute_deferred', self.deferred_seq, args, dict(conn=conn)))
+
+
+	def execute(self, *args):
+		'''
+		@return: sqlite3 cursor. It's bound to calling thread connection
+		'''
+		self._semaphore.acquire()
+		try:
+			cur = self._conn().cursor()
+			cur.execute(*args)
+			return cur
+		finally:
+			self._semaphore.release()
+
+
+	def _conn(self):
+		conn = getattr(self._local, 'conn', None)
+		if not conn:
+			conn = self._creator()
+			conn.isolation_level = None
+			try:
+				conn.execute('PRAGMA query_only = 1')
+			except sqlite3.Error:
+				# SQLite < 3.8
+				pass
+			self._local.conn = conn
+		return conn
+
+
 class Proxy(object):
 	
 	
-	def __init__(self, tasks_queue):
+	def __init__(self, tasks_queue, readers=None, stats=None):
 		'''
 		Ingoing tasks queue. Item is a tuple(method, client_hash, args, kwds)
 		Outgoing result.  
@@ -29,14 +134,18 @@ class Proxy(object):
 		self.result = None
 		self.error = None
 		self.tasks_queue = tasks_queue
+		self.readers = readers
+		self.stats = stats or CallStats()
 		self.result_available = threading.Event()
 		self.hash = self.__hash__()		
 	
 	def _call(self, method, args=None, kwds=None, wait=True):
 		self.result_available.clear()
+		started = time.time()
 		self.tasks_queue.put((method, self.__hash__(), args, kwds))
 		if wait:
 			self.result_available.wait(GLOBAL_TIMEOUT)
+			self.stats.add(time.time() - started)
 		try:	
 			if self.error:
 				raise self.error[0], self.error[1]
@@ -49,49 +158,104 @@ class Proxy(object):
 
 class CursorProxy(Proxy):
 
-	def __init__(self, tasks_queue):
-		super(CursorProxy, self).__init__(tasks_queue)
-		self._execute_result = None
-		self._call('cursor_create', [self])		
+	arraysize = ARRAYSIZE
+
+	def __init__(self, tasks_queue, readers=None, stats=None):
+		super(CursorProxy, self).__init__(tasks_queue, readers, stats)
+		self._registered = False
+		self._reset()
+
+
+	def _reset(self):
+		self._rows = []
+		self._rowcount = 0
+		self._more = False
+		# Cursor from read pool. Rows are fetched from it in the calling thread
+		self._reader_cur = None
+
+
+	def _call(self, method, args=None, kwds=None, wait=True):
+		if not self._registered:
+			# Register in server only when it's needed. Reads from pool don't need it
+			self._registered = True
+			super(CursorProxy, self)._call('cursor_create', [self])
+		return super(CursorProxy, self)._call(method, args, kwds, wait)
 		
 		
 	def execute(self, sql, parameters=None):
 		args = [sql]
 		if parameters:
 			args += [parameters]
-		self._execute_result = self._call('cursor_execute', args)
-
-		if not self._execute_result:
-			self._execute_result = dict(data=[], rowcount=0)
+		self.close()
+		if self.readers and self.readers.can_read(sql):
+			started = time.time()
+			self._reader_cur = self.readers.execute(*args)
+			self.stats.add(time.time() - started, read=True)
+			self._rowcount = self._reader_cur.rowcount
+			self._more = True
+		else:
+			result = self._call('cursor_execute', args, dict(arraysize=self.arraysize))
+			if result:
+				self._rows = result['data']
+				self._rowcount = result['rowcount']
+				self._more = result['more']
+		return self
 
-		# Temporary
-		#LOG.debug('Execute result: %s', self._execute_result)
 
-		self._execute_result['iter'] = iter(self._execute_result['data'] or [None])
-		return self
+	def _fetch_page(self, size):
+		if self._reader_cur:
+			rows = self._reader_cur.fetchmany(size)
+		else:
+			rows = self._call('cursor_fetchmany', [size]) or []
+		if len(rows) < size:
+			# Server closes exhausted cursor itself
+			self._more = False
+			self._reader_cur = None
+		self._rows.extend(rows)
 	
 	
 	def fetchone(self):
-		try:
-			return self._execute_result['iter'].next()
-		except StopIteration:
-			return None
+		rows = self.fetchmany(1)
+		return rows[0] if rows else None
+
+
+	def fetchmany(self, size=None):
+		size = size or self.arraysize
+		if len(self._rows) < size and self._more:
+			self._fetch_page(max(size - len(self._rows), self.arraysize))
+		ret = self._rows[:size]
+		del self._rows[:size]
+		return ret
 
 
 	def fetchall(self):
+		while self._more:
+			self._fetch_page(self.arraysize)
 		try:
-			return self._execute_result['data']
+			return self._rows
 		finally:
-			self._execute_result['data'] = None
+			self._rows = []
+
+
+	def __iter__(self):
+		while True:
+			rows = self.fetchmany()
+			if not rows:
+				break
+			for row in rows:
+				yield row
+
 	
 	@property
 	def rowcount(self):
-		return self._execute_result['rowcount']
+		return self._rowcount
 
 	
 	def close(self):
-		pass
-		#self._call('cursor_delete', wait=False)
+		if self._more and not self._reader_cur:
+			# Don't wait for reply, it may race with the next call result
+			self.tasks_queue.put(('cursor_close', self.__hash__(), None, None))
+		self._reset()
 		
 
 	__del__ = close
@@ -100,7 +264,7 @@ class CursorProxy(Proxy):
 class ConnectionProxy(Proxy):
 		
 	def cursor(self):
-		cp = CursorProxy(self.tasks_queue)
+		cp = CursorProxy(self.tasks_queue, self.readers, self.stats)
 		return cp
 
 
@@ -109,10 +273,47 @@ class ConnectionProxy(Proxy):
 		pass
 
 
+	def execute_deferred(self, sql, parameters=None):
+		'''
+		Queue write statement without waiting for result. 
+		Server groups deferred writes into one transaction, that is committed 
+		after FLUSH_DELAY seconds or on flush()
+		'''
+		args = [sql]
+		if parameters:
+			args += [parameters]
+		if self.readers:
+			self.readers.put_deferred(self.tasks_queue, args, self.__hash__())
+		else:
+			self.tasks_queue.put(('conn_execute_deferred', None, args, dict(conn=self.__hash__())))
+
+
+	def flush(self):
+		'''
+		Durability fence: returns when all deferred writes are committed.
+		Raises the first error of deferred writes failed since the previous flush
+		'''
+		# Use own proxy to not share result event with other threads
+		cp = CursorProxy(self.tasks_queue, self.readers, self.stats)
+		return cp._call('conn_flush', [self.__hash__()])
+
+
 	def executescript(self, sql):
 		return self._call('conn_executescript', [sql])
 
 
+	def get_stats(self):
+		'''
+		@return: dict with writer queue depth and proxy calls wait time
+		'''
+		return {
+			'queue_depth': self.tasks_queue.qsize(),
+			'calls': self.stats.calls,
+			'reads': self.stats.reads,
+			'wait_total': self.stats.wait_total,
+			'wait_max': self.stats.wait_max,
+			'readers': self.readers and self.readers.size or 0
+		}
 
 	
 	def _get_row_factory(self):
@@ -140,17 +341,31 @@ class ConnectionProxy(Proxy):
 		
 class SqliteServer(object):
 	
-	def __init__(self, conn_creator):
+	def __init__(self, conn_creator, readers=0):
 		self._master_conn = conn_creator()
 		self._master_conn.isolation_level = None
+		self._readers = None
+		if readers:
+			# Readers don't block writer and each other only in WAL mode
+			mode = self._master_conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+			if str(mode).lower() == 'wal':
+				self._readers = ReadPool(conn_creator, readers)
+			else:
+				LOG.debug('WAL journal is not supported (mode: %s). Read pool disabled', mode)
 		self._single_conn_proxy = None
 		self._clients = WeakValueDictionary()
 		self._cursors = {}
+		self._tx_deadline = None
+		self._tx_statements = 0
+		self._tx_seq = None
+		self._last_reap = time.time()
+		# First failed deferred write of each connection, raised from its flush()
+		self._deferred_errors = {}
 
 
 	def connect(self):
 		if not self._single_conn_proxy:
-			self._single_conn_proxy = ConnectionProxy(Queue.Queue())
+			self._single_conn_proxy = ConnectionProxy(Queue.Queue(), self._readers)
 			self._clients[self._single_conn_proxy.__hash__()] = self._single_conn_proxy
 		return self._single_conn_proxy 
 	
@@ -160,8 +375,29 @@ class SqliteServer(object):
 			# TODO: what about to create connection here and periodically check it's health
 			# This will allow us to remove SQLiteServerThread class
 			
-			job = self._single_conn_proxy.tasks_queue.get()
+			try:
+				job = self._next_job()
+			except Queue.Empty:
+				try:
+					self._tx_commit()
+				except:
+					LOG.warning('Cannot commit deferred writes. Will retry', exc_info=sys.exc_info())
+					self._tx_deadline = time.time() + FLUSH_DELAY
+				self._reap_cursors()
+				continue
+			if self._cursors:
+				self._reap_cursors()
 			#LOG.debug('job: %s', job)
+			if type(job) == tuple and job and job[0] in _DEFERRED_METHODS:
+				# Nobody waits for result
+				try:
+					getattr(self, '_%s' % job[0])(job[1], *(job[2] or []))
+				except:
+					LOG.warning('Deferred %s failed', job[0], exc_info=sys.exc_info())
+					conn = (job[3] or {}).get('conn')
+					if conn is not None:
+						self._deferred_errors.setdefault(conn, sys.exc_info())
+				continue
 			try:
 				result = error = None				
 				try:
@@ -185,6 +421,69 @@ class SqliteServer(object):
 				LOG.warning('Recoverable error in SQLite server loop', exc_info=sys.exc_info())
 	
 	
+	def _next_job(self):
+		queue = self._single_conn_proxy.tasks_queue
+		timeout = None
+		if self._tx_deadline is not None:
+			timeout = self._tx_deadline - time.time()
+			if timeout <= 0 or self._tx_statements >= FLUSH_MAX_STATEMENTS:
+				raise Queue.Empty()
+		if self._cursors:
+			# Wake up to reap idle cursors
+			timeout = min(timeout or CURSOR_IDLE_TIMEOUT, CURSOR_IDLE_TIMEOUT)
+		if timeout is None:
+			return queue.get()
+		return queue.get(True, timeout)
+
+
+	def _reap_cursors(self):
+		now = time.time()
+		if now - self._last_reap < CURSOR_IDLE_TIMEOUT:
+			return
+		self._last_reap = now
+		for hash, entry in self._cursors.items():
+			if now - entry['last_used'] > CURSOR_IDLE_TIMEOUT:
+				LOG.debug('Closing idle cursor (client: %s)', hash)
+				self._close_cursor(hash)
+
+
+	def _close_cursor(self, hash):
+		entry = self._cursors.pop(hash, None)
+		if entry:
+			entry['cursor'].close()
+
+
+	def _tx_begin(self):
+		if self._tx_deadline is None:
+			self._master_conn.execute('BEGIN')
+			self._tx_deadline = time.time() + FLUSH_DELAY
+			self._tx_statements = 0
+
+
+	def _tx_commit(self):
+		if self._tx_deadline is not None:
+			self._master_conn.execute('COMMIT')
+			self._tx_deadline = None
+			self._tx_statements = 0
+			if self._readers and self._tx_seq is not None:
+				self._readers.committed_seq = self._tx_seq
+			self._tx_seq = None
+
+
+	def _conn_execute_deferred(self, seq, *args):
+		self._tx_begin()
+		self._tx_statements += 1
+		self._tx_seq = seq
+		self._master_conn.execute(*args)
+
+
+	def _conn_flush(self, hash, conn=None):
+		self._tx_commit()
+		error = self._deferred_errors.pop(conn, None)
+		if error:
+			raise error[0], error[1], error[2]
+
+	
 	def _cursor_create(self, hash, proxy):
 		"""
 		self._cursors[hash] = self._master_conn.cursor()
@@ -202,44 +501,57 @@ class SqliteServer(object):
 			del self._cursors[hash]
 		return result
 		"""
+		self._close_cursor(hash)
 		if hash in self._clients:
 			#LOG.debug('delete cursor %s', hash)
 			del self._clients[hash]
 
 
-	def _cursor_execute(self, hash, *args, **kwds):
+	def _cursor_execute(self, hash, sql, parameters=None, arraysize=None):
+		'''
+		Execute statement and return first `arraysize` rows. 
+		When there are more rows, cursor stays open until client fetches them all
+		'''
+		if not sql.lstrip()[:6].upper() == 'SELECT':
+			# Caller expects it's write is durable as in autocommit mode
+			self._tx_commit()
+		self._close_cursor(hash)
 		cur = self._master_conn.cursor()
 		try:
-			cur.execute(*args, **kwds)
+			if parameters is not None:
+				cur.execute(sql, parameters)
+			else:
+				cur.execute(sql)
+			data = cur.fetchmany(arraysize) if arraysize else cur.fetchall()
+			more = bool(arraysize) and len(data) == arraysize
+			if more:
+				self._cursors[hash] = dict(cursor=cur, last_used=time.time())
 			return {
-				'data': cur.fetchall(),
-				'rowcount': cur.rowcount
+				'data': data,
+				'rowcount': cur.rowcount,
+				'more': more
 			}
 		finally:
-			cur.close()
+			if not hash in self._cursors:
+				cur.close()
 
 	
-	def _cursor_fetchone(self, hash):
-		result = None
-		if hash in self._cursors:
-			result = self._cursors[hash].fetchone()
-		return result 
-		
-		
-	def _cursor_fetchall(self, hash):
-		result = None
-		if hash in self._cursors:
-			result = self._cursors[hash].fetchall()
-		return result 
-	
-	
-	def _cursor_rowcount(self, hash):
-		result = None
-		if hash in self._cursors:
-			result = self._cursors[hash].rowcount
-		return result 
+	def _cursor_close(self, hash):
+		self._close_cursor(hash)
+
+
+	def _cursor_fetchmany(self, hash, size):
+		entry = self._cursors.get(hash)
+		if not entry:
+			raise sqlite3.ProgrammingError('Cursor is closed (idle more then %d seconds?)' % 
+										CURSOR_IDLE_TIMEOUT)
+		entry['last_used'] = time.time()
+		rows = entry['cursor'].fetchmany(size)
+		if len(rows) < size:
+			self._close_cursor(hash)
+		return rows
+
 
-	
 	def _conn_set_row_factory(self, hash, f):
 		self._master_conn.row_factory = f	
 	
@@ -257,6 +569,7 @@ class SqliteServer(object):
 		
 		
 	def _conn_executescript(self, hash, sql):
+		self._tx_commit()
 		return self._master_conn.executescript(sql)
 
 
@@ -295,13 +608,14 @@ class SQLiteServerThread(threading.Thread):
 	connection = None
 	conn_creator = None
 	
-	def __init__(self, conn_creator):
+	def __init__(self, conn_creator, readers=0):
 		self.ready = False
 		self.conn_creator = conn_creator
+		self.readers = readers
 		threading.Thread.__init__(self)
 		
 	def run(self):
-		server = SqliteServer(self.conn_creator)
+		server = SqliteServer(self.conn_creator, self.readers)
 		self.connection = server.connect()
 		self.ready = True
 		server.serve_forever()
@@ -4,7 +4,16 @@ Created on May 23, 2011
 @author: marat
 '''
 
+from __future__ import with_statement
+
+import cStringIO
+import httplib
+import select
+import socket
+import threading
+import time
 import urllib2
+import urlparse
 
 class HTTPRedirectHandler(urllib2.HTTPRedirectHandler):
 	
@@ -38,4 +47,112 @@ class HTTPRedirectHandler(urllib2.HTTPRedirectHandler):
 		else:
 			raise urllib2.HTTPError(req.get_full_url(), code, msg, headers, fp)	
 	
-	http_error_305 = urllib2.HTTPRedirectHandler.http_error_302
\ No newline at end of file
+	http_error_305 = urllib2.HTTPRedirectHandler.http_error_302
+
+class HTTPConnectionPool(object):
+	'''
+	Keep-alive HTTP(S) connections, reused between requests to the same host.
+	Errors are raised as urllib2.HTTPError and urllib2.URLError, 
+	so it can replace urllib2.urlopen for POST requests without redirects
+	'''
+
+	def __init__(self, timeout=30, max_idle=4, idle_timeout=60):
+		self.timeout = timeout
+		self.max_idle = max_idle
+		self.idle_timeout = idle_timeout
+		self.opened = 0
+		self.reused = 0
+		self._idle = {}
+		self._lock = threading.Lock()
+
+
+	def post(self, url, data, headers=None):
+		'''
+		@return: tuple(status, response headers, response body)
+		'''
+		r = urlparse.urlparse(url)
+		key = (r.scheme, r.hostname, r.port)
+		path = r.path or '/'
+		if r.query:
+			path += '?' + r.query
+		headers = dict(headers or {})
+		headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+
+		conn, reused = self._get(key)
+		try:
+			try:
+				resp = self._request(conn, path, data, headers)
+			except (httplib.HTTPException, socket.error), e:
+				conn.close()
+				if not reused:
+					raise
+				# Server closed keep-alive connection, while it was idle
+				conn, reused = self._new(key), False
+				resp = self._request(conn, path, data, headers)
+			body = resp.read()
+		except (httplib.HTTPException, socket.error), e:
+			conn.close()
+			raise urllib2.URLError(e)
+
+		if resp.will_close:
+			conn.close()
+		else:
+			self._put(key, conn)
+
+		if not 200 <= resp.status < 300:
+			raise urllib2.HTTPError(url, resp.status, resp.reason, 
+						resp.msg, cStringIO.StringIO(body))
+		return resp.status, resp.msg, body
+
+
+	def close(self):
+		with self._lock:
+			for conns in self._idle.values():
+				for conn, _ in conns:
+					conn.close()
+			self._idle.clear()
+
+
+	def _request(self, conn, path, data, headers):
+		conn.request('POST', path, data, headers)
+		return conn.getresponse()
+
+
+	def _get(self, key):
+		now = time.time()
+		with self._lock:
+			conns = self._idle.get(key, [])
+			while conns:
+				conn, last_used = conns.pop()
+				if now - last_used < self.idle_timeout and self._healthy(conn):
+					self.reused += 1
+					return conn, True
+				conn.close()
+		return self._new(key), False
+
+
+	def _new(self, key):
+		scheme, host, port = key
+		cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+		with self._lock:
+			self.opened += 1
+		return cls(host, port, timeout=self.timeout)
+
+
+	def _put(self, key, conn):
+		with self._lock:
+			conns = self._idle.setdefault(key, [])
+			if len(conns) < self.max_idle:
+				conns.append((conn, time.time()))
+				return
+		conn.close()
+
+
+	def _healthy(self, conn):
+		# Idle keep-alive socket becomes readable when server closes it
+		if not conn.sock:
+			return False
+		try:
+			return not select.select([conn.sock], [], [], 0)[0]
+		except (select.error, socket.error):
+			return False